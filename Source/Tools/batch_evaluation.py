@@ -0,0 +1,240 @@
+import argparse
+import contextlib
+import glob
+import os
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from tqdm import tqdm
+
+from Source.Tools.confusion_matrix_stats_calculator import (STAT_BLOC_COLUMNS, binary_confusion_counts,
+                                                            confusion_stats, stack_file_paths)
+from Source.Tools.console import OUTPUT_FORMATS, write_records
+from Source.Tools.image_io import read_image
+from Source.Tools.volume_cache import DEFAULT_MAX_CACHE_BYTES, cached_volume, npy_file_bytes
+from Source.Tools.volume_sources import ArraySource, MultiPageTiffSource, is_volume_file, open_volume_source
+
+# Columns of the table written by batch_confusion_matrix_statistics
+BATCH_COLUMNS = ("model",) + STAT_BLOC_COLUMNS + ("unlabeled",)
+
+# Read-only volumes shared by the worker processes, opened once per process by _open_shared_volumes
+_shared_volumes = {}
+
+
+def expand_predicted_folders(predicted_folder_paths):
+    """
+    Expands a list of predicted folder paths and glob patterns into the folders to evaluate.
+    :param predicted_folder_paths: A folder or volume file path or glob pattern, or a list of them
+    :return: List of folder and volume file paths in the order given, each pattern's matches sorted
+    """
+    if isinstance(predicted_folder_paths, (str, os.PathLike)):
+        predicted_folder_paths = [predicted_folder_paths]
+
+    folders = []
+    for path in predicted_folder_paths:
+        path = os.fspath(path)
+        matches = sorted(glob.glob(path)) if glob.has_magic(path) else [path]
+
+        for match in matches:
+            if (os.path.isdir(match) or is_volume_file(match)) and match not in folders:
+                folders.append(match)
+
+    if not folders:
+        raise ValueError(f"No predicted dataset folders found: {predicted_folder_paths}")
+
+    return folders
+
+
+def _shared_volume_path(folder_path, cache_dir, scratch_dir):
+    """
+    Decodes a folder once into a memory-mapped slice-contiguous volume that worker processes can open read-only.
+    Volume files that can already be memory-mapped are shared as they are.
+    :return: Path to the .npy file of the volume, or to the volume file
+    """
+    if is_volume_file(folder_path):
+        with open_volume_source(folder_path) as volume_source:
+            if not isinstance(volume_source, MultiPageTiffSource) or volume_source.is_memory_mapped:
+                return folder_path
+
+            # Compressed multi-page TIFFs are decoded once into a scratch volume rather than by every worker
+            with tempfile.NamedTemporaryFile(dir=scratch_dir, suffix=".npy", delete=False) as scratch_file:
+                volume_path = scratch_file.name
+            volume = np.lib.format.open_memmap(volume_path, mode="w+", dtype=volume_source.dtype,
+                                               shape=volume_source.shape)
+            for start in range(0, len(volume_source), 16):
+                volume[start:start + 16] = volume_source.read_slab(start, start + 16)
+            volume.flush()
+            return volume_path
+
+    file_paths = stack_file_paths(folder_path)
+
+    if cache_dir is not None and file_paths:
+        # Volumes too large for the persistent cache are only decoded into the scratch copy below
+        first_image = read_image(file_paths[0])
+        if npy_file_bytes((len(file_paths),) + first_image.shape, first_image.dtype) <= DEFAULT_MAX_CACHE_BYTES:
+            return cached_volume(file_paths, cache_dir).filename
+
+    # Volumes too large for the persistent cache still get a scratch copy for the length of the batch
+    return cached_volume(file_paths, scratch_dir, max_cache_bytes=float("inf")).filename
+
+
+def _volume_shape(path):
+    """
+    :return: (slices, rows, columns) shape of a shared volume
+    """
+    if path.endswith(".npy"):
+        return np.load(path, mmap_mode="r").shape
+    with open_volume_source(path) as volume_source:
+        return volume_source.shape
+
+
+def _open_shared_volumes(ground_truth_path, roi_mask_path):
+    """
+    Process pool initializer mapping the shared ground truth and ROI mask volumes.
+    """
+    for name, path in (("ground_truth", ground_truth_path), ("roi_mask", roi_mask_path)):
+        if path is None:
+            _shared_volumes[name] = None
+        elif path.endswith(".npy"):
+            _shared_volumes[name] = ArraySource(np.load(path, mmap_mode="r"), path)
+        else:
+            _shared_volumes[name] = open_volume_source(path)
+
+
+def _score_prediction(predicted_folder_path, pos_label, slab_size):
+    """
+    Streams a predicted folder slab by slab against the shared ground truth and ROI mask volumes.
+    :return: tn, fp, fn, tp and unlabeled counts, or the error message if the prediction can't be compared
+    """
+    ground_truth = _shared_volumes["ground_truth"]
+    roi_mask = _shared_volumes["roi_mask"]
+
+    try:
+        # Each prediction's handles are closed once it is scored, so long batches don't pile up open files
+        with open_volume_source(predicted_folder_path) as predicted_source:
+            if len(predicted_source) != len(ground_truth):
+                raise ValueError("Datasets are not the same size")
+
+            confusion_totals = np.zeros(5, dtype=np.int64)
+
+            for start in range(0, len(predicted_source), slab_size):
+                # Each process decodes on a single thread since the pool already uses every core
+                predicted = predicted_source.read_slab(start, start + slab_size, workers=1)
+                ground_truth_slab = ground_truth.read_slab(start, start + slab_size, workers=1)
+
+                if predicted.shape != ground_truth_slab.shape:
+                    raise ValueError("Datasets are not the same size")
+
+                roi_voxels = None
+                if roi_mask is not None:
+                    roi_voxels = roi_mask.read_slab(start, start + slab_size, workers=1) == pos_label
+                confusion_totals += binary_confusion_counts(ground_truth_slab, predicted, pos_label, roi_voxels)
+
+    except (OSError, ValueError) as error:
+        return str(error)
+
+    return confusion_totals
+
+
+def write_stat_table(rows, output_path):
+    """
+    Writes the batch statistics to a CSV or JSON file depending on the file extension.
+    :param rows: List of dictionaries with the BATCH_COLUMNS keys
+    :param output_path: Path to the .csv or .json output file
+    """
+    write_records(rows, BATCH_COLUMNS, output_path)
+
+
+def batch_confusion_matrix_statistics(pos_label, ground_truth_folder_path, predicted_folder_paths,
+                                      roi_mask_folder_path=None, output_path=None, slab_size=16, workers=None,
+                                      cache_dir=None):
+    """
+    Compares many predicted datasets against one ground truth (and optional ROI mask). The shared volumes are decoded
+    once into memory-mapped files that every worker process reads, and the predictions are scored in parallel.
+    :param pos_label: The greyscale integer value considered to be positive
+    :param ground_truth_folder_path: Path to the ground truth image stack folder, multi-page TIFF or raw volume file
+    :param predicted_folder_paths: A predicted folder (or volume file) path or glob pattern, or a list of them
+    :param roi_mask_folder_path: Optional path to the ROI mask image stack folder or volume file, None to include the
+                                 entire dataset
+    :param output_path: Optional path to a .csv or .json file to write the table of statistics to
+    :param slab_size: The number of predicted slices each worker decodes and counts at a time
+    :param workers: Number of worker processes, None for one per core
+    :param cache_dir: Optional path to a volume cache folder to keep the shared volumes between batches
+    :return: List of dictionaries of the statistics per predicted folder, see BATCH_COLUMNS
+    """
+    predicted_folders = expand_predicted_folders(predicted_folder_paths)
+    print(f"Evaluating {len(predicted_folders)} predicted datasets")
+
+    rows = []
+
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        ground_truth_path = _shared_volume_path(ground_truth_folder_path, cache_dir, scratch_dir)
+        roi_mask_path = None
+        if roi_mask_folder_path is not None:
+            roi_mask_path = _shared_volume_path(roi_mask_folder_path, cache_dir, scratch_dir)
+
+            if _volume_shape(roi_mask_path) != _volume_shape(ground_truth_path):
+                raise ValueError("Mask dimensions don't match the datasets")
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=_open_shared_volumes,
+                                 initargs=(ground_truth_path, roi_mask_path)) as executor:
+            results = executor.map(_score_prediction, predicted_folders, [pos_label] * len(predicted_folders),
+                                   [slab_size] * len(predicted_folders))
+
+            for predicted_folder, result in tqdm(zip(predicted_folders, results),
+                                                 total=len(predicted_folders),
+                                                 desc="Scoring Predictions",
+                                                 unit="Dataset"):
+                if isinstance(result, str):
+                    print(f"Warning: {predicted_folder} was skipped: {result}")
+                    continue
+
+                tn, fp, fn, tp, unlabeled = (int(count) for count in result)
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    stats = confusion_stats(np.int64(tn), np.int64(fp), np.int64(fn), np.int64(tp))
+
+                row = {"model": predicted_folder}
+                row.update({column: stat.item() for column, stat in zip(STAT_BLOC_COLUMNS, stats)})
+                row["unlabeled"] = unlabeled
+                rows.append(row)
+
+    if output_path is not None:
+        write_stat_table(rows, output_path)
+        print(f"Statistics written to {output_path}")
+
+    return rows
+
+
+def main(argv=None):
+    """
+    Command line entry point, run with python -m Source.Tools.batch_evaluation --help for the options.
+    :param argv: Optional list of the command line arguments, None for sys.argv
+    """
+    parser = argparse.ArgumentParser(description="Score many predicted image stacks against one ground truth.")
+    parser.add_argument("ground_truth", help="ground truth image stack folder")
+    parser.add_argument("predicted", nargs="+", help="predicted image stack folders or quoted glob patterns")
+    parser.add_argument("--roi", default=None, help="ROI mask image stack folder")
+    parser.add_argument("--pos-label", type=int, default=255, help="greyscale value considered positive")
+    parser.add_argument("--output", default=None, help=".csv or .json file to write the statistics to, stdout if unset")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default=None,
+                        help="format of the statistics, by default the output file's extension or JSON on stdout")
+    parser.add_argument("--slab-size", type=int, default=16, help="slices decoded at a time by each worker")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--cache-dir", default=None, help="volume cache folder to keep the shared volumes in")
+    args = parser.parse_args(argv)
+
+    # Progress messages go to stderr so the table on stdout can be piped
+    with contextlib.redirect_stdout(sys.stderr):
+        rows = batch_confusion_matrix_statistics(args.pos_label, args.ground_truth, args.predicted, args.roi,
+                                                 slab_size=args.slab_size, workers=args.workers,
+                                                 cache_dir=args.cache_dir)
+
+    write_records(rows, BATCH_COLUMNS, args.output, args.format)
+    if args.output is not None:
+        print(f"Statistics written to {args.output}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
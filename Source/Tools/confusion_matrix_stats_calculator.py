@@ -1,59 +1,464 @@
+import argparse
+import contextlib
 import os
-import tkinter as tk
-from tkinter import filedialog
+import sys
 
 import numpy as np
-from PIL import Image
-from sklearn.metrics import confusion_matrix
 
+from Source.Tools.console import OUTPUT_FORMATS, ask_directory, write_records
+from Source.Tools.image_io import map_ordered, stack_images
+from Source.Tools.instrumentation import configure, instrumented, stage
+from Source.Tools.packed_mask import (PackedMask, label_bits, pack_labels, packed_confusion_counts, popcount,
+                                      slice_masks)
+from Source.Tools.volume_cache import cached_volume
+from Source.Tools.volume_sources import ArraySource, close_sources, is_volume_file, open_volume_source
 
-def image_stacker(folder_path):
+# Names of the statistics returned by confusion_matrix_statistics, in order
+STAT_BLOC_COLUMNS = ("tp", "fn", "fp", "tn", "precision", "recall", "f1", "pixel_error")
+
+# Names of the counts along the last axis of a slice profile, in the order returned by binary_confusion_counts
+PROFILE_COLUMNS = ("tn", "fp", "fn", "tp", "unlabeled")
+
+
+def stack_file_paths(folder_path):
+    """
+    Lists the files of an image stack folder in the order they are stacked into a volume.
+    :param folder_path: Path to the folder containing images of identical size
+    :return: Sorted list of paths to each file in the folder
+    """
+    return [os.path.join(folder_path, file_name) for file_name in sorted(os.listdir(folder_path))]
+
+
+def stack_length(folder_path):
+    """
+    :param folder_path: Path to an image stack folder, or a multi-page TIFF or raw volume file
+    :return: The number of slices in the stack
+    """
+    if is_volume_file(folder_path):
+        with open_volume_source(folder_path) as volume_source:
+            return len(volume_source)
+
+    return len(stack_file_paths(folder_path))
+
+
+def image_stacker(folder_path, z_axis=2, workers=None, cache_dir=None, prefetch=None):
     """
     Converts folders containing image stacks to a 3D array of the intensity values (image volume).
-    :param folder_path: Path to the folder containing images of identical size that will be stacked into a volume
+    :param folder_path: Path to the folder containing images of identical size that will be stacked into a volume, or
+                        to a multi-page TIFF or raw volume file holding every slice (see volume_sources)
+    :param z_axis: The axis the images are stacked along, 2 for (rows, columns, slices) or 0 for (slices, rows, columns)
+    :param workers: Number of threads decoding the images, None for one per core
+    :param cache_dir: Optional path to a volume cache folder, the volume is then memory-mapped from the cache and only
+                      decoded the first time the folder is loaded
+    :param prefetch: Optional Prefetch setting how many images of a folder are decoded at once and recording the time
+                     spent waiting on them
     :return: Resulting image volume of the stacked images converted to a 3D array
     """
-    image_list = []
+    if is_volume_file(folder_path):
+        with open_volume_source(folder_path) as volume_source:
+            return np.moveaxis(volume_source.read_slab(0, len(volume_source), workers), 0, z_axis)
+
+    if cache_dir is not None:
+        # Cached volumes are stored slice-contiguous and viewed in the requested layout
+        return np.moveaxis(cached_volume(stack_file_paths(folder_path), cache_dir, workers=workers), 0, z_axis)
+
+    return stack_images(stack_file_paths(folder_path), z_axis, workers, prefetch)
+
+
+def slab_stacker(folder_path, slab_size, workers=None, cache_dir=None):
+    """
+    Streams an image stack folder as consecutive slabs of slices so only one slab is held in memory at a time.
+    :param folder_path: Path to the folder containing images of identical size that will be stacked into slabs, or to
+                        a multi-page TIFF or raw volume file whose pages are read lazily
+    :param slab_size: The number of slices in each slab (the last slab may be smaller)
+    :param workers: Number of threads decoding the images of each slab, None for one per core
+    :param cache_dir: Optional path to a volume cache folder to read the slabs from a memory-mapped cached volume
+    :return: Generator of 3D arrays stacked the same way as image_stacker
+    """
+    if not isinstance(slab_size, int) or isinstance(slab_size, bool) or slab_size < 1:
+        raise ValueError("Slab size must be a positive integer")
+
+    if is_volume_file(folder_path):
+        # The handles are closed once every slab is read or the generator is discarded
+        with open_volume_source(folder_path) as volume_source:
+            for start in range(0, len(volume_source), slab_size):
+                yield np.moveaxis(volume_source.read_slab(start, start + slab_size, workers), 0, 2)
+        return
+
+    file_paths = stack_file_paths(folder_path)
+
+    if cache_dir is not None:
+        volume = cached_volume(file_paths, cache_dir, workers=workers)
+        for start in range(0, len(file_paths), slab_size):
+            yield np.moveaxis(volume[start:start + slab_size], 0, 2)
+        return
+
+    for start in range(0, len(file_paths), slab_size):
+        yield stack_images(file_paths[start:start + slab_size], workers=workers)
+
+
+def tile_counts(voxels, tile_size):
+    """
+    Counts the True voxels of each XY tile of each slice of a (rows, columns, slices) boolean volume.
+    :param voxels: Boolean volume with the slices along the last axis
+    :param tile_size: Width and height of the square tiles in pixels, the last row and column of tiles may be smaller
+    :return: Integer array of shape (slices, tile rows, tile columns)
+    """
+    row_starts = np.arange(0, voxels.shape[0], tile_size)
+    column_starts = np.arange(0, voxels.shape[1], tile_size)
+
+    row_counts = np.add.reduceat(voxels, row_starts, axis=0, dtype=np.int64)
+    tile_totals = np.add.reduceat(row_counts, column_starts, axis=1)
+
+    return np.moveaxis(tile_totals, 2, 0)
+
+
+def binary_confusion_counts(ground_truth, predicted, pos_label, roi_voxels=None, per_slice=False, tile_size=None):
+    """
+    Counts the binary confusion matrix of two image volumes without flattening or copying them.
+    :param ground_truth: Ground truth image volume containing 0 and pos_label values
+    :param predicted: Predicted image volume of the same shape containing 0 and pos_label values
+    :param pos_label: The greyscale integer value considered to be positive
+    :param roi_voxels: Optional boolean array of the same shape, only the True voxels are counted
+    :param per_slice: Count each slice of a (rows, columns, slices) volume separately instead of the whole volume
+    :param tile_size: Optional tile width in pixels to also count each XY tile of each slice separately
+    :return: tn, fp, fn, tp counts and the number of counted voxels whose values are neither 0 nor pos_label, each an
+             array of shape (slices,) when per_slice is True or (slices, tile rows, tile columns) with a tile_size
+    """
+    if tile_size is not None:
+        def count(voxels):
+            return tile_counts(voxels, tile_size)
+    elif per_slice:
+        def count(voxels):
+            return np.count_nonzero(voxels, axis=(0, 1))
+    else:
+        def count(voxels):
+            return np.int64(np.count_nonzero(voxels))
+
+    ground_truth_positive = ground_truth == pos_label
+    predicted_positive = predicted == pos_label
+
+    # Voxels are only classified if both volumes hold either 0 or pos_label there
+    labeled = np.logical_or(ground_truth_positive, ground_truth == 0)
+    labeled &= np.logical_or(predicted_positive, predicted == 0)
+
+    if roi_voxels is not None:
+        labeled &= roi_voxels
+        counted_voxels = count(roi_voxels)
+    else:
+        counted_voxels = count(np.broadcast_to(True, labeled.shape))
+
+    ground_truth_positive &= labeled
+    predicted_positive &= labeled
+
+    labeled_voxels = count(labeled)
+    ground_truth_positives = count(ground_truth_positive)
+    predicted_positives = count(predicted_positive)
+
+    # Reuses the ground truth positive buffer to find the voxels positive in both volumes
+    ground_truth_positive &= predicted_positive
+    tp = count(ground_truth_positive)
+
+    fn = ground_truth_positives - tp
+    fp = predicted_positives - tp
+    tn = labeled_voxels - tp - fn - fp
+    unlabeled = counted_voxels - labeled_voxels
+
+    return tn, fp, fn, tp, unlabeled
+
+
+def streamed_confusion_counts(pos_label, ground_truth_folder_path, predicted_folder_path, roi_mask_folder_path=None,
+                              slab_size=1, cache_dir=None, profile=False, tile_size=None):
+    """
+    Calculates the confusion matrix of two image stacks by reading matching slabs of slices from each folder and adding
+    their counts to running totals, so peak memory depends on the slab size rather than the volume size. Each slice is
+    packed into one bit per voxel as it is decoded and each slab is counted on the packed masks.
+    :param pos_label: The greyscale integer value considered to be positive
+    :param ground_truth_folder_path: Path to the ground truth image stack folder
+    :param predicted_folder_path: Path to the predicted image stack folder
+    :param roi_mask_folder_path: Optional path to the ROI mask image stack folder, None to include the entire dataset
+    :param slab_size: The number of slices read from each folder at a time
+    :param cache_dir: Optional path to a volume cache folder to read the slabs from memory-mapped cached volumes
+    :param profile: Also return the counts of each slice, gathered in the same pass
+    :param tile_size: Optional tile width in pixels to profile each XY tile of each slice (implies profile)
+    :return: tn, fp, fn, tp counts, the number of counted voxels that are neither 0 nor pos_label, the number of
+             ROI voxels (None if there is no ROI mask) and the profile (None unless requested), an array of shape
+             (slices, 5) or (slices, tile rows, tile columns, 5) holding the PROFILE_COLUMNS counts
+    """
+    profile = profile or tile_size is not None
+
+    if tile_size is not None:
+        return streamed_tile_counts(pos_label, ground_truth_folder_path, predicted_folder_path, roi_mask_folder_path,
+                                    slab_size, cache_dir, tile_size)
+
+    if not isinstance(slab_size, int) or isinstance(slab_size, bool) or slab_size < 1:
+        raise ValueError("Slab size must be a positive integer")
+
+    paths = [ground_truth_folder_path, predicted_folder_path]
+    if roi_mask_folder_path is not None:
+        paths.append(roi_mask_folder_path)
+    sources = [dataset_source(path, cache_dir) for path in paths]
+    try:
+        if sources[1].shape != sources[0].shape:
+            raise ValueError("Datasets are not the same size")
+        if roi_mask_folder_path is not None and sources[2].shape != sources[0].shape:
+            raise ValueError("Mask dimensions don't match the datasets")
+
+        def slice_bits(index):
+            # Each slice is packed in the thread that decodes it, so a slab only ever exists packed
+            bits = label_bits(sources[0].read(index), pos_label) + label_bits(sources[1].read(index), pos_label)
+            if roi_mask_folder_path is not None:
+                bits += (np.packbits(sources[2].read(index) == pos_label, axis=None),)
+            return bits
+
+        slice_count = len(sources[0])
+        slice_nbytes = sum(source.nbytes for source in sources) // max(slice_count, 1)
+        slice_profile = np.zeros((slice_count, 5), dtype=np.int64)
+        roi_size = None if roi_mask_folder_path is None else 0
+        full_bits = np.packbits(np.ones(sources[0].slice_shape, dtype=bool), axis=None)
+
+        with stage("streamed_count") as count_stage:
+            for index, bits in zip(range(slice_count), map_ordered(slice_bits, range(slice_count))):
+                start = index - index % slab_size
+                stop = min(start + slab_size, slice_count)
+
+                # Packed masks of the ground truth and predicted positive and labeled voxels, and of the ROI
+                if index == start:
+                    slab_masks = [PackedMask(stop - start, sources[0].slice_shape) for _ in bits]
+                    unlabeled_slab = False
+
+                for mask, mask_bits in zip(slab_masks, bits):
+                    mask.write_bits(index - start, full_bits if mask_bits is None else mask_bits)
+                unlabeled_slab |= bits[1] is not None or bits[3] is not None
+
+                if index + 1 == stop:
+                    ground_truth_positive, ground_truth_labeled, predicted_positive, predicted_labeled = slab_masks[:4]
+                    roi = slab_masks[4] if roi_mask_folder_path is not None else None
+                    if not unlabeled_slab:
+                        ground_truth_labeled = predicted_labeled = None
+
+                    slice_profile[start:stop] = np.stack(packed_confusion_counts(
+                        ground_truth_positive, predicted_positive, ground_truth_labeled, predicted_labeled, roi,
+                        per_slice=True), axis=-1)
+                    if roi is not None:
+                        roi_size += int(popcount(roi.words))
+                    count_stage.add(slices=stop - start, nbytes=(stop - start) * slice_nbytes)
+
+        tn, fp, fn, tp, unlabeled = slice_profile.sum(axis=0)
+
+        return tn, fp, fn, tp, unlabeled, roi_size, slice_profile if profile else None
+    finally:
+        close_sources(*sources)
+
+
+def streamed_tile_counts(pos_label, ground_truth_folder_path, predicted_folder_path, roi_mask_folder_path=None,
+                         slab_size=1, cache_dir=None, tile_size=None):
+    """
+    The tile profile of streamed_confusion_counts, counted on decoded slabs since tile sums need the voxels in place.
+    :return: the same values as streamed_confusion_counts
+    """
+    slice_count = stack_length(ground_truth_folder_path)
+
+    if stack_length(predicted_folder_path) != slice_count:
+        raise ValueError("Datasets are not the same size")
+
+    slab_streams = [slab_stacker(ground_truth_folder_path, slab_size, cache_dir=cache_dir),
+                    slab_stacker(predicted_folder_path, slab_size, cache_dir=cache_dir)]
+
+    if roi_mask_folder_path is not None:
+        if stack_length(roi_mask_folder_path) != slice_count:
+            raise ValueError("Mask dimensions don't match the datasets")
+        slab_streams.append(slab_stacker(roi_mask_folder_path, slab_size, cache_dir=cache_dir))
+
+    confusion_totals = np.zeros(5, dtype=np.int64)
+    slab_profiles = []
+    roi_size = None if roi_mask_folder_path is None else 0
+
+    with stage("streamed_count") as count_stage:
+        for slabs in zip(*slab_streams):
+            ground_truth, predicted = slabs[0], slabs[1]
+            count_stage.add(slices=np.shape(ground_truth)[2], nbytes=sum(slab.nbytes for slab in slabs))
+
+            if np.shape(ground_truth) != np.shape(predicted):
+                raise ValueError("Datasets are not the same size")
+
+            roi_voxels = None
+            if roi_mask_folder_path is not None:
+                if np.size(ground_truth) != np.size(slabs[2]):
+                    raise ValueError("Mask dimensions don't match the datasets")
+
+                # Only the voxels inside the ROI are counted
+                roi_voxels = np.reshape(slabs[2] == pos_label, np.shape(ground_truth))
+                roi_size += np.count_nonzero(roi_voxels)
+
+            slab_profile = np.stack(binary_confusion_counts(ground_truth, predicted, pos_label, roi_voxels, True,
+                                                            tile_size), axis=-1)
+            slab_profiles.append(slab_profile)
+            confusion_totals += slab_profile.reshape(-1, 5).sum(axis=0)
+
+    tn, fp, fn, tp, unlabeled = confusion_totals
+    slice_profile = np.concatenate(slab_profiles) if slab_profiles else None
+
+    return tn, fp, fn, tp, unlabeled, roi_size, slice_profile
+
+
+def dataset_source(folder_path, cache_dir=None, workers=None):
+    """
+    Opens a dataset for lazy slice access in stacking order.
+    :param folder_path: Path to an image stack folder, or a multi-page TIFF or raw volume file
+    :param cache_dir: Optional path to a volume cache folder to read a folder's slices from a memory-mapped cached
+                      volume
+    :param workers: Number of threads decoding a folder into the cache the first time, None for one per core
+    :return: VolumeSource of the dataset
+    """
+    if is_volume_file(folder_path):
+        return open_volume_source(folder_path)
+
+    if cache_dir is not None:
+        return ArraySource(cached_volume(stack_file_paths(folder_path), cache_dir, workers=workers), folder_path)
+
+    return open_volume_source(folder_path, stack_file_paths(folder_path))
+
+
+def roi_slice_boxes(roi_source, pos_label, workers=None, packed=False):
+    """
+    Reads an ROI mask slice by slice to find the bounding box of the ROI in each slice.
+    :param roi_source: VolumeSource of the ROI mask
+    :param pos_label: The greyscale integer value marking voxels inside the ROI
+    :param workers: Number of decoding threads, None for one per core
+    :param packed: Keep the cropped ROI masks packed with np.packbits, one bit per voxel, instead of as boolean arrays
+    :return: List with ((first row, last row + 1), (first column, last column + 1), cropped ROI mask) for each slice,
+             None for slices without any ROI voxel, and the number of ROI voxels
+    """
+    def slice_box(roi_mask):
+        roi_voxels = roi_mask == pos_label
+
+        rows, columns = np.flatnonzero(roi_voxels.any(axis=1)), np.flatnonzero(roi_voxels.any(axis=0))
+        if not len(rows):
+            return None, 0
+
+        rows, columns = (int(rows[0]), int(rows[-1]) + 1), (int(columns[0]), int(columns[-1]) + 1)
+        cropped = roi_voxels[rows[0]:rows[1], columns[0]:columns[1]]
+
+        return (rows, columns, np.packbits(cropped, axis=None) if packed else cropped), np.count_nonzero(cropped)
+
+    boxes = []
+    roi_size = 0
+    for box, roi_voxel_count in roi_source.map_slices(slice_box, workers):
+        boxes.append(box)
+        roi_size += roi_voxel_count
+
+    return boxes, roi_size
+
+
+def roi_cropped_confusion_counts(pos_label, ground_truth_folder_path, predicted_folder_path, roi_mask_folder_path,
+                                 cache_dir=None, profile=False, workers=None):
+    """
+    Calculates the confusion matrix inside an ROI by reading the ROI mask first, so that ground truth and predicted
+    slices without any ROI voxel are never decoded and the others are only counted inside the ROI's bounding box in that
+    slice. Memory-mapped and raw volumes only read the box (see VolumeSource.read_region), while most image files are
+    decoded whole and cropped (see image_io.read_image_region), so for those the saving comes from the empty slices.
+    The ROI boxes are kept packed, one bit per voxel, and each box of the datasets is packed before it is counted.
+    :param pos_label: The greyscale integer value considered to be positive
+    :param ground_truth_folder_path: Path to the ground truth image stack folder or volume file
+    :param predicted_folder_path: Path to the predicted image stack folder or volume file
+    :param roi_mask_folder_path: Path to the ROI mask image stack folder or volume file
+    :param cache_dir: Optional path to a volume cache folder to read the datasets from memory-mapped cached volumes
+    :param profile: Also return the counts of each slice, gathered in the same pass
+    :param workers: Number of decoding threads, None for one per core
+    :return: the same values as streamed_confusion_counts
+    """
+    sources = [dataset_source(path, cache_dir, workers)
+               for path in (ground_truth_folder_path, predicted_folder_path, roi_mask_folder_path)]
+    try:
+        if sources[1].shape != sources[0].shape:
+            raise ValueError("Datasets are not the same size")
+        if sources[2].shape != sources[0].shape:
+            raise ValueError("Mask dimensions don't match the datasets")
+
+        with stage("roi_boxes") as roi_stage:
+            boxes, roi_size = roi_slice_boxes(sources[2], pos_label, workers, packed=True)
+            roi_stage.add(slices=len(boxes))
+
+        roi_slices = [index for index, box in enumerate(boxes) if box is not None]
+
+        def count_slice(index):
+            # The box of each dataset is packed like the ROI and counted a word at a time
+            rows, columns, roi_bits = boxes[index]
+            ground_truth_bits = label_bits(sources[0].read_region(index, rows, columns), pos_label)
+            predicted_bits = label_bits(sources[1].read_region(index, rows, columns), pos_label)
+
+            ground_truth_positive, ground_truth_labeled, predicted_positive, predicted_labeled, roi = slice_masks(
+                (rows[1] - rows[0], columns[1] - columns[0]), *ground_truth_bits, *predicted_bits, roi_bits)
+            return packed_confusion_counts(ground_truth_positive, predicted_positive, ground_truth_labeled,
+                                           predicted_labeled, roi)
+
+        # Slices without any ROI voxel keep zero counts
+        slice_profile = np.zeros((len(boxes), 5), dtype=np.int64)
+        with stage("roi_count") as count_stage:
+            for index, counts in zip(roi_slices, map_ordered(count_slice, roi_slices, workers)):
+                slice_profile[index] = counts
+            count_stage.add(slices=len(roi_slices))
+
+        tn, fp, fn, tp, unlabeled = slice_profile.sum(axis=0)
+
+        return tn, fp, fn, tp, unlabeled, roi_size, slice_profile if profile else None
+    finally:
+        close_sources(*sources)
+
+
+def confusion_stats(tn, fp, fn, tp):
+    """
+    Calculates the statistics reported by confusion_matrix_statistics from the confusion matrix counts.
+    :return: tp, fn, fp, tn, precision, recall, F1-score and pixel error, in the order of STAT_BLOC_COLUMNS
+    """
+    # Calculates the precision from the true and false positive values for use in the f1 score calculation
+    precision = tp / (tp + fp)
 
-    # Iterates through all the files in the folder
-    for file_name in sorted(os.listdir(folder_path)):
-        file_path = os.path.join(folder_path, file_name)
+    # Calculates the recall values for use in the f1 score calculation
+    recall = tp / (tp + fn)
 
-        # Opens each image, converts it to an array, then appends the array to the list of images in the folder to save
-        with Image.open(file_path) as img:
-            image_array = np.array(img)
-            image_list.append(image_array)
+    # Calculate the F1-score from the precision and recall values to provide a hollistic comparison
+    f1 = 2 * (precision * recall) / (precision + recall)
 
-    # Converts the saved list of images into a 3D array by stacking them along the axis normal to the image plane
-    image_volume = np.stack(image_list, axis=2)
+    # Calculate pixel error
+    pixel_error = (fn + fp) / (tp + fn + fp + tn)
 
-    return image_volume
+    return tp, fn, fp, tn, precision, recall, f1, pixel_error
 
 
+@instrumented("confusion_matrix_statistics")
 def confusion_matrix_statistics(pos_label, roi_mask_input, print_labels, ground_truth_folder_path=None,
-                                predicted_folder_path=None, roi_mask_folder_path=None):
+                                predicted_folder_path=None, roi_mask_folder_path=None, slab_size=None, cache_dir=None,
+                                profile=False, tile_size=None, result_cache_dir=None):
     """
     Allows you to select datasets to compare and calculate the confusion matrix of. Prints relevant statistics such as
-    F1-score, precision, and recall.
+    F1-score, precision, and recall. A folder browser is only opened for the paths that aren't given.
     :param pos_label: The greyscale integer value considered to be positive, it should be equal to (2^(# of bits) - 1)
     :param roi_mask_input: Boolean value for if you have a specific region of interest to isolate
     :param print_labels: Boolean value that determines if the printed outputs have labels or not
     :param ground_truth_folder_path: Optional variable to enter the path to the ground truth folder to skip browsing
     :param predicted_folder_path: Optional variable to enter the path to the predicted folder to skip browsing
     :param roi_mask_folder_path: Optional variable to enter the path to the ROI mask folder to skip browsing
-    :return: The confusion matrix
+    :param slab_size: Optional number of slices to read from each folder at a time, streaming the datasets instead of
+                      loading the full volumes so peak memory depends on the slab size (None loads the full volumes)
+    :param cache_dir: Optional path to a volume cache folder, each dataset is then decoded once into the cache and
+                      memory-mapped on later calls (useful when comparing many predictions to the same ground truth)
+    :param profile: Also return the TP/FN/FP/TN counts of each slice, gathered in the same counting pass
+    :param tile_size: Optional tile width in pixels to profile each XY tile of each slice as well (implies profile)
+    :param result_cache_dir: Optional path to a result cache folder keeping the counts of every slice, so a rerun only
+                             counts the slices that are new or changed (see result_cache.cached_confusion_counts)
+    :return: The confusion matrix statistics, and the slice profile if requested (see streamed_confusion_counts)
     """
+    profile = profile or tile_size is not None
 
     if not isinstance(roi_mask_input, bool):
         raise ValueError("Mask parameter must be a boolean")
     if not isinstance(print_labels, bool):
         raise ValueError("Print_labels parameter must be a boolean")
 
-    root = tk.Tk()
-    root.withdraw()  # Hide the root window
-
     if ground_truth_folder_path is None:
-        ground_truth_folder_path = filedialog.askdirectory(title="Select the Ground Truth dataset folder")
+        ground_truth_folder_path = ask_directory("Select the Ground Truth dataset folder")
 
     if ground_truth_folder_path:
         print("Ground truth folder:", ground_truth_folder_path)
@@ -61,7 +466,7 @@ def confusion_matrix_statistics(pos_label, roi_mask_input, print_labels, ground_
         raise ValueError("No ground truth dataset selected")
 
     if predicted_folder_path is None:
-        predicted_folder_path = filedialog.askdirectory(title="Select the Predicted dataset folder")
+        predicted_folder_path = ask_directory("Select the Predicted dataset folder")
 
     if predicted_folder_path:
         print("Predicted folder:", predicted_folder_path)
@@ -70,7 +475,7 @@ def confusion_matrix_statistics(pos_label, roi_mask_input, print_labels, ground_
 
     if roi_mask_input is True:
         if roi_mask_folder_path is None:
-            roi_mask_folder_path = filedialog.askdirectory(title="Select the ROI mask dataset folder")
+            roi_mask_folder_path = ask_directory("Select the ROI mask dataset folder")
 
         if roi_mask_folder_path:
             print("ROI Mask folder:", roi_mask_folder_path)
@@ -78,49 +483,93 @@ def confusion_matrix_statistics(pos_label, roi_mask_input, print_labels, ground_
             print("No ROI mask selected, calculations will include the entire dataset.")
             roi_mask_input = False
 
-    # Converts image stacks to image volumes
-    ground_truth = image_stacker(ground_truth_folder_path)
-    predicted = image_stacker(predicted_folder_path)
-
-    if np.shape(ground_truth) != np.shape(predicted):
-        raise ValueError("Datasets are not the same size")
-
-    # Flatten the images to 1D arrays for use with sklearn's f1_score function
-    if roi_mask_input is True:
-        # If there's a mask dataset, turn it into indexes of 0s and 1s
-        roi_mask = image_stacker(roi_mask_folder_path)
-        normalized_roi_mask = roi_mask/pos_label
-        roi_size = np.sum(normalized_roi_mask)
+    if result_cache_dir is not None:
+        from Source.Tools.result_cache import cached_confusion_counts
+
+        if tile_size is not None:
+            raise ValueError("Tile profiles are not kept in the result cache")
+
+        # Reuses the counts of the slices that haven't changed since they were last counted
+        with stage("cached_count") as count_stage:
+            slice_profile, roi_size, counted = cached_confusion_counts(
+                pos_label, ground_truth_folder_path, predicted_folder_path, result_cache_dir,
+                roi_mask_folder_path if roi_mask_input is True else None)
+            count_stage.add(slices=counted)
+        tn, fp, fn, tp, unlabeled = slice_profile.sum(axis=0)
+        if roi_mask_input is True:
+            print("ROI voxels: ", roi_size)
+    elif slab_size is not None:
+        if roi_mask_input is False:
+            roi_mask_folder_path = None
+
+        # Streams matching slabs from each folder, adding their counts to running totals
+        tn, fp, fn, tp, unlabeled, roi_size, slice_profile = streamed_confusion_counts(
+            pos_label, ground_truth_folder_path, predicted_folder_path, roi_mask_folder_path, slab_size, cache_dir,
+            profile, tile_size)
+        if roi_mask_input is True:
+            print("ROI voxels: ", roi_size)
+    elif roi_mask_input is True and tile_size is None:
+        # Reads the ROI mask first, then only the parts of the datasets inside it
+        tn, fp, fn, tp, unlabeled, roi_size, slice_profile = roi_cropped_confusion_counts(
+            pos_label, ground_truth_folder_path, predicted_folder_path, roi_mask_folder_path, cache_dir, profile)
         print("ROI voxels: ", roi_size)
-
-        if np.size(ground_truth) != np.size(roi_mask):
-            raise ValueError("Mask dimensions don't match the datasets")
-
-        roi_mask_flat = normalized_roi_mask.flatten() == 1
-
-        # Only convert the 1 indexes to the flat form for comparison
-        ground_truth_flat = ground_truth.flatten()[roi_mask_flat]
-        predicted_flat = predicted.flatten()[roi_mask_flat]
+    elif tile_size is None:
+        # Decodes the datasets straight into packed masks holding one bit per voxel
+        with stage("decode") as decode_stage:
+            sources = [dataset_source(path, cache_dir) for path in (ground_truth_folder_path, predicted_folder_path)]
+            try:
+                if sources[1].shape != sources[0].shape:
+                    raise ValueError("Datasets are not the same size")
+
+                ground_truth_positive, ground_truth_labeled = pack_labels(sources[0], pos_label)
+                predicted_positive, predicted_labeled = pack_labels(sources[1], pos_label)
+                decode_stage.add(slices=len(sources[0]), nbytes=sources[0].nbytes + sources[1].nbytes)
+            finally:
+                close_sources(*sources)
+
+        # Calculate the values of the confusion matrix a word of 64 voxels at a time
+        with stage("count") as count_stage:
+            slice_profile = np.stack(packed_confusion_counts(ground_truth_positive, predicted_positive,
+                                                             ground_truth_labeled, predicted_labeled, per_slice=True),
+                                     axis=-1)
+            tn, fp, fn, tp, unlabeled = slice_profile.sum(axis=0)
+            count_stage.add(slices=len(slice_profile), nbytes=ground_truth_positive.nbytes + predicted_positive.nbytes)
     else:
-        # If there is no mask, flatten the entire dataset
-        ground_truth_flat = ground_truth.flatten()
-        predicted_flat = predicted.flatten()
+        # Converts image stacks to image volumes for the tile profile
+        with stage("decode") as decode_stage:
+            ground_truth = image_stacker(ground_truth_folder_path, cache_dir=cache_dir)
+            predicted = image_stacker(predicted_folder_path, cache_dir=cache_dir)
+            decode_stage.add(slices=np.shape(ground_truth)[2], nbytes=ground_truth.nbytes + predicted.nbytes)
+
+        if np.shape(ground_truth) != np.shape(predicted):
+            raise ValueError("Datasets are not the same size")
+
+        if roi_mask_input is True:
+            with stage("decode_roi") as decode_stage:
+                roi_mask = image_stacker(roi_mask_folder_path, cache_dir=cache_dir)
+                decode_stage.add(slices=np.shape(roi_mask)[2], nbytes=roi_mask.nbytes)
+            if np.size(ground_truth) != np.size(roi_mask):
+                raise ValueError("Mask dimensions don't match the datasets")
+
+            # Only the pos_label voxels of the mask are counted in the comparison
+            roi_voxels = np.reshape(roi_mask == pos_label, np.shape(ground_truth))
+            roi_size = np.count_nonzero(roi_voxels)
+            print("ROI voxels: ", roi_size)
+        else:
+            # If there is no mask, the entire dataset is counted
+            roi_voxels = None
 
-    # Calculate the values of the confusion matrix
-    confusion_img_matrix = confusion_matrix(ground_truth_flat, predicted_flat, labels=[0, pos_label])
-    tn, fp, fn, tp = confusion_img_matrix.ravel()
+        # Calculate the values of the confusion matrix
+        with stage("count") as count_stage:
+            slice_profile = np.stack(binary_confusion_counts(ground_truth, predicted, pos_label, roi_voxels, True,
+                                                             tile_size), axis=-1)
+            tn, fp, fn, tp, unlabeled = slice_profile.reshape(-1, 5).sum(axis=0)
+            count_stage.add(slices=np.shape(ground_truth)[2], nbytes=ground_truth.nbytes + predicted.nbytes)
 
-    # Calculates the precision from the true and false positive values for use in the f1 score calculation
-    precision = tp / (tp + fp)
+    if unlabeled:
+        print(f"Warning: {unlabeled} voxels are neither 0 nor {pos_label} and were left out of the confusion matrix.")
 
-    # Calculates the recall values for use in the f1 score calculation
-    recall = tp / (tp + fn)
-
-    # Calculate the F1-score from the precision and recall values to provide a hollistic comparison
-    f1 = 2 * (precision * recall) / (precision + recall)
-
-    # Calculate pixel error
-    pixel_error = (fn + fp) / (tp + fn + fp + tn)
+    tp, fn, fp, tn, precision, recall, f1, pixel_error = confusion_stats(tn, fp, fn, tp)
 
     if print_labels:
         print("\nTrue positive (TP):", tp)
@@ -145,20 +594,61 @@ def confusion_matrix_statistics(pos_label, roi_mask_input, print_labels, ground_
     stat_bloc = [tp, fn, fp, tn, precision, recall, f1, pixel_error]
     stat_bloc = np.transpose(stat_bloc)
 
+    if profile:
+        return stat_bloc, slice_profile
+
     return stat_bloc
 
-def main():
+def main(argv=None):
     """
-    Leave the following folder paths equal to none the first time and then once you've selected the desired folders,
-    they will be printed for you to copy into the ground truth and ROI mask variables so you only need to browse for the
-    next predicted folder each time. See the functions themselves for further documentation.
+    Command line entry point, run with python -m Source.Tools.confusion_matrix_stats_calculator --help for the options.
+    Any dataset folder left out is browsed for, so running it without arguments works as before on a desktop. To score
+    many predicted folders at once, use batch_evaluation instead. See the functions themselves for further
+    documentation.
+    :param argv: Optional list of the command line arguments, None for sys.argv
     """
-    ground_truth_folder = None
-    predicted_folder = None  # Leave as None if you wish to be prompted to browse for the folder each time
-    ROI_mask_folder = None
-
-    confusion_matrix_statistics(255, True, False, ground_truth_folder, predicted_folder,
-                                ROI_mask_folder)
+    parser = argparse.ArgumentParser(description="Calculate the confusion matrix statistics of a predicted image "
+                                                 "stack against its ground truth.")
+    parser.add_argument("ground_truth", nargs="?", default=None,
+                        help="ground truth image stack folder or volume file, browsed for if unset")
+    parser.add_argument("predicted", nargs="?", default=None,
+                        help="predicted image stack folder or volume file, browsed for if unset")
+    parser.add_argument("--roi", default=None, help="ROI mask image stack folder or volume file")
+    parser.add_argument("--browse-roi", action="store_true", help="browse for the ROI mask folder")
+    parser.add_argument("--index", default=None,
+                        help="dataset index file, so each dataset can be given as a query matching one indexed folder")
+    parser.add_argument("--pos-label", type=int, default=255, help="greyscale value considered positive")
+    parser.add_argument("--slab-size", type=int, default=None,
+                        help="stream the datasets this many slices at a time instead of loading the full volumes")
+    parser.add_argument("--cache-dir", default=None, help="volume cache folder to keep the decoded datasets in")
+    parser.add_argument("--result-cache", default=None,
+                        help="result cache folder keeping the counts of every slice so reruns only count changed slices")
+    parser.add_argument("--instrument", default=None,
+                        help="write a JSON report of each stage's time, throughput and memory to this file")
+    parser.add_argument("--profile-dir", default=None, help="with --instrument, write a cProfile dump of each stage")
+    parser.add_argument("--output", default=None, help=".csv or .json file to write the statistics to, stdout if unset")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default=None,
+                        help="format of the statistics, by default the output file's extension or JSON on stdout")
+    args = parser.parse_args(argv)
+
+    if args.instrument is not None:
+        configure(args.instrument, args.profile_dir)
+
+    # The printed statistics go to stderr so the table on stdout can be piped
+    with contextlib.redirect_stdout(sys.stderr):
+        if args.index is not None:
+            from Source.Tools.dataset_index import resolve_dataset_argument
+
+            arguments = (args.ground_truth, args.predicted, args.roi)
+            args.ground_truth, args.predicted, args.roi = [resolve_dataset_argument(argument, args.index)
+                                                           for argument in arguments]
+
+        stat_bloc = confusion_matrix_statistics(args.pos_label, args.roi is not None or args.browse_roi, True,
+                                                args.ground_truth, args.predicted, args.roi, args.slab_size,
+                                                args.cache_dir, result_cache_dir=args.result_cache)
+
+    row = {column: stat.item() for column, stat in zip(STAT_BLOC_COLUMNS, stat_bloc)}
+    write_records([row], STAT_BLOC_COLUMNS, args.output, args.format)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,68 @@
+import csv
+import json
+import sys
+
+# Formats the command line entry points can write their results in
+OUTPUT_FORMATS = ("json", "csv")
+
+
+def ask_directory(title):
+    """
+    Opens a folder browser dialog. tkinter is only imported here so the tools can run on machines without a display
+    whenever every path is passed in.
+    :param title: Title of the dialog
+    :return: The selected folder path, or an empty string if the dialog was cancelled
+    """
+    import tkinter as tk
+    from tkinter import filedialog
+
+    root = tk.Tk()
+    root.withdraw()  # Hide the root window
+
+    try:
+        return filedialog.askdirectory(title=title)
+    finally:
+        root.destroy()
+
+
+def output_format_for(output_path, output_format=None):
+    """
+    :param output_path: Optional path to the output file, its extension sets the format when none is given
+    :param output_format: Optional "json" or "csv"
+    :return: "json" or "csv"
+    """
+    if output_format is None:
+        if output_path is None or output_path.lower().endswith(".json"):
+            return "json"
+        if output_path.lower().endswith(".csv"):
+            return "csv"
+        raise ValueError(f"Output file '{output_path}' must be a .csv or .json file")
+
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Output format must be one of {OUTPUT_FORMATS}")
+
+    return output_format
+
+
+def write_records(rows, fieldnames, output_path=None, output_format=None):
+    """
+    Writes a table of results as JSON or CSV to a file or to stdout.
+    :param rows: List of dictionaries with the fieldnames keys
+    :param fieldnames: Column names in the order they are written to CSV
+    :param output_path: Optional path to the output file, None for stdout
+    :param output_format: Optional "json" or "csv", by default the output file's extension or JSON for stdout
+    """
+    output_format = output_format_for(output_path, output_format)
+    output_file = sys.stdout if output_path is None else open(output_path, "w", newline="")
+
+    try:
+        if output_format == "json":
+            json.dump(rows, output_file, indent=2)
+            output_file.write("\n")
+        else:
+            writer = csv.DictWriter(output_file, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(rows)
+    finally:
+        if output_path is not None:
+            output_file.close()
@@ -0,0 +1,282 @@
+import argparse
+import json
+import os
+import sqlite3
+import sys
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import numpy as np
+from PIL import Image, ImageMode
+
+from Source.Tools.console import OUTPUT_FORMATS, write_records
+from Source.Tools.image_io import default_workers
+from Source.Tools.training_data_selector import IMAGE_EXTENSIONS
+
+INDEX_VERSION = 1
+
+# Columns of the rows returned by find_datasets
+DATASET_COLUMNS = ("path", "name", "slice_count", "extensions", "shape", "dtype", "total_size")
+
+# Characters that make a query a glob pattern on the whole path rather than a phrase in the folder name
+GLOB_CHARACTERS = "*?["
+
+
+def open_index(index_path):
+    """
+    Opens a dataset index database, creating it if it doesn't exist. An index made by another version is emptied so it
+    is rebuilt on the next refresh.
+    :param index_path: Path to the index file
+    :return: sqlite3 connection to the index
+    """
+    connection = sqlite3.connect(index_path)
+
+    if connection.execute("PRAGMA user_version").fetchone()[0] != INDEX_VERSION:
+        connection.execute("DROP TABLE IF EXISTS directories")
+        connection.execute(f"PRAGMA user_version = {INDEX_VERSION}")
+
+    connection.execute("CREATE TABLE IF NOT EXISTS directories (path TEXT PRIMARY KEY, parent TEXT, name TEXT, "
+                       "mtime_ns INTEGER, slice_count INTEGER, extensions TEXT, shape TEXT, dtype TEXT, "
+                       "total_size INTEGER)")
+    connection.execute("CREATE INDEX IF NOT EXISTS directories_parent ON directories (parent)")
+    connection.commit()
+
+    return connection
+
+
+def subtree_condition(root_path):
+    """
+    Selects a folder and everything under it by comparing path prefixes exactly, since LIKE patterns would treat _ and
+    % in folder names as wildcards and match letters regardless of case.
+    :param root_path: Absolute path to the folder
+    :return: SQL condition on the path column and its parameters
+    """
+    prefix = root_path.rstrip(os.sep) + os.sep
+    return "(path = ? OR substr(path, 1, ?) = ?)", [root_path, len(prefix), prefix]
+
+
+def image_header(file_path):
+    """
+    Reads the shape and data type of an image from its header without decoding it.
+    :param file_path: Path to the image
+    :return: (rows, columns) or (rows, columns, bands) shape list, and the numpy data type name
+    """
+    with Image.open(file_path) as img:
+        mode = ImageMode.getmode(img.mode)
+        shape = [img.size[1], img.size[0]] + ([len(mode.bands)] if len(mode.bands) > 1 else [])
+        return shape, np.dtype(mode.typestr).name
+
+
+def scan_directory(path, known_mtime_ns=None, extensions=IMAGE_EXTENSIONS):
+    """
+    Lists one directory of the archive for the index. A directory whose modification time hasn't changed since it was
+    indexed has the same entries, so only its modification time is read.
+    :param path: Path to the directory
+    :param known_mtime_ns: Modification time the directory was indexed at, None if it is new
+    :param extensions: Extensions of the image files making a directory a stack folder
+    :return: The directory's index row, or None if it is unchanged, and the list of its subdirectory paths, or None if
+             it is unchanged
+    """
+    mtime_ns = os.stat(path).st_mtime_ns
+    if mtime_ns == known_mtime_ns:
+        return None, None
+
+    subdirectories = []
+    image_files = []
+
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(entry.path)
+                elif entry.name.lower().endswith(extensions) and entry.is_file():
+                    image_files.append((entry.name, entry.stat().st_size))
+            except OSError:
+                # Entries removed or unreadable while scanning are left out
+                continue
+
+    row = {"path": path, "parent": os.path.dirname(path), "name": os.path.basename(path), "mtime_ns": mtime_ns,
+           "slice_count": len(image_files), "extensions": None, "shape": None, "dtype": None, "total_size": 0}
+
+    if image_files:
+        image_files.sort()
+        extension_counts = {}
+        for name, _ in image_files:
+            extension = os.path.splitext(name)[1].lower()
+            extension_counts[extension] = extension_counts.get(extension, 0) + 1
+
+        row["extensions"] = json.dumps(extension_counts)
+        row["total_size"] = sum(size for _, size in image_files)
+        try:
+            shape, row["dtype"] = image_header(os.path.join(path, image_files[0][0]))
+            row["shape"] = json.dumps(shape)
+        except (OSError, ValueError):
+            print(f"Warning: could not read the image header of {os.path.join(path, image_files[0][0])}")
+
+    return row, subdirectories
+
+
+def refresh_index(index_path, root_path, workers=None):
+    """
+    Builds or incrementally refreshes the index of every stack folder under a root folder. Directories are scanned with
+    os.scandir on a thread pool, which keeps many slow (network) directory reads in flight at once. Directories whose
+    modification time hasn't changed since the last refresh are not listed again and their subdirectories are taken
+    from the index, so a refresh of an unchanged archive only reads each directory's modification time.
+    Files whose contents change without being added, removed or renamed don't change their directory's modification
+    time, so their size and header are only updated once something else in the directory changes.
+    :param index_path: Path to the index file, created if it doesn't exist
+    :param root_path: Path to the archive folder to index
+    :param workers: Number of scanning threads, None for four per core since the threads mostly wait on the file system
+    :return: Dictionary with the number of directories "scanned", "unchanged" and "removed"
+    """
+    root_path = os.path.abspath(root_path)
+    if not os.path.isdir(root_path):
+        raise ValueError(f"Provided path is not a folder: {root_path}")
+
+    connection = open_index(index_path)
+    condition, parameters = subtree_condition(root_path)
+
+    # Modification times and subdirectories of everything indexed under the root before this refresh
+    known_mtimes = {}
+    known_children = {}
+    rows = connection.execute(f"SELECT path, parent, mtime_ns FROM directories WHERE {condition}", parameters)
+    for path, parent, mtime_ns in rows:
+        known_mtimes[path] = mtime_ns
+        if path != root_path:
+            known_children.setdefault(parent, []).append(path)
+
+    changed_rows = []
+    visited = set()
+    statistics = {"scanned": 0, "unchanged": 0, "removed": 0}
+
+    with ThreadPoolExecutor(max_workers=workers or 4 * default_workers()) as executor:
+        pending = {executor.submit(scan_directory, root_path, known_mtimes.get(root_path)): root_path}
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                path = pending.pop(future)
+                try:
+                    row, subdirectories = future.result()
+                except OSError:
+                    # Directories removed or unreadable since their parent was listed are dropped from the index
+                    continue
+
+                visited.add(path)
+                if row is None:
+                    statistics["unchanged"] += 1
+                    subdirectories = known_children.get(path, [])
+                else:
+                    statistics["scanned"] += 1
+                    changed_rows.append(row)
+
+                for subdirectory in subdirectories:
+                    future = executor.submit(scan_directory, subdirectory, known_mtimes.get(subdirectory))
+                    pending[future] = subdirectory
+
+    removed = [(path,) for path in known_mtimes if path not in visited]
+    statistics["removed"] = len(removed)
+
+    with connection:
+        connection.executemany("DELETE FROM directories WHERE path = ?", removed)
+        connection.executemany("INSERT OR REPLACE INTO directories VALUES (:path, :parent, :name, :mtime_ns, "
+                               ":slice_count, :extensions, :shape, :dtype, :total_size)", changed_rows)
+    connection.close()
+
+    return statistics
+
+
+def find_datasets(index_path, query=None, root_path=None):
+    """
+    Finds every indexed stack folder matching a query, without touching the archive itself.
+    :param index_path: Path to the index file
+    :param query: A phrase contained in the folder name (case-sensitive), or a glob pattern matched against the whole
+                  folder path when it contains any of *?[ (where * also matches across folders). None matches every
+                  stack folder
+    :param root_path: Optional folder to restrict the results to
+    :return: List of dictionaries with the DATASET_COLUMNS keys, sorted by path
+    """
+    if not os.path.isfile(index_path):
+        raise ValueError(f"Dataset index '{index_path}' does not exist, build it with refresh_index first")
+
+    conditions = ["slice_count > 0"]
+    parameters = []
+
+    if query and any(character in query for character in GLOB_CHARACTERS):
+        conditions.append("path GLOB ?")
+        parameters.append(query)
+    elif query:
+        conditions.append("instr(name, ?) > 0")
+        parameters.append(query)
+
+    if root_path is not None:
+        condition, subtree_parameters = subtree_condition(os.path.abspath(root_path))
+        conditions.append(condition)
+        parameters += subtree_parameters
+
+    connection = open_index(index_path)
+    try:
+        rows = connection.execute(f"SELECT {', '.join(DATASET_COLUMNS)} FROM directories "
+                                  f"WHERE {' AND '.join(conditions)} ORDER BY path", parameters).fetchall()
+    finally:
+        connection.close()
+
+    datasets = []
+    for row in rows:
+        dataset = dict(zip(DATASET_COLUMNS, row))
+        dataset["extensions"] = json.loads(dataset["extensions"])
+        dataset["shape"] = json.loads(dataset["shape"]) if dataset["shape"] is not None else None
+        datasets.append(dataset)
+
+    return datasets
+
+
+def resolve_dataset_argument(argument, index_path=None):
+    """
+    Lets a command line tool take an index query wherever it takes a dataset path. Existing paths are used as they
+    are, anything else is looked up in the index and must match exactly one stack folder.
+    :param argument: Dataset path or index query, or None
+    :param index_path: Optional path to the index file, None to only accept paths
+    :return: The dataset path
+    """
+    if argument is None or index_path is None or os.path.exists(argument):
+        return argument
+
+    matches = find_datasets(index_path, argument)
+    if len(matches) != 1:
+        listed = "".join(f"\n  {match['path']}" for match in matches[:20])
+        raise ValueError(f"Index query '{argument}' matches {len(matches)} datasets instead of one{listed}")
+
+    print(f"Index query '{argument}' resolved to {matches[0]['path']}")
+    return matches[0]["path"]
+
+
+def main(argv=None):
+    """
+    Command line entry point, run with python -m Source.Tools.dataset_index --help for the options.
+    :param argv: Optional list of the command line arguments, None for sys.argv
+    """
+    parser = argparse.ArgumentParser(description="Build, refresh and query a persistent index of image stack folders.")
+    parser.add_argument("index", help="index file")
+    parser.add_argument("--refresh", default=None, metavar="ROOT",
+                        help="index or refresh every stack folder under ROOT")
+    parser.add_argument("--workers", type=int, default=None, help="scanning threads, four per core if unset")
+    parser.add_argument("--query", default=None,
+                        help="phrase in the folder name, or glob pattern on the whole path, of the stack folders "
+                             "to list")
+    parser.add_argument("--output", default=None, help=".csv or .json file to write the matches to, stdout if unset")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default=None,
+                        help="format of the matches, by default the output file's extension or JSON on stdout")
+    args = parser.parse_args(argv)
+
+    if args.refresh is not None:
+        statistics = refresh_index(args.index, args.refresh, args.workers)
+        print(f"Scanned {statistics['scanned']} directories, {statistics['unchanged']} unchanged, "
+              f"{statistics['removed']} removed", file=sys.stderr)
+
+    if args.query is not None or args.refresh is None:
+        write_records(find_datasets(args.index, args.query), DATASET_COLUMNS, args.output, args.format)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+import os
+import tempfile
+
+import numpy as np
+from tqdm import tqdm
+
+from Source.Tools.training_data_selector import dataset_file_paths, map_dataset
+from Source.Tools.volume_sources import close_sources
+
+# Default size of the slice embedding, of the mini-batches it is fitted on and of the pooling of the slices
+DEFAULT_COMPONENTS = 16
+DEFAULT_BATCH_SIZE = 64
+DEFAULT_DOWNSAMPLE_FACTOR = 4
+
+
+def slice_embedding(file_paths, n_components=DEFAULT_COMPONENTS, downsample_factor=DEFAULT_DOWNSAMPLE_FACTOR,
+                    batch_size=DEFAULT_BATCH_SIZE, workers=None, cache_dir=None, scratch_dir=None):
+    """
+    Embeds every slice of a dataset in a low-dimensional space with an incremental PCA fitted one mini-batch of
+    downsampled slices at a time. The downsampled slices are kept in a memory-mapped scratch volume between the fitting
+    and projecting passes, so each slice is decoded once and memory stays bounded by the batch size.
+    :param file_paths: list of file paths to each image, or a VolumeSource from dataset_file_paths
+    :param n_components: number of principal components of the embedding
+    :param downsample_factor: integer factor the images are mean pooled by before fitting
+    :param batch_size: number of slices per mini-batch, at least n_components
+    :param workers: number of decoding threads, None for one per core
+    :param cache_dir: optional path to a volume cache folder to read the images from a memory-mapped cached volume
+    :param scratch_dir: folder for the temporary scratch volume, None for the system's temporary folder
+    :return: (slices, components) array of the embedding of each slice
+    """
+    from sklearn.decomposition import IncrementalPCA
+
+    number_of_images = len(file_paths)
+
+    # Every mini-batch, the last one included, needs at least as many slices as components
+    n_components = min(n_components, number_of_images)
+    batch_size = max(batch_size, n_components)
+    batch_bounds = np.linspace(0, number_of_images, max(1, number_of_images // batch_size) + 1).astype(int)
+
+    pca = None
+
+    with tempfile.TemporaryDirectory(dir=scratch_dir) as scratch_folder:
+        scratch_volume = None
+        batch_end = iter(batch_bounds[1:])
+        next_batch_end = next(batch_end)
+        batch_start = 0
+
+        image_arrays = map_dataset(lambda image_array: image_array.astype(np.float32).ravel(), file_paths, workers,
+                                   cache_dir=cache_dir, downsample_factor=downsample_factor)
+
+        for i, image_array in tqdm(enumerate(image_arrays),
+                                   total=number_of_images,
+                                   desc="Fitting Slice Embedding",
+                                   unit="Image"):
+
+            # The first image sets the size of the scratch volume and caps the components at its number of pixels
+            if scratch_volume is None:
+                n_components = min(n_components, image_array.size)
+                pca = IncrementalPCA(n_components=n_components)
+                scratch_volume = np.lib.format.open_memmap(os.path.join(scratch_folder, "scratch.npy"), mode="w+",
+                                                           dtype=np.float32,
+                                                           shape=(number_of_images, image_array.size))
+
+            if image_array.size != scratch_volume.shape[1]:
+                raise ValueError(f"Image {i} does not match the size of the first image")
+
+            scratch_volume[i] = image_array
+
+            if i + 1 == next_batch_end:
+                pca.partial_fit(scratch_volume[batch_start:next_batch_end])
+                batch_start, next_batch_end = next_batch_end, next(batch_end, None)
+
+        embedding = np.empty((number_of_images, n_components))
+        for start, stop in zip(batch_bounds[:-1], batch_bounds[1:]):
+            embedding[start:stop] = pca.transform(scratch_volume[start:stop])
+
+        del scratch_volume
+
+    return embedding
+
+
+def farthest_point_sampling(embedding, number_of_points):
+    """
+    Greedily picks points that are as far as possible from every point picked before them, starting from the point
+    closest to the centre of the embedding so the first pick is the most representative slice.
+    :param embedding: (points, dimensions) array
+    :param number_of_points: number of points to pick, at most the number of points in the embedding
+    :return: integer array of the picked point indices, in the order they were picked
+    """
+    number_of_points = min(number_of_points, len(embedding))
+    if number_of_points < 1:
+        return np.array([], dtype=np.intp)
+
+    picked = [int(np.argmin(np.sum((embedding - embedding.mean(axis=0)) ** 2, axis=1)))]
+
+    # Squared distance from each point to its nearest picked point, updated with each new pick
+    nearest_distance = np.sum((embedding - embedding[picked[0]]) ** 2, axis=1)
+
+    for _ in range(number_of_points - 1):
+        picked.append(int(np.argmax(nearest_distance)))
+        np.minimum(nearest_distance, np.sum((embedding - embedding[picked[-1]]) ** 2, axis=1), out=nearest_distance)
+
+    return np.array(picked, dtype=np.intp)
+
+
+def diverse_training_slices(dataset_path, desired_number_of_slices, idx_offset=0, n_components=DEFAULT_COMPONENTS,
+                            downsample_factor=None, batch_size=DEFAULT_BATCH_SIZE, workers=None, cache_dir=None,
+                            scratch_dir=None):
+    """
+    Selects training slices that differ from each other, by farthest-point sampling of a PCA embedding of the slices.
+    Unlike the extrema of the difference to the average image, this also separates slices that are different from each
+    other but equally far from the average.
+    :param dataset_path: the path to the image stack dataset folder, or to a multi-page TIFF or raw volume file
+    :param desired_number_of_slices: how many image slices you want to identify for use as training data
+    :param idx_offset: the index your dataset begins numbering at
+    :param n_components: number of principal components of the embedding
+    :param downsample_factor: integer factor the images are mean pooled by before fitting, None for
+                              DEFAULT_DOWNSAMPLE_FACTOR
+    :param batch_size: number of slices per mini-batch
+    :param workers: number of decoding threads, None for one per core
+    :param cache_dir: optional path to a volume cache folder to read the images from a memory-mapped cached volume
+    :param scratch_dir: folder for the temporary scratch volume, None for the system's temporary folder
+    :return: sorted slice numbers of the selected slices, and the distance of each slice's embedding from the centre
+    """
+    if downsample_factor is None:
+        downsample_factor = DEFAULT_DOWNSAMPLE_FACTOR
+
+    file_paths = dataset_file_paths(dataset_path)
+    embedding = slice_embedding(file_paths, n_components, downsample_factor, batch_size, workers, cache_dir,
+                                scratch_dir)
+    close_sources(file_paths)
+
+    picked = farthest_point_sampling(embedding, desired_number_of_slices)
+    centre_distance = np.sqrt(np.sum((embedding - embedding.mean(axis=0)) ** 2, axis=1))
+
+    return np.sort(picked) + idx_offset, centre_distance
@@ -0,0 +1,233 @@
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+
+def default_workers():
+    """
+    :return: The number of decoding threads used when none is specified, one per available core
+    """
+    return os.cpu_count() or 1
+
+
+def read_image(file_path, dtype=None):
+    """
+    Opens an image and converts it to an array of its intensity values.
+    :param file_path: Path to the image
+    :param dtype: Optional data type to convert the intensity values to, None keeps the image's own type
+    :return: 2D array of the image (3D for multichannel images)
+    """
+    with Image.open(file_path) as img:
+        return np.array(img, dtype=dtype)
+
+
+def read_image_region(file_path, rows, columns, dtype=None):
+    """
+    Decodes the part of an image inside a box. Only uncompressed TIFFs stored in several strips or tiles, which Pillow
+    keeps as separate pieces, skip the pieces that don't overlap the box. Compressed TIFFs (decoded whole by libtiff),
+    single-strip TIFFs such as those Pillow writes, and other formats are decoded whole and cropped, so for image
+    folders the saving mostly comes from skipping slices whose ROI is empty.
+    :param file_path: Path to the image
+    :param rows: (first row, last row + 1) of the box
+    :param columns: (first column, last column + 1) of the box
+    :param dtype: Optional data type to convert the intensity values to, None keeps the image's own type
+    :return: 2D array of the box (3D for multichannel images)
+    """
+    with Image.open(file_path) as img:
+        # Pieces without extents can't be placed, so they are always kept
+        img.tile = [tile for tile in img.tile
+                    if tile[1] is None or (tile[1][1] < rows[1] and tile[1][3] > rows[0] and
+                                           tile[1][0] < columns[1] and tile[1][2] > columns[0])]
+
+        return np.array(img.crop((columns[0], rows[0], columns[1], rows[1])), dtype=dtype)
+
+
+class Prefetch:
+    """
+    Read-ahead depth and wait statistics of a prefetching pipeline (see map_ordered). Passing the same Prefetch to
+    several pipelines adds up their statistics, so a whole run can be checked for being I/O or compute bound.
+    """
+
+    def __init__(self, read_ahead=None):
+        """
+        :param read_ahead: Number of items decoded ahead of the consumer, None for two per worker thread. Larger values
+                           hide slower or more variable reads (such as NFS) at the cost of holding more decoded images
+        """
+        if read_ahead is not None and (isinstance(read_ahead, bool) or not isinstance(read_ahead, int) or
+                                       read_ahead < 1):
+            raise ValueError("Read-ahead depth must be a positive integer")
+
+        self.read_ahead = read_ahead
+        self.items = 0
+        self.stalls = 0
+        self.wait_seconds = 0.0
+        self.elapsed_seconds = 0.0
+
+    def depth(self, workers):
+        """
+        :param workers: Number of worker threads of the pipeline
+        :return: The number of items to keep in flight ahead of the consumer
+        """
+        return self.read_ahead or 2 * workers
+
+    def summary(self):
+        """
+        :return: One line description of how long the consumers waited on reads
+        """
+        wait_share = self.wait_seconds / self.elapsed_seconds if self.elapsed_seconds else 0.0
+        return (f"Waited {self.wait_seconds:.2f} s on reads ({wait_share:.0%} of {self.elapsed_seconds:.2f} s), "
+                f"{self.stalls} of {self.items} items were not ready when needed")
+
+
+def map_ordered(function, items, workers=None, prefetch=None):
+    """
+    Applies a function to each item on a thread pool, yielding the results in the order of the items. Only a bounded
+    number of items are processed ahead of the consumer, which blocks the producer until the consumer catches up, so
+    memory stays bounded while reads overlap the consumer's computation.
+    :param function: Function applied to each item in a worker thread
+    :param items: Iterable of the function's arguments
+    :param workers: Number of threads, None for one per core
+    :param prefetch: Optional Prefetch setting the read-ahead depth and recording how long the consumer waited
+    :return: Generator of the function results in item order
+    """
+    workers = workers or default_workers()
+    prefetch = prefetch or Prefetch()
+    read_ahead = prefetch.depth(workers)
+
+    def next_result(future):
+        # Time spent blocked here is time the consumer could not compute because the read wasn't finished
+        if not future.done():
+            wait_start = time.perf_counter()
+            result = future.result()
+            prefetch.wait_seconds += time.perf_counter() - wait_start
+            prefetch.stalls += 1
+        else:
+            result = future.result()
+
+        prefetch.items += 1
+        return result
+
+    started = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        try:
+            for item in items:
+                pending.append(executor.submit(function, item))
+
+                # Keeps read_ahead items in flight, waiting on the oldest before submitting more
+                if len(pending) > read_ahead:
+                    yield next_result(pending.popleft())
+
+            while pending:
+                yield next_result(pending.popleft())
+        finally:
+            for future in pending:
+                future.cancel()
+            prefetch.elapsed_seconds += time.perf_counter() - started
+
+
+def map_images(function, file_paths, workers=None, dtype=None, prefetch=None):
+    """
+    Decodes images on a thread pool and applies a function to each of them, yielding the results in the order of the
+    file paths. Only a bounded number of images are decoded ahead of the consumer so memory stays bounded.
+    :param function: Function applied to each decoded image array in the worker thread
+    :param file_paths: List of paths to the images
+    :param workers: Number of decoding threads, None for one per core
+    :param dtype: Optional data type to convert the intensity values to
+    :param prefetch: Optional Prefetch setting the read-ahead depth and recording how long the consumer waited
+    :return: Generator of the function results in file path order
+    """
+    return map_ordered(lambda file_path: function(read_image(file_path, dtype)), file_paths, workers, prefetch)
+
+
+def iter_images(file_paths, workers=None, dtype=None, prefetch=None):
+    """
+    Decodes images on a thread pool, yielding the arrays in the order of the file paths.
+    :param file_paths: List of paths to the images
+    :param workers: Number of decoding threads, None for one per core
+    :param dtype: Optional data type to convert the intensity values to
+    :param prefetch: Optional Prefetch setting the read-ahead depth and recording how long the consumer waited
+    :return: Generator of image arrays
+    """
+    return map_images(lambda image_array: image_array, file_paths, workers, dtype, prefetch)
+
+
+def decode_into(file_paths, volume, z_axis=2, workers=None, prefetch=None):
+    """
+    Decodes images on a thread pool straight into the matching slices of a preallocated volume.
+    :param file_paths: List of paths to images of identical size, in stacking order
+    :param volume: Preallocated array (or memmap) with one slice per file along z_axis
+    :param z_axis: The axis of the volume that the images are stacked along
+    :param workers: Number of decoding threads, None for one per core
+    :param prefetch: Optional Prefetch setting how many images are decoded at once and recording the time spent waiting
+    :return: The filled volume
+    """
+    slices = np.moveaxis(volume, z_axis, 0)
+
+    if len(file_paths) != slices.shape[0]:
+        raise ValueError(f"Volume has room for {slices.shape[0]} slices but {len(file_paths)} images were given")
+
+    def decode(index):
+        image_array = read_image(file_paths[index])
+
+        if image_array.shape != slices.shape[1:] or image_array.dtype != volume.dtype:
+            raise ValueError(f"Image {file_paths[index]} does not match the size and type of the volume "
+                             f"({image_array.shape} {image_array.dtype} instead of {slices.shape[1:]} {volume.dtype})")
+        slices[index] = image_array
+
+    # Consuming the results raises any decoding error in the calling thread
+    for _ in map_ordered(decode, range(len(file_paths)), workers, prefetch):
+        pass
+
+    return volume
+
+
+def stack_images(file_paths, z_axis=2, workers=None, prefetch=None):
+    """
+    Stacks a list of images into a 3D array of the intensity values. The first image sets the size and type of the
+    preallocated volume, then the rest are decoded straight into it in parallel.
+    :param file_paths: List of paths to images of identical size, in stacking order
+    :param z_axis: The axis the images are stacked along, 2 for (rows, columns, slices) or 0 for a slice-contiguous
+                   (slices, rows, columns) layout that is faster to read slice by slice
+    :param workers: Number of decoding threads, None for one per core
+    :param prefetch: Optional Prefetch setting the read-ahead depth and recording the time spent waiting on reads
+    :return: Resulting image volume of the stacked images converted to a 3D array
+    """
+    if not file_paths:
+        raise ValueError("No images to stack")
+
+    first_image = read_image(file_paths[0])
+
+    volume_shape = list(first_image.shape)
+    volume_shape.insert(z_axis, len(file_paths))
+    volume = np.empty(volume_shape, dtype=first_image.dtype)
+
+    np.moveaxis(volume, z_axis, 0)[0] = first_image
+    decode_into(file_paths[1:], np.moveaxis(volume, z_axis, 0)[1:], 0, workers, prefetch)
+
+    return volume
+
+
+def block_reduce(image_array, factor):
+    """
+    Downsamples an image by averaging each factor x factor block of pixels. Rows and columns at the edges that don't
+    fill a whole block are left out.
+    :param image_array: 2D array of the image
+    :param factor: Integer downsampling factor, 1 returns the image unchanged
+    :return: 2D float array of the block means, factor times smaller along each axis
+    """
+    if factor == 1:
+        return image_array
+
+    rows, columns = image_array.shape[0] // factor, image_array.shape[1] // factor
+    if rows == 0 or columns == 0:
+        raise ValueError(f"Image of shape {image_array.shape} is smaller than the downsampling factor {factor}")
+
+    blocks = image_array[:rows * factor, :columns * factor].reshape(rows, factor, columns, factor)
+
+    return blocks.mean(axis=(1, 3))
@@ -0,0 +1,206 @@
+import contextlib
+import functools
+import json
+import os
+import sys
+import time
+
+# Environment variables switching the instrumentation on without changing any call, holding the path of the JSON
+# report and of the folder the cProfile dumps of each stage are written to
+REPORT_ENVIRONMENT_VARIABLE = "IMAGE_TOOLS_INSTRUMENT"
+PROFILE_ENVIRONMENT_VARIABLE = "IMAGE_TOOLS_PROFILE_DIR"
+
+# Report and profile paths set by configure, which take precedence over the environment variables
+_settings = {"report_path": None, "profile_dir": None}
+
+# The run being instrumented, None while the instrumentation is off
+_active = {"run": None}
+
+
+class _NullStage:
+    """
+    Stands in for a stage while the instrumentation is off, so an instrumented block costs one function call.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def add(self, slices=0, nbytes=0):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+def configure(report_path=None, profile_dir=None):
+    """
+    Switches the instrumentation on for the runs that follow, as the command line entry points do for --instrument.
+    :param report_path: Path of the JSON report written at the end of each run, None to fall back on the
+                        IMAGE_TOOLS_INSTRUMENT environment variable
+    :param profile_dir: Optional folder to write a cProfile dump of each stage to, None to fall back on the
+                        IMAGE_TOOLS_PROFILE_DIR environment variable
+    """
+    _settings["report_path"] = report_path
+    _settings["profile_dir"] = profile_dir
+
+
+def _io_counters():
+    """
+    :return: Bytes the process has read through read calls (page cache hits included, memory-mapped reads not) and
+             bytes it has read from storage, or None for each where the platform doesn't say
+    """
+    try:
+        with open("/proc/self/io") as io_file:
+            counters = dict(line.split(": ") for line in io_file.read().splitlines())
+        return int(counters["rchar"]), int(counters["read_bytes"])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def peak_memory_mb():
+    """
+    :return: The peak resident memory of the process so far in MB, or None where the platform doesn't say
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024
+
+
+class _Stage:
+    """
+    Times one stage of an instrumented run and adds its record to the run's report.
+    """
+
+    def __init__(self, run, name):
+        self.run = run
+        self.name = name
+        self.slices = 0
+        self.nbytes = 0
+        self.profiler = None
+
+    def add(self, slices=0, nbytes=0):
+        """
+        Counts work done in the stage for its throughput.
+        :param slices: Number of slices processed
+        :param nbytes: Number of bytes of decoded image data processed
+        """
+        self.slices += slices
+        self.nbytes += nbytes
+
+    def __enter__(self):
+        if self.run["profile_dir"] is not None:
+            import cProfile
+
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+        self.io_start = _io_counters()
+        self.cpu_start = time.process_time()
+        self.wall_start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall_seconds = time.perf_counter() - self.wall_start
+        cpu_seconds = time.process_time() - self.cpu_start
+        io_end = _io_counters()
+
+        if self.profiler is not None:
+            self.profiler.disable()
+            os.makedirs(self.run["profile_dir"], exist_ok=True)
+            self.profiler.dump_stats(os.path.join(self.run["profile_dir"], f"{self.run['name']}.{self.name}.prof"))
+
+        bytes_read, storage_bytes_read = [None if end is None else end - start
+                                          for start, end in zip(self.io_start, io_end)]
+
+        # Throughput is measured on the decoded data when the stage counts it, otherwise on what was read
+        throughput_bytes = self.nbytes or bytes_read or 0
+
+        self.run["stages"].append({
+            "stage": self.name,
+            "wall_seconds": wall_seconds,
+            "cpu_seconds": cpu_seconds,
+            "slices": self.slices,
+            "bytes_decoded": self.nbytes,
+            "bytes_read": bytes_read,
+            "storage_bytes_read": storage_bytes_read,
+            "slices_per_second": self.slices / wall_seconds if wall_seconds else None,
+            "gb_per_second": throughput_bytes / 1e9 / wall_seconds if wall_seconds else None,
+            "peak_memory_mb": peak_memory_mb()})
+
+        return False
+
+
+def stage(name):
+    """
+    Instruments a stage of the current run, such as decoding, counting or the extrema search, recording its wall and
+    CPU time, bytes read, throughput and the peak memory at its end. Work done can be added to it for the throughput:
+        with stage("decode") as decode_stage:
+            ...
+            decode_stage.add(slices=len(file_paths), nbytes=volume.nbytes)
+    Outside of an instrumented run it does nothing.
+    :param name: Name of the stage in the report
+    :return: Context manager of the stage
+    """
+    if _active["run"] is None:
+        return _NULL_STAGE
+
+    return _Stage(_active["run"], name)
+
+
+@contextlib.contextmanager
+def run(name):
+    """
+    Instruments a whole run of a tool if the instrumentation is switched on by configure or the IMAGE_TOOLS_INSTRUMENT
+    environment variable, writing the JSON report of its stages once it ends. A run started inside another run adds
+    its stages to the outer run.
+    :param name: Name of the run in the report
+    """
+    report_path = _settings["report_path"] or os.environ.get(REPORT_ENVIRONMENT_VARIABLE)
+
+    if _active["run"] is not None or not report_path:
+        yield
+        return
+
+    _active["run"] = {"name": name, "stages": [],
+                      "profile_dir": _settings["profile_dir"] or os.environ.get(PROFILE_ENVIRONMENT_VARIABLE)}
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        report = {"run": name,
+                  "wall_seconds": time.perf_counter() - wall_start,
+                  "cpu_seconds": time.process_time() - cpu_start,
+                  "peak_memory_mb": peak_memory_mb(),
+                  "stages": _active["run"]["stages"]}
+        _active["run"] = None
+
+        with open(report_path, "w") as report_file:
+            json.dump(report, report_file, indent=2)
+            report_file.write("\n")
+
+
+def instrumented(name):
+    """
+    Decorator instrumenting every call of a function as a run (see run).
+    :param name: Name of the run in the report
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with run(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,201 @@
+import numpy as np
+
+from Source.Tools.confusion_matrix_stats_calculator import confusion_stats, slab_stacker, stack_length
+
+# Names of the per-class statistics returned by multiclass_stats, in order
+MULTICLASS_STAT_COLUMNS = ("tp", "fn", "fp", "tn", "precision", "recall", "f1", "pixel_error", "iou")
+
+
+def label_indices(volume, labels):
+    """
+    Maps each voxel of a label volume to the index of its label, or to len(labels) if its value isn't one of them.
+    8 and 16-bit volumes are mapped with a lookup table, other types with a binary search of the labels.
+    :param volume: Label volume (or slab) of integer class values
+    :param labels: Sequence of the class values, in the order of the confusion matrix rows and columns
+    :return: Integer array of the same shape as the volume holding the label indices
+    """
+    labels = np.asarray(labels)
+    number_of_labels = len(labels)
+
+    if volume.dtype.kind in "ui" and volume.dtype.itemsize <= 2:
+        value_info = np.iinfo(volume.dtype)
+        lookup_table = np.full(int(value_info.max) - int(value_info.min) + 1, number_of_labels, dtype=np.intp)
+
+        for label_index, label in enumerate(labels):
+            if value_info.min <= label <= value_info.max:
+                lookup_table[int(label) - int(value_info.min)] = label_index
+
+        if value_info.min == 0:
+            return lookup_table[volume]
+        return lookup_table[volume.astype(np.intp) - int(value_info.min)]
+
+    label_order = np.argsort(labels)
+    sorted_labels = labels[label_order]
+    positions = np.searchsorted(sorted_labels, volume).clip(0, number_of_labels - 1)
+
+    indices = label_order[positions]
+    indices[sorted_labels[positions] != volume] = number_of_labels
+
+    return indices
+
+
+def multiclass_confusion_counts(ground_truth, predicted, labels, roi_voxels=None):
+    """
+    Counts the full confusion matrix of two label volumes in one pass by encoding each voxel pair as a single combined
+    index and counting the indices with np.bincount.
+    :param ground_truth: Ground truth label volume
+    :param predicted: Predicted label volume of the same shape
+    :param labels: Sequence of the K class values
+    :param roi_voxels: Optional boolean array of the same shape, only the True voxels are counted
+    :return: (K + 1) x (K + 1) array of counts, rows are ground truth and columns are predicted labels, the last row and
+             column count the voxels whose value isn't one of the labels
+    """
+    if len(set(np.asarray(labels).tolist())) != len(labels):
+        raise ValueError("Labels must be unique")
+
+    number_of_bins = len(labels) + 1
+
+    combined_indices = label_indices(ground_truth, labels) * number_of_bins
+    combined_indices += label_indices(predicted, labels)
+
+    if roi_voxels is not None:
+        combined_indices = combined_indices[roi_voxels]
+
+    counts = np.bincount(combined_indices.ravel(), minlength=number_of_bins ** 2)
+
+    return counts.reshape(number_of_bins, number_of_bins).astype(np.int64)
+
+
+def multiclass_stats(confusion_counts):
+    """
+    Calculates per-class and averaged statistics from a K x K confusion matrix, treating each class one-vs-rest.
+    :param confusion_counts: K x K array of counts, rows are ground truth and columns are predicted labels
+    :return: Dictionary of per-class arrays keyed by MULTICLASS_STAT_COLUMNS, plus "macro" (unweighted mean of the
+             per-class precision, recall, F1, pixel error and IoU over the classes where they are defined) and "micro"
+             (the same statistics from the counts summed over all classes) dictionaries
+    """
+    confusion_counts = np.asarray(confusion_counts, dtype=np.int64)
+    total = confusion_counts.sum()
+
+    tp = np.diagonal(confusion_counts).copy()
+    fn = confusion_counts.sum(axis=1) - tp
+    fp = confusion_counts.sum(axis=0) - tp
+    tn = total - tp - fn - fp
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        per_class = dict(zip(MULTICLASS_STAT_COLUMNS[:8], confusion_stats(tn, fp, fn, tp)))
+        per_class["iou"] = tp / (tp + fp + fn)
+
+        micro_tp, micro_fn, micro_fp, micro_tn = tp.sum(), fn.sum(), fp.sum(), tn.sum()
+        micro = dict(zip(MULTICLASS_STAT_COLUMNS[4:8], confusion_stats(micro_tn, micro_fp, micro_fn, micro_tp)[4:]))
+        micro["iou"] = micro_tp / (micro_tp + micro_fp + micro_fn)
+
+    macro = {}
+    for column in MULTICLASS_STAT_COLUMNS[4:]:
+        defined = per_class[column][~np.isnan(per_class[column])]
+        macro[column] = defined.mean() if defined.size else np.nan
+
+    per_class["macro"] = macro
+    per_class["micro"] = micro
+
+    return per_class
+
+
+def streamed_multiclass_confusion_counts(labels, ground_truth_folder_path, predicted_folder_path,
+                                         roi_mask_folder_path=None, roi_label=255, slab_size=16, cache_dir=None):
+    """
+    Builds the multi-class confusion matrix of two label image stacks in one streaming pass over matching slabs.
+    :param labels: Sequence of the K class values
+    :param ground_truth_folder_path: Path to the ground truth label image stack folder
+    :param predicted_folder_path: Path to the predicted label image stack folder
+    :param roi_mask_folder_path: Optional path to the ROI mask image stack folder, None to include the entire dataset
+    :param roi_label: The greyscale value of the voxels inside the ROI mask
+    :param slab_size: The number of slices read from each folder at a time
+    :param cache_dir: Optional path to a volume cache folder to read the slabs from memory-mapped cached volumes
+    :return: (K + 1) x (K + 1) array of counts, see multiclass_confusion_counts
+    """
+    slice_count = stack_length(ground_truth_folder_path)
+
+    if stack_length(predicted_folder_path) != slice_count:
+        raise ValueError("Datasets are not the same size")
+
+    slab_streams = [slab_stacker(ground_truth_folder_path, slab_size, cache_dir=cache_dir),
+                    slab_stacker(predicted_folder_path, slab_size, cache_dir=cache_dir)]
+
+    if roi_mask_folder_path is not None:
+        if stack_length(roi_mask_folder_path) != slice_count:
+            raise ValueError("Mask dimensions don't match the datasets")
+        slab_streams.append(slab_stacker(roi_mask_folder_path, slab_size, cache_dir=cache_dir))
+
+    number_of_bins = len(labels) + 1
+    confusion_totals = np.zeros((number_of_bins, number_of_bins), dtype=np.int64)
+
+    for slabs in zip(*slab_streams):
+        ground_truth, predicted = slabs[0], slabs[1]
+
+        if np.shape(ground_truth) != np.shape(predicted):
+            raise ValueError("Datasets are not the same size")
+
+        roi_voxels = None
+        if roi_mask_folder_path is not None:
+            if np.size(ground_truth) != np.size(slabs[2]):
+                raise ValueError("Mask dimensions don't match the datasets")
+            roi_voxels = np.reshape(slabs[2] == roi_label, np.shape(ground_truth))
+
+        confusion_totals += multiclass_confusion_counts(ground_truth, predicted, labels, roi_voxels)
+
+    return confusion_totals
+
+
+def multiclass_confusion_matrix_statistics(labels, ground_truth_folder_path, predicted_folder_path,
+                                           roi_mask_folder_path=None, roi_label=255, slab_size=16, print_labels=True,
+                                           class_names=None, cache_dir=None):
+    """
+    Compares two multi-class label image stacks, building the full confusion matrix in one streaming pass and printing
+    the per-class precision, recall, F1-score (Dice), IoU and pixel error with their macro and micro averages.
+    :param labels: Sequence of the greyscale values of each class, e.g. (0, 128, 255)
+    :param ground_truth_folder_path: Path to the ground truth label image stack folder
+    :param predicted_folder_path: Path to the predicted label image stack folder
+    :param roi_mask_folder_path: Optional path to the ROI mask image stack folder, None to include the entire dataset
+    :param roi_label: The greyscale value of the voxels inside the ROI mask
+    :param slab_size: The number of slices read from each folder at a time
+    :param print_labels: Boolean value that determines if the printed table has a header and class names or not
+    :param class_names: Optional names of each class for the printed table, e.g. ("matrix", "fiber", "pore")
+    :param cache_dir: Optional path to a volume cache folder to read the datasets from memory-mapped cached volumes
+    :return: Dictionary of statistics from multiclass_stats, plus the K x K "confusion_matrix" and the number of
+             "unlabeled" voxels whose value isn't one of the labels
+    """
+    confusion_totals = streamed_multiclass_confusion_counts(labels, ground_truth_folder_path, predicted_folder_path,
+                                                            roi_mask_folder_path, roi_label, slab_size, cache_dir)
+
+    confusion_counts = confusion_totals[:-1, :-1]
+    unlabeled = confusion_totals.sum() - confusion_counts.sum()
+
+    if unlabeled:
+        print(f"Warning: {unlabeled} voxels are not one of the labels {tuple(labels)} and were left out of the "
+              f"confusion matrix.")
+
+    stats = multiclass_stats(confusion_counts)
+    stats["confusion_matrix"] = confusion_counts
+    stats["unlabeled"] = unlabeled
+
+    if class_names is None:
+        class_names = [str(label) for label in labels]
+
+    rows = [(name, [stats[column][k] for column in MULTICLASS_STAT_COLUMNS]) for k, name in enumerate(class_names)]
+    rows += [(average, [np.nan] * 4 + [stats[average][column] for column in MULTICLASS_STAT_COLUMNS[4:]])
+             for average in ("macro", "micro")]
+
+    if print_labels:
+        print("\nConfusion matrix (rows are ground truth, columns are predicted):")
+        print(confusion_counts)
+        print()
+        print("\t".join(("class",) + MULTICLASS_STAT_COLUMNS))
+        for name, values in rows:
+            print("\t".join([name] + ["" if np.isnan(value) else str(value) for value in values]))
+    else:
+        for name, values in rows:
+            print("\t".join("" if np.isnan(value) else str(value) for value in values))
+        print("\n")
+
+    return stats
@@ -0,0 +1,357 @@
+import argparse
+import contextlib
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from tqdm import tqdm
+
+from Source.Tools.console import OUTPUT_FORMATS, write_records
+from Source.Tools.volume_sources import open_volume_source
+
+# Names of the summary statistics returned by object_detection_statistics, in order
+OBJECT_STAT_COLUMNS = ("ground_truth_objects", "predicted_objects", "object_tp", "object_fn", "object_fp",
+                       "detection_precision", "detection_recall", "detection_f1", "mean_matched_iou")
+
+# Columns of the per-object table returned by object_detection_statistics
+PER_OBJECT_COLUMNS = ("volume", "object", "voxels", "best_iou", "matched")
+
+# Volumes labeled by the worker processes, opened once per process by _open_shared_sources
+_shared_sources = {}
+
+
+def _open_shared_sources(paths, pos_label, connectivity):
+    """
+    Process pool initializer opening the ground truth, predicted and optional ROI mask volumes.
+    """
+    _shared_sources["sources"] = [open_volume_source(path) for path in paths]
+    _shared_sources["pos_label"] = pos_label
+    _shared_sources["connectivity"] = connectivity
+
+
+def _label_slab(start, stop):
+    """
+    Labels the connected components of the ground truth and prediction in one slab, numbering them from 1 within the
+    slab. Components touching the slab's first or last slice are joined to their neighbours afterwards.
+    :param start: Index of the first slice of the slab
+    :param stop: Index after the last slice of the slab
+    :return: For the ground truth and the prediction, the voxel count of each slab label (index 0 unused) and the labels
+             of the first and last slices, then an (n, 3) array of the (ground truth label, predicted label, voxels)
+             overlaps
+    """
+    from scipy.ndimage import generate_binary_structure, label
+
+    sources = _shared_sources["sources"]
+    pos_label = _shared_sources["pos_label"]
+    structure = generate_binary_structure(3, _shared_sources["connectivity"])
+
+    masks = [source.read_slab(start, stop) == pos_label for source in sources[:2]]
+    if masks[0].shape != masks[1].shape:
+        raise ValueError("Datasets are not the same size")
+
+    if len(sources) == 3:
+        roi_voxels = sources[2].read_slab(start, stop) == pos_label
+        if roi_voxels.shape != masks[0].shape:
+            raise ValueError("Mask dimensions don't match the datasets")
+        for mask in masks:
+            mask &= roi_voxels
+
+    labeled_slabs = []
+    for mask in masks:
+        labels, number_of_labels = label(mask, structure=structure)
+        sizes = np.bincount(labels.ravel(), minlength=number_of_labels + 1)
+        labeled_slabs.append((labels, sizes, labels[0].copy(), labels[-1].copy()))
+
+    # Voxels positive in both volumes give the overlap between each pair of objects
+    ground_truth_labels, predicted_labels = labeled_slabs[0][0], labeled_slabs[1][0]
+    both = (ground_truth_labels > 0) & (predicted_labels > 0)
+    pair_keys = ground_truth_labels[both].astype(np.int64) * len(labeled_slabs[1][1]) + predicted_labels[both]
+    pair_keys, pair_counts = np.unique(pair_keys, return_counts=True)
+    overlaps = np.stack((pair_keys // len(labeled_slabs[1][1]), pair_keys % len(labeled_slabs[1][1]), pair_counts),
+                        axis=1)
+
+    return [labeled_slab[1:] for labeled_slab in labeled_slabs], overlaps
+
+
+def seam_label_pairs(last_slice, first_slice, connectivity=1):
+    """
+    Finds the labels that touch across the seam between two slabs.
+    :param last_slice: Global labels of the last slice of the upper slab
+    :param first_slice: Global labels of the first slice of the lower slab
+    :param connectivity: 1 for face neighbours, 2 to add edge neighbours, 3 to add corner neighbours
+    :return: (n, 2) array of the unique pairs of touching labels
+    """
+    from scipy.ndimage import generate_binary_structure
+
+    rows, columns = last_slice.shape
+    pairs = []
+
+    # The last plane of the structure holds the neighbours one slice further along
+    for row_shift, column_shift in np.argwhere(generate_binary_structure(3, connectivity)[2]) - 1:
+        upper = last_slice[max(0, -row_shift):rows - max(0, row_shift),
+                           max(0, -column_shift):columns - max(0, column_shift)]
+        lower = first_slice[max(0, row_shift):rows - max(0, -row_shift),
+                            max(0, column_shift):columns - max(0, -column_shift)]
+        touching = (upper > 0) & (lower > 0)
+        pairs.append(np.stack((upper[touching], lower[touching]), axis=1))
+
+    return np.unique(np.concatenate(pairs), axis=0) if pairs else np.empty((0, 2), dtype=np.int64)
+
+
+def union_find_roots(number_of_labels, pairs):
+    """
+    Merges labels that touch with a union-find forest.
+    :param number_of_labels: Number of labels, numbered from 1 (0 is the background)
+    :param pairs: (n, 2) array of labels belonging to the same object
+    :return: Array mapping each label to the smallest label of its object
+    """
+    parent = np.arange(number_of_labels + 1)
+
+    def find(label_id):
+        while parent[label_id] != label_id:
+            # Path halving keeps the trees shallow
+            parent[label_id] = parent[parent[label_id]]
+            label_id = parent[label_id]
+        return label_id
+
+    for first, second in pairs:
+        first_root, second_root = find(first), find(second)
+        if first_root != second_root:
+            parent[max(first_root, second_root)] = min(first_root, second_root)
+
+    # Points every label straight at its root
+    while True:
+        grandparent = parent[parent]
+        if np.array_equal(grandparent, parent):
+            return parent
+        parent = grandparent
+
+
+def chunked_object_labels(pos_label, ground_truth_folder_path, predicted_folder_path, roi_mask_folder_path=None,
+                          slab_size=64, connectivity=1, workers=None):
+    """
+    Labels the connected components of the ground truth and prediction out of core. Each slab is labeled in a worker
+    process, the slab labels are numbered globally and the components that continue across slab seams are merged with
+    union-find, so memory is bounded by the slab size and the number of objects rather than the volume size.
+    :param pos_label: The greyscale integer value considered to be positive
+    :param ground_truth_folder_path: Path to the ground truth image stack folder or volume file
+    :param predicted_folder_path: Path to the predicted image stack folder or volume file
+    :param roi_mask_folder_path: Optional path to the ROI mask image stack folder or volume file, voxels outside of the
+                                 ROI are treated as negative
+    :param slab_size: Number of slices labeled at a time by each worker
+    :param connectivity: 1 for face neighbours, 2 to add edge neighbours, 3 to add corner neighbours
+    :param workers: Number of worker processes, None for one per core
+    :return: Voxel count of each ground truth object and of each predicted object, and an (n, 3) array of the
+             (ground truth object, predicted object, voxels) overlaps, with objects numbered from 0
+    """
+    if connectivity not in (1, 2, 3):
+        raise ValueError("Connectivity must be 1, 2 or 3")
+
+    paths = [ground_truth_folder_path, predicted_folder_path]
+    if roi_mask_folder_path is not None:
+        paths.append(roi_mask_folder_path)
+
+    # The volumes are only opened here to check their lengths, the worker processes open their own
+    slice_counts = []
+    for path in paths:
+        with open_volume_source(path) as volume_source:
+            slice_counts.append(len(volume_source))
+
+    number_of_slices = slice_counts[0]
+    if slice_counts[1] != number_of_slices:
+        raise ValueError("Datasets are not the same size")
+    if roi_mask_folder_path is not None and slice_counts[2] != number_of_slices:
+        raise ValueError("Mask dimensions don't match the datasets")
+
+    starts = list(range(0, number_of_slices, slab_size))
+
+    # Slab labels are made global by adding the number of labels in the slabs before them
+    offsets = [[0], [0]]
+    sizes = [[np.zeros(1, dtype=np.int64)], [np.zeros(1, dtype=np.int64)]]
+    seams = [[], []]
+    overlaps = []
+    previous_last_slices = [None, None]
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_open_shared_sources,
+                             initargs=(paths, pos_label, connectivity)) as executor:
+        results = executor.map(_label_slab, starts, [start + slab_size for start in starts])
+
+        for slab_volumes, slab_overlaps in tqdm(results, total=len(starts), desc="Labeling Objects", unit="Slab"):
+            for volume, (slab_sizes, first_slice, last_slice) in enumerate(slab_volumes):
+                offset = offsets[volume][-1]
+                first_slice = np.where(first_slice > 0, first_slice + offset, 0)
+                last_slice = np.where(last_slice > 0, last_slice + offset, 0)
+
+                if previous_last_slices[volume] is not None:
+                    seams[volume].append(seam_label_pairs(previous_last_slices[volume], first_slice, connectivity))
+
+                sizes[volume].append(slab_sizes[1:])
+                previous_last_slices[volume] = last_slice
+                offsets[volume].append(offset + len(slab_sizes) - 1)
+
+            slab_overlaps = slab_overlaps + np.array([offsets[0][-2], offsets[1][-2], 0])
+            overlaps.append(slab_overlaps)
+
+    object_sizes = []
+    object_ids = []
+    for volume in (0, 1):
+        number_of_labels = offsets[volume][-1]
+        pairs = np.concatenate(seams[volume]) if seams[volume] else np.empty((0, 2), dtype=np.int64)
+        roots = union_find_roots(number_of_labels, pairs)
+
+        # Objects are numbered from 0 in the order of their first label
+        _, compact_ids = np.unique(roots[1:], return_inverse=True)
+        object_ids.append(compact_ids)
+        object_sizes.append(np.bincount(compact_ids, weights=np.concatenate(sizes[volume])[1:]).astype(np.int64))
+
+    overlaps = np.concatenate(overlaps)
+    if len(overlaps):
+        pair_keys = object_ids[0][overlaps[:, 0] - 1] * len(object_sizes[1]) + object_ids[1][overlaps[:, 1] - 1]
+        pair_keys, inverse = np.unique(pair_keys, return_inverse=True)
+        pair_counts = np.bincount(inverse, weights=overlaps[:, 2]).astype(np.int64)
+        overlaps = np.stack((pair_keys // len(object_sizes[1]), pair_keys % len(object_sizes[1]), pair_counts), axis=1)
+    else:
+        overlaps = np.empty((0, 3), dtype=np.int64)
+
+    return object_sizes[0], object_sizes[1], overlaps
+
+
+def match_objects(ground_truth_sizes, predicted_sizes, overlaps, iou_threshold=0.5):
+    """
+    Matches ground truth and predicted objects one to one, greedily pairing the overlapping objects with the highest
+    intersection over union first.
+    :param ground_truth_sizes: Voxel count of each ground truth object
+    :param predicted_sizes: Voxel count of each predicted object
+    :param overlaps: (n, 3) array of the (ground truth object, predicted object, voxels) overlaps
+    :param iou_threshold: Smallest intersection over union of a matched pair, any overlap counts when 0
+    :return: Array of the predicted object matched to each ground truth object (-1 if none), array of the best
+             intersection over union of each ground truth object and of each predicted object, and the intersection
+             over union of each matched ground truth object (NaN if unmatched)
+    """
+    ground_truth, predicted, intersection = overlaps[:, 0], overlaps[:, 1], overlaps[:, 2]
+    iou = intersection / (ground_truth_sizes[ground_truth] + predicted_sizes[predicted] - intersection)
+
+    ground_truth_best_iou = np.zeros(len(ground_truth_sizes))
+    predicted_best_iou = np.zeros(len(predicted_sizes))
+    np.maximum.at(ground_truth_best_iou, ground_truth, iou)
+    np.maximum.at(predicted_best_iou, predicted, iou)
+
+    matches = np.full(len(ground_truth_sizes), -1)
+    matched_iou = np.full(len(ground_truth_sizes), np.nan)
+    predicted_matched = np.zeros(len(predicted_sizes), dtype=bool)
+
+    for pair in np.argsort(-iou, kind="stable"):
+        if iou[pair] < iou_threshold:
+            break
+        if matches[ground_truth[pair]] < 0 and not predicted_matched[predicted[pair]]:
+            matches[ground_truth[pair]] = predicted[pair]
+            matched_iou[ground_truth[pair]] = iou[pair]
+            predicted_matched[predicted[pair]] = True
+
+    return matches, ground_truth_best_iou, predicted_best_iou, matched_iou
+
+
+def object_detection_statistics(pos_label, ground_truth_folder_path, predicted_folder_path,
+                                roi_mask_folder_path=None, iou_threshold=0.5, slab_size=64, connectivity=1,
+                                workers=None):
+    """
+    Object level counterpart of confusion_matrix_statistics for porosity and defect segmentations, counting how many
+    objects (connected components) were detected rather than how many voxels match. A ground truth object is detected
+    when it is matched to a predicted object with an intersection over union of at least iou_threshold.
+    :param pos_label: The greyscale integer value considered to be positive
+    :param ground_truth_folder_path: Path to the ground truth image stack folder or volume file
+    :param predicted_folder_path: Path to the predicted image stack folder or volume file
+    :param roi_mask_folder_path: Optional path to the ROI mask image stack folder or volume file
+    :param iou_threshold: Smallest intersection over union of a detected object, any overlap counts when 0
+    :param slab_size: Number of slices labeled at a time by each worker
+    :param connectivity: 1 for face neighbours, 2 to add edge neighbours, 3 to add corner neighbours
+    :param workers: Number of worker processes, None for one per core
+    :return: Dictionary of the OBJECT_STAT_COLUMNS statistics, and a list of PER_OBJECT_COLUMNS rows with the size and
+             best intersection over union of every ground truth and predicted object
+    """
+    ground_truth_sizes, predicted_sizes, overlaps = chunked_object_labels(
+        pos_label, ground_truth_folder_path, predicted_folder_path, roi_mask_folder_path, slab_size, connectivity,
+        workers)
+    matches, ground_truth_best_iou, predicted_best_iou, matched_iou = match_objects(
+        ground_truth_sizes, predicted_sizes, overlaps, iou_threshold)
+
+    tp = int(np.count_nonzero(matches >= 0))
+    fn = len(ground_truth_sizes) - tp
+    fp = len(predicted_sizes) - tp
+
+    # Detection scores are left as NaN when there is nothing to detect or nothing was predicted
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = np.float64(tp) / (tp + fp)
+        recall = np.float64(tp) / (tp + fn)
+        f1 = 2 * precision * recall / (precision + recall)
+
+    statistics = {"ground_truth_objects": len(ground_truth_sizes), "predicted_objects": len(predicted_sizes),
+                  "object_tp": tp, "object_fn": fn, "object_fp": fp, "detection_precision": float(precision),
+                  "detection_recall": float(recall), "detection_f1": float(f1),
+                  "mean_matched_iou": float(np.nanmean(matched_iou)) if tp else float("nan")}
+
+    predicted_matched = np.zeros(len(predicted_sizes), dtype=bool)
+    predicted_matched[matches[matches >= 0]] = True
+    per_object = [{"volume": "ground_truth", "object": i, "voxels": int(size), "best_iou": float(best_iou),
+                   "matched": bool(matches[i] >= 0)}
+                  for i, (size, best_iou) in enumerate(zip(ground_truth_sizes, ground_truth_best_iou))]
+    per_object += [{"volume": "predicted", "object": i, "voxels": int(size), "best_iou": float(best_iou),
+                    "matched": bool(predicted_matched[i])}
+                   for i, (size, best_iou) in enumerate(zip(predicted_sizes, predicted_best_iou))]
+
+    return statistics, per_object
+
+
+def print_object_statistics(statistics, per_object):
+    """
+    Prints the object detection statistics and the quartiles of the object sizes and best intersections over union.
+    """
+    for column in OBJECT_STAT_COLUMNS:
+        print(f"{column}: {statistics[column]}")
+
+    for volume in ("ground_truth", "predicted"):
+        rows = [row for row in per_object if row["volume"] == volume]
+        if rows:
+            print(f"\n{volume} object voxels (min, 25%, median, 75%, max):",
+                  np.percentile([row["voxels"] for row in rows], [0, 25, 50, 75, 100]))
+            print(f"{volume} object best IoU (min, 25%, median, 75%, max):",
+                  np.percentile([row["best_iou"] for row in rows], [0, 25, 50, 75, 100]))
+
+
+def main(argv=None):
+    """
+    Command line entry point, run with python -m Source.Tools.object_metrics --help for the options.
+    :param argv: Optional list of the command line arguments, None for sys.argv
+    """
+    parser = argparse.ArgumentParser(description="Calculate object level detection statistics of a predicted image "
+                                                 "stack against its ground truth.")
+    parser.add_argument("ground_truth", help="ground truth image stack folder or volume file")
+    parser.add_argument("predicted", help="predicted image stack folder or volume file")
+    parser.add_argument("--roi", default=None, help="ROI mask image stack folder or volume file")
+    parser.add_argument("--pos-label", type=int, default=255, help="greyscale value considered positive")
+    parser.add_argument("--iou-threshold", type=float, default=0.5,
+                        help="smallest intersection over union of a detected object, 0 counts any overlap")
+    parser.add_argument("--connectivity", type=int, choices=(1, 2, 3), default=1,
+                        help="1 joins voxels sharing a face, 2 also an edge, 3 also a corner")
+    parser.add_argument("--slab-size", type=int, default=64, help="slices labeled at a time by each worker")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, one per core if unset")
+    parser.add_argument("--per-object", default=None, help=".csv or .json file to write every object's size and IoU to")
+    parser.add_argument("--output", default=None, help=".csv or .json file to write the statistics to, stdout if unset")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default=None,
+                        help="format of the statistics, by default the output file's extension or JSON on stdout")
+    args = parser.parse_args(argv)
+
+    # The printed statistics go to stderr so the table on stdout can be piped
+    with contextlib.redirect_stdout(sys.stderr):
+        statistics, per_object = object_detection_statistics(args.pos_label, args.ground_truth, args.predicted,
+                                                             args.roi, args.iou_threshold, args.slab_size,
+                                                             args.connectivity, args.workers)
+        print_object_statistics(statistics, per_object)
+
+    write_records([statistics], OBJECT_STAT_COLUMNS, args.output, args.format)
+    if args.per_object is not None:
+        write_records(per_object, PER_OBJECT_COLUMNS, args.per_object)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+import numpy as np
+
+# Number of 64-bit words of each mask combined at a time when counting, bounding the temporaries to 8 MB each
+COUNT_CHUNK_WORDS = 1 << 20
+
+
+class PackedMask:
+    """
+    Binary volume holding one bit per voxel, 8 times smaller than a uint8 or boolean volume. Each (rows, columns) slice
+    is packed with np.packbits into whole 64-bit words. The bits past the end of a slice are always 0, so the bitwise
+    AND of two masks never counts them.
+    """
+
+    def __init__(self, number_of_slices, slice_shape):
+        """
+        Allocates an empty mask.
+        :param number_of_slices: Number of slices
+        :param slice_shape: (rows, columns) of each slice
+        """
+        self.slice_shape = tuple(slice_shape)
+        self.slice_size = int(np.prod(self.slice_shape))
+        self.words = np.zeros((number_of_slices, -(-self.slice_size // 64)), dtype=np.uint64)
+
+    @property
+    def shape(self):
+        return (len(self.words),) + self.slice_shape
+
+    @property
+    def nbytes(self):
+        return self.words.nbytes
+
+    def __len__(self):
+        return len(self.words)
+
+    def write_bits(self, index, bits):
+        """
+        :param index: Index of the slice
+        :param bits: The slice's voxels packed with np.packbits(voxels, axis=None)
+        """
+        self.words[index].view(np.uint8)[:len(bits)] = bits
+
+    def read(self, index):
+        """
+        :param index: Index of the slice
+        :return: The slice as a (rows, columns) boolean array
+        """
+        bits = np.unpackbits(self.words[index].view(np.uint8), count=self.slice_size)
+        return bits.reshape(self.slice_shape).view(bool)
+
+
+def popcount(words, axis=None):
+    """
+    :param words: Array of packed words
+    :param axis: Optional axis to count along, None counts the whole array
+    :return: The number of set bits, as int64
+    """
+    return np.bitwise_count(words).sum(axis=axis, dtype=np.int64)
+
+
+def label_bits(slice_array, pos_label):
+    """
+    Packs the labels of a slice.
+    :param slice_array: 2D array of the slice
+    :param pos_label: The greyscale integer value considered to be positive
+    :return: The packed bits of the pos_label voxels, and of the voxels that are either 0 or pos_label (None when every
+             voxel is)
+    """
+    positive = slice_array == pos_label
+    labeled = positive | (slice_array == 0)
+
+    return np.packbits(positive, axis=None), None if labeled.all() else np.packbits(labeled, axis=None)
+
+
+def slice_masks(slice_shape, *slice_bits):
+    """
+    Wraps the packed bits of single slices (or of boxes of slices) as one-slice PackedMasks, to count them on their own.
+    :param slice_shape: (rows, columns) of the slice or box
+    :param slice_bits: Packed bits of each slice, as returned by label_bits, or None
+    :return: List with a PackedMask for each of the packed bits, None where they are None
+    """
+    masks = []
+    for bits in slice_bits:
+        if bits is None:
+            masks.append(None)
+            continue
+
+        mask = PackedMask(1, slice_shape)
+        mask.write_bits(0, bits)
+        masks.append(mask)
+
+    return masks
+
+
+def pack_labels(volume_source, pos_label, workers=None, prefetch=None):
+    """
+    Decodes a dataset slice by slice on a thread pool, packing each slice's labels straight into packed masks so the
+    full volume is never held decoded.
+    :param volume_source: VolumeSource of the dataset
+    :param pos_label: The greyscale integer value considered to be positive
+    :param workers: Number of decoding threads, None for one per core
+    :param prefetch: Optional Prefetch setting the read-ahead depth and recording how long the consumer waited
+    :return: PackedMask of the pos_label voxels, and PackedMask of the voxels that are either 0 or pos_label (None when
+             every voxel is, which is the common case for binary segmentations)
+    """
+    positive = PackedMask(len(volume_source), volume_source.slice_shape)
+    labeled = None
+    full_bits = np.packbits(np.ones(positive.slice_size, dtype=bool))
+
+    slice_bits = volume_source.map_slices(lambda slice_array: label_bits(slice_array, pos_label), workers,
+                                          prefetch=prefetch)
+    for index, (positive_bits, labeled_bits) in enumerate(slice_bits):
+        positive.write_bits(index, positive_bits)
+
+        # The labeled mask is only allocated once a slice holds other values, with the earlier slices fully labeled
+        if labeled_bits is not None and labeled is None:
+            labeled = PackedMask(len(volume_source), volume_source.slice_shape)
+            for earlier_index in range(index):
+                labeled.write_bits(earlier_index, full_bits)
+
+        if labeled is not None:
+            labeled.write_bits(index, full_bits if labeled_bits is None else labeled_bits)
+
+    return positive, labeled
+
+
+def packed_confusion_counts(ground_truth_positive, predicted_positive, ground_truth_labeled=None,
+                            predicted_labeled=None, roi=None, per_slice=False):
+    """
+    Counts the binary confusion matrix of packed masks with bitwise AND and popcounts of whole 64-bit words, 64 voxels
+    at a time.
+    :param ground_truth_positive: PackedMask of the ground truth positive voxels
+    :param predicted_positive: PackedMask of the predicted positive voxels
+    :param ground_truth_labeled: Optional PackedMask of the ground truth voxels that are either 0 or pos_label, None
+                                 when every voxel is
+    :param predicted_labeled: The same for the predictions
+    :param roi: Optional PackedMask of the voxels to count, None to count every voxel
+    :param per_slice: Count each slice separately instead of the whole volume
+    :return: tn, fp, fn, tp counts and the number of counted voxels whose values are neither 0 nor pos_label, each an
+             array of shape (slices,) when per_slice is True (the same as binary_confusion_counts)
+    """
+    masks = [mask for mask in (predicted_positive, ground_truth_labeled, predicted_labeled, roi) if mask is not None]
+    if any(mask.shape != ground_truth_positive.shape for mask in masks):
+        raise ValueError("Packed masks are not the same size")
+
+    slice_counts = np.zeros((len(ground_truth_positive), 5), dtype=np.int64)
+    chunk_size = max(1, COUNT_CHUNK_WORDS // ground_truth_positive.words.shape[1])
+
+    for start in range(0, len(ground_truth_positive), chunk_size):
+        chunk = slice(start, start + chunk_size)
+
+        # Voxels are only classified inside the ROI where both datasets hold either 0 or pos_label
+        valid = None
+        for mask in (ground_truth_labeled, predicted_labeled, roi):
+            if mask is None:
+                continue
+            if valid is None:
+                valid = mask.words[chunk].copy()
+            else:
+                valid &= mask.words[chunk]
+
+        counted_voxels = popcount(roi.words[chunk], axis=1) if roi is not None else ground_truth_positive.slice_size
+        labeled_voxels = popcount(valid, axis=1) if valid is not None else counted_voxels
+
+        ground_truth = ground_truth_positive.words[chunk]
+        predicted = predicted_positive.words[chunk]
+        if valid is not None:
+            ground_truth = ground_truth & valid
+            predicted = predicted & valid
+
+        tp = popcount(ground_truth & predicted, axis=1)
+        fn = popcount(ground_truth, axis=1) - tp
+        fp = popcount(predicted, axis=1) - tp
+        tn = labeled_voxels - tp - fn - fp
+
+        slice_counts[chunk] = np.stack(np.broadcast_arrays(tn, fp, fn, tp, counted_voxels - labeled_voxels), axis=-1)
+
+    if per_slice:
+        return tuple(slice_counts.T)
+
+    return tuple(slice_counts.sum(axis=0))
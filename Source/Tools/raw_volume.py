@@ -0,0 +1,259 @@
+import json
+import os
+import re
+
+import numpy as np
+
+# Extensions of raw CT volume files accepted in place of an image stack folder
+RAW_EXTENSIONS = (".scv", ".raw", ".vol")
+
+# Number of leading bytes searched for header fields when the header size isn't known yet
+HEADER_SCAN_BYTES = 4096
+
+# Header field names (lower case, without separators) giving the voxel data type and the header size
+DTYPE_FIELDS = ("dtype", "datatype", "elementtype", "voxeltype")
+HEADER_BYTES_FIELDS = ("headerbytes", "headersize", "headerlength", "dataoffset")
+
+# MetaImage element type names and the matching numpy data types
+MET_ELEMENT_TYPES = {"met_uchar": "uint8", "met_char": "int8", "met_ushort": "uint16", "met_short": "int16",
+                     "met_uint": "uint32", "met_int": "int32", "met_float": "float32", "met_double": "float64"}
+
+# Number of voxels processed at a time by the chunked counting functions
+DEFAULT_CHUNK_VOXELS = 1 << 26
+
+
+def is_raw_volume(path):
+    """
+    :param path: Path to a file or folder
+    :return: True if the path is a raw volume file rather than an image stack folder
+    """
+    return os.path.isfile(path) and os.fspath(path).lower().endswith(RAW_EXTENSIONS)
+
+
+def parse_raw_header(header, data_bytes, itemsize):
+    """
+    Looks for the volume dimensions in a raw file header. The header is read as three leading 32 or 16-bit integers
+    (x, y, z) in either byte order, then as text holding three consecutive integers, and a reading is only accepted if
+    the dimensions account for every byte of voxel data in the file.
+    :param header: The header bytes
+    :param data_bytes: Number of bytes of voxel data following the header
+    :param itemsize: Size of one voxel in bytes
+    :return: (slices, rows, columns) shape, or None if no reading of the header matches the file size
+    """
+    number_of_voxels = data_bytes // itemsize
+    if number_of_voxels * itemsize != data_bytes or number_of_voxels == 0:
+        return None
+
+    for dimension_type in ("<u4", ">u4", "<u2", ">u2"):
+        dimension_bytes = 3 * np.dtype(dimension_type).itemsize
+        if len(header) < dimension_bytes:
+            continue
+
+        x, y, z = np.frombuffer(header[:dimension_bytes], dtype=dimension_type).tolist()
+        if min(x, y, z) > 0 and x * y * z == number_of_voxels:
+            return z, y, x
+
+    numbers = [int(number) for number in re.findall(rb"\d+", header)]
+    for i in range(len(numbers) - 2):
+        x, y, z = numbers[i:i + 3]
+        if min(x, y, z) > 0 and x * y * z == number_of_voxels:
+            return z, y, x
+
+    return None
+
+
+def parse_raw_header_fields(header):
+    """
+    Looks for the voxel data type and header size in the "name = value" or "name: value" text fields of a raw file
+    header, e.g. "dtype=float32 header_bytes=512" or a MetaImage "ElementType = MET_USHORT".
+    :param header: The leading bytes of the file
+    :return: Voxel data type and number of header bytes, each None if the header doesn't give it
+    """
+    dtype = None
+    header_bytes = None
+
+    for name, value in re.findall(rb"([A-Za-z_]\w*)\s*[=:]\s*([<>|]?[\w.]+)", header):
+        name = name.replace(b"_", b"").decode("ascii").lower()
+        value = value.decode("ascii")
+
+        if name in DTYPE_FIELDS and dtype is None:
+            try:
+                dtype = np.dtype(MET_ELEMENT_TYPES.get(value.lower(), value))
+            except TypeError:
+                continue
+        elif name in HEADER_BYTES_FIELDS and header_bytes is None and value.isdigit():
+            header_bytes = int(value)
+
+    return dtype, header_bytes
+
+
+def open_raw_volume(file_path, shape=None, dtype=None, header_bytes=None):
+    """
+    Opens a raw CT volume as a read-only memory-mapped (slices, rows, columns) array without reading it into memory.
+    Settings that aren't given are read from an optional JSON sidecar next to the file (<file name>.json with "shape",
+    "dtype" and "header_bytes" keys), then from the fields of the file header. The data type and header size are never
+    guessed, a file that doesn't give them needs them passed in or a sidecar.
+    :param file_path: Path to the raw volume file
+    :param shape: Optional (slices, rows, columns) shape of the volume
+    :param dtype: Optional voxel data type
+    :param header_bytes: Optional number of header bytes in front of the voxel data
+    :return: Memory-mapped volume, a flat array of every voxel if the shape can't be determined
+    """
+    sidecar_path = os.fspath(file_path) + ".json"
+    if os.path.isfile(sidecar_path):
+        with open(sidecar_path) as sidecar_file:
+            sidecar = json.load(sidecar_file)
+        shape = shape if shape is not None else sidecar.get("shape")
+        dtype = dtype if dtype is not None else sidecar.get("dtype")
+        header_bytes = header_bytes if header_bytes is not None else sidecar.get("header_bytes")
+
+    # Fill in what the caller and sidecar left out from the header fields
+    if dtype is None or header_bytes is None:
+        with open(file_path, "rb") as raw_file:
+            header_dtype, header_size = parse_raw_header_fields(raw_file.read(header_bytes or HEADER_SCAN_BYTES))
+        dtype = dtype if dtype is not None else header_dtype
+        header_bytes = header_bytes if header_bytes is not None else header_size
+
+    missing = [name for name, value in (("dtype", dtype), ("header_bytes", header_bytes)) if value is None]
+    if missing:
+        raise ValueError(f"The {' and '.join(missing)} of '{file_path}' could not be read from its header. Pass "
+                         f"{'them' if len(missing) > 1 else 'it'} or add a {os.path.basename(sidecar_path)} sidecar "
+                         f"with {', '.join(repr(name) for name in missing)} keys.")
+
+    dtype = np.dtype(dtype)
+    header_bytes = int(header_bytes)
+
+    data_bytes = os.path.getsize(file_path) - header_bytes
+    if data_bytes < 0:
+        raise ValueError(f"File '{file_path}' is smaller than its {header_bytes} byte header")
+
+    if shape is None:
+        with open(file_path, "rb") as raw_file:
+            shape = parse_raw_header(raw_file.read(header_bytes), data_bytes, dtype.itemsize)
+
+    if shape is None:
+        print(f"Warning: the dimensions of {file_path} could not be read from its header, it was opened as a flat "
+              f"array. Pass the shape or add a {os.path.basename(sidecar_path)} sidecar to open it as a volume.")
+        shape = (data_bytes // dtype.itemsize,)
+
+    shape = tuple(int(dimension) for dimension in shape)
+    if int(np.prod(shape)) * dtype.itemsize > data_bytes:
+        raise ValueError(f"File '{file_path}' is too small for a {shape} {dtype} volume")
+
+    return np.memmap(file_path, dtype=dtype, mode="r", offset=header_bytes, shape=shape)
+
+
+def open_raw_stack(file_path):
+    """
+    Opens a raw CT volume for use in place of an image stack folder.
+    :param file_path: Path to the raw volume file, its shape, type and header size must be given by its header or sidecar
+    :return: Memory-mapped (slices, rows, columns) volume
+    """
+    volume = open_raw_volume(file_path)
+
+    if volume.ndim != 3:
+        raise ValueError(f"Raw volume '{file_path}' needs a known 3D shape to be used as an image stack")
+
+    return volume
+
+
+def iter_chunks(volume, chunk_voxels=DEFAULT_CHUNK_VOXELS):
+    """
+    Splits a volume into flat chunks so whole-volume operations only hold one chunk in memory at a time.
+    :param volume: Array or memmap of any shape
+    :param chunk_voxels: Number of voxels per chunk
+    :return: Generator of 1D views of the volume
+    """
+    flat_volume = np.ravel(volume)
+
+    for start in range(0, flat_volume.size, chunk_voxels):
+        yield flat_volume[start:start + chunk_voxels]
+
+
+def threshold_counts(volume, threshold, chunk_voxels=DEFAULT_CHUNK_VOXELS):
+    """
+    Counts the voxels above and at or below a threshold, one chunk at a time.
+    :param volume: Array or memmap of any shape
+    :param threshold: Grey value intensity threshold, e.g. separating the background air from the subject of a scan
+    :param chunk_voxels: Number of voxels counted at a time
+    :return: Number of voxels above the threshold, number of voxels at or below it
+    """
+    above = 0
+    total = 0
+
+    for chunk in iter_chunks(volume, chunk_voxels):
+        above += np.count_nonzero(chunk > threshold)
+        total += chunk.size
+
+    return above, total - above
+
+
+def streaming_histogram(volume, bins=256, chunk_voxels=DEFAULT_CHUNK_VOXELS):
+    """
+    Builds the intensity histogram of a volume one chunk at a time. Integer volumes of 16 bits or fewer get an exact
+    histogram with one bin per grey value, other types get evenly spaced bins between their minimum and maximum.
+    :param volume: Array or memmap of any shape
+    :param bins: Number of bins for volumes that aren't 8 or 16-bit integers
+    :param chunk_voxels: Number of voxels counted at a time
+    :return: Histogram counts, and the grey value of each bin (the left bin edge for non-integer volumes)
+    """
+    if volume.dtype.kind == "u" and volume.dtype.itemsize <= 2:
+        histogram = np.zeros(1 << (8 * volume.dtype.itemsize), dtype=np.int64)
+        for chunk in iter_chunks(volume, chunk_voxels):
+            histogram += np.bincount(chunk, minlength=histogram.size)
+        return histogram, np.arange(histogram.size)
+
+    minimum = min(chunk.min() for chunk in iter_chunks(volume, chunk_voxels))
+    maximum = max(chunk.max() for chunk in iter_chunks(volume, chunk_voxels))
+    if maximum == minimum:
+        maximum = minimum + 1
+    bin_edges = np.linspace(minimum, maximum, bins + 1)
+
+    histogram = np.zeros(bins, dtype=np.int64)
+    for chunk in iter_chunks(volume, chunk_voxels):
+        histogram += np.histogram(chunk, bins=bin_edges)[0]
+
+    return histogram, bin_edges[:-1]
+
+
+def otsu_threshold(histogram, values):
+    """
+    Finds the threshold maximizing the between-class variance of a histogram (Otsu's method).
+    :param histogram: Histogram counts
+    :param values: Grey value of each bin
+    :return: Threshold grey value, voxels above it are the foreground class
+    """
+    histogram = np.asarray(histogram, dtype=float)
+    values = np.asarray(values, dtype=float)
+
+    background_weight = np.cumsum(histogram)
+    foreground_weight = background_weight[-1] - background_weight
+    background_sum = np.cumsum(histogram * values)
+    foreground_sum = background_sum[-1] - background_sum
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_difference = background_sum / background_weight - foreground_sum / foreground_weight
+        between_class_variance = background_weight * foreground_weight * mean_difference ** 2
+
+    return values[np.nanargmax(between_class_variance)]
+
+
+def raw_volume_voxel_counts(file_path, threshold=None, shape=None, dtype=None, header_bytes=None):
+    """
+    Counts the voxels of a raw CT volume above and at or below a threshold, finding it with Otsu's method on a
+    streaming histogram if no threshold is given.
+    :param file_path: Path to the raw volume file
+    :param threshold: Optional grey value intensity threshold separating the background air from the subject
+    :param shape: Optional (slices, rows, columns) shape of the volume, see open_raw_volume
+    :param dtype: Optional voxel data type, see open_raw_volume
+    :param header_bytes: Optional number of header bytes, see open_raw_volume
+    :return: threshold, number of voxels above it, number of voxels at or below it
+    """
+    volume = open_raw_volume(file_path, shape, dtype, header_bytes)
+
+    if threshold is None:
+        threshold = otsu_threshold(*streaming_histogram(volume))
+
+    above, at_or_below = threshold_counts(volume, threshold)
+
+    return threshold, above, at_or_below
@@ -0,0 +1,324 @@
+import hashlib
+import json
+import os
+import uuid
+
+import numpy as np
+from tqdm import tqdm
+
+from Source.Tools.confusion_matrix_stats_calculator import binary_confusion_counts, stack_file_paths
+from Source.Tools.image_io import block_reduce, map_ordered, read_image
+from Source.Tools.volume_cache import DEFAULT_MAX_CACHE_BYTES
+from Source.Tools.volume_sources import FolderSource, VolumeSource, close_sources, open_volume_source
+
+RESULT_CACHE_VERSION = 2
+
+# Size of the blocks files are read in when hashing their contents
+HASH_BLOCK_BYTES = 1 << 20
+
+
+def file_key(file_path, hash_contents=False):
+    """
+    Identifies a file by its path, size and modification time, or by a hash of its contents so that touched or copied
+    files with unchanged contents keep their key.
+    :param file_path: Path to the file
+    :param hash_contents: Hash the file's contents instead of its path, size and modification time
+    :return: Hexadecimal key string
+    """
+    key_hash = hashlib.sha256()
+
+    if hash_contents:
+        with open(file_path, "rb") as file:
+            for block in iter(lambda: file.read(HASH_BLOCK_BYTES), b""):
+                key_hash.update(block)
+    else:
+        file_stat = os.stat(file_path)
+        key_hash.update(json.dumps([os.path.abspath(file_path), file_stat.st_size, file_stat.st_mtime_ns]).encode())
+
+    return key_hash.hexdigest()
+
+
+def combined_key(*parts):
+    """
+    :param parts: JSON serializable values
+    :return: Hexadecimal key string of the values and the cache version
+    """
+    return hashlib.sha256(json.dumps([RESULT_CACHE_VERSION] + list(parts)).encode()).hexdigest()
+
+
+def slice_keys(file_paths, hash_contents=False):
+    """
+    Keys each slice of a dataset. Slices of an image stack are keyed by their own file, slices of a volume file by the
+    file and their index, so only the changed images of a stack get new keys.
+    :param file_paths: list of file paths to each image, or a VolumeSource
+    :param hash_contents: Hash the files' contents instead of their path, size and modification time
+    :return: List of one key per slice
+    """
+    if isinstance(file_paths, FolderSource):
+        file_paths = file_paths.file_paths
+
+    if isinstance(file_paths, VolumeSource):
+        volume_key = file_key(file_paths.path, hash_contents)
+        return [combined_key(volume_key, index) for index in range(len(file_paths))]
+
+    return [file_key(file_path, hash_contents) for file_path in file_paths]
+
+
+def read_slice(file_paths, index):
+    """
+    :param file_paths: list of file paths to each image, or a VolumeSource
+    :param index: index of the slice
+    :return: the decoded slice
+    """
+    if isinstance(file_paths, VolumeSource):
+        return file_paths.read(index)
+    return read_image(file_paths[index])
+
+
+def _write_atomic(path, write):
+    """
+    Writes a cache file through a temporary file that is only renamed once it's complete, so interrupted runs never
+    leave a partial file behind under a valid key.
+    :param path: Path of the cache file
+    :param write: Function writing the contents to the temporary path it is given
+    """
+    root, extension = os.path.splitext(path)
+    temporary_path = f"{root}.{uuid.uuid4().hex}.tmp{extension}"
+    try:
+        write(temporary_path)
+        os.replace(temporary_path, path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+
+def _load_entry(entry_path):
+    """
+    :return: The JSON contents of a cache entry, or None if there is no entry
+    """
+    try:
+        with open(entry_path) as entry_file:
+            return json.load(entry_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def _save_entry(entry_path, entry):
+    def write(temporary_path):
+        with open(temporary_path, "w") as entry_file:
+            json.dump(entry, entry_file)
+
+    _write_atomic(entry_path, write)
+
+
+def referenced_slice_keys(selection_dir, skipped_entry_path=None):
+    """
+    :param selection_dir: Path to the folder of the cached selection entries
+    :param skipped_entry_path: Optional path of an entry to leave out, such as the one being replaced
+    :return: Set of the stored slice keys that the selection entries point to
+    """
+    keys = set()
+
+    for file_name in os.listdir(selection_dir):
+        entry_path = os.path.join(selection_dir, file_name)
+        if not file_name.endswith(".json") or entry_path == skipped_entry_path:
+            continue
+
+        entry = _load_entry(entry_path)
+        if entry is not None:
+            keys.update(entry["slice_keys"])
+
+    return keys
+
+
+def evict_slice_store(slice_dir, max_cache_bytes=DEFAULT_MAX_CACHE_BYTES, kept_keys=()):
+    """
+    Deletes the least recently used stored slices until the store fits in the size limit. Evicted slices are decoded
+    again the next time a dataset holding them changes.
+    :param slice_dir: Path to the per-slice store
+    :param max_cache_bytes: Largest total size of the stored slices
+    :param kept_keys: Keys of the slices that are never evicted, such as those of the dataset just scored
+    :return: List of the evicted keys
+    """
+    kept_keys = set(kept_keys)
+    slices = []
+
+    for file_name in os.listdir(slice_dir):
+        if not file_name.endswith(".npy") or file_name.endswith(".tmp.npy"):
+            continue
+
+        # Stored slices have their modification time refreshed whenever they are read to track the last access
+        file_stat = os.stat(os.path.join(slice_dir, file_name))
+        slices.append((file_stat.st_mtime_ns, file_stat.st_size, file_name[:-len(".npy")]))
+
+    store_size = sum(size for _, size, _ in slices)
+    evicted = []
+
+    for _, size, key in sorted(slices):
+        if store_size <= max_cache_bytes:
+            break
+        if key in kept_keys:
+            continue
+
+        try:
+            os.remove(os.path.join(slice_dir, key + ".npy"))
+        except FileNotFoundError:
+            pass
+
+        store_size -= size
+        evicted.append(key)
+
+    return evicted
+
+
+def cached_avg_and_scores(folder_path, cache_dir, downsample_factor=1, workers=None, hash_contents=False,
+                          max_cache_bytes=DEFAULT_MAX_CACHE_BYTES):
+    """
+    Calculates the average image and the difference scores of every image like image_list_avg followed by
+    average_pixel_difference_calc, reusing the results of earlier runs from a persistent cache. An unchanged dataset is
+    answered without decoding anything. Otherwise only new or changed slices are decoded, into a per-slice store, and
+    the average and scores are recalculated from the stored slices (every score depends on the average, so every
+    stored slice is read again, but none of them is decoded again). The store is kept under a size limit by evicting
+    the least recently used slices of other datasets, and a dataset whose slices alone exceed the limit isn't stored.
+    :param folder_path: path to the folder containing the images, or to a multi-page TIFF or raw volume file
+    :param cache_dir: path to the result cache folder, created if it doesn't exist
+    :param downsample_factor: integer factor the images are mean pooled by before averaging and scoring
+    :param workers: number of threads decoding the new or changed slices, None for one per core
+    :param hash_contents: key the slices on a hash of their files' contents instead of path, size and modification time
+    :param max_cache_bytes: largest total size of the per-slice store
+    :return: list of file paths to each image (a VolumeSource for volume files), the average image, list of difference
+             scores, number of slices that were decoded
+    """
+    from Source.Tools.training_data_selector import array_mse_calc, dataset_file_paths
+
+    file_paths = dataset_file_paths(folder_path)
+    keys = [combined_key(key, downsample_factor) for key in slice_keys(file_paths, hash_contents)]
+
+    slice_dir = os.path.join(cache_dir, "slices")
+    selection_dir = os.path.join(cache_dir, "selection")
+    os.makedirs(slice_dir, exist_ok=True)
+    os.makedirs(selection_dir, exist_ok=True)
+
+    entry_key = combined_key("selection", os.path.abspath(folder_path), downsample_factor)
+    entry_path = os.path.join(selection_dir, entry_key + ".json")
+    average_path = os.path.join(selection_dir, entry_key + ".npy")
+
+    entry = _load_entry(entry_path)
+    if entry is not None and entry["slice_keys"] == keys and os.path.isfile(average_path):
+        return file_paths, np.load(average_path), entry["scores"], 0
+
+    def slice_path(key):
+        return os.path.join(slice_dir, key + ".npy")
+
+    missing = [index for index, key in enumerate(keys) if not os.path.isfile(slice_path(key))]
+
+    def decode_and_store(index):
+        image_array = block_reduce(read_slice(file_paths, index), downsample_factor)
+        _write_atomic(slice_path(keys[index]), lambda temporary_path: np.save(temporary_path, image_array))
+
+    for _ in tqdm(map_ordered(decode_and_store, missing, workers),
+                  total=len(missing),
+                  desc="Decoding Changed Slices",
+                  unit="Image"):
+        pass
+
+    summed_array = 0
+    for key in keys:
+        summed_array += np.load(slice_path(key), mmap_mode="r").astype(float)
+        os.utime(slice_path(key))
+    avg_img = summed_array / len(keys)
+
+    scores = [array_mse_calc(np.load(slice_path(key), mmap_mode="r"), avg_img) for key in keys]
+
+    # Slices this dataset no longer has are deleted, unless another dataset with identical slices still holds them
+    other_keys = referenced_slice_keys(selection_dir, entry_path)
+    if entry is not None:
+        for stale_key in set(entry["slice_keys"]) - set(keys) - other_keys:
+            if os.path.isfile(slice_path(stale_key)):
+                os.remove(slice_path(stale_key))
+
+    dataset_bytes = sum(os.path.getsize(slice_path(key)) for key in set(keys))
+    if dataset_bytes > max_cache_bytes:
+        print(f"Warning: the slices of {folder_path} are larger than the result cache limit and were not kept, a "
+              f"change to the dataset decodes every slice again.")
+        for key in set(keys) - other_keys:
+            os.remove(slice_path(key))
+    else:
+        evict_slice_store(slice_dir, max_cache_bytes, keys)
+
+    _write_atomic(average_path, lambda temporary_path: np.save(temporary_path, avg_img))
+    _save_entry(entry_path, {"slice_keys": keys, "scores": scores})
+
+    return file_paths, avg_img, scores, len(missing)
+
+
+def cached_confusion_counts(pos_label, ground_truth_folder_path, predicted_folder_path, cache_dir,
+                            roi_mask_folder_path=None, workers=None, hash_contents=False):
+    """
+    Counts the confusion matrix of every slice of two image stacks, reusing the counts of slices whose ground truth,
+    prediction and ROI mask haven't changed since an earlier run, so only new or changed slices are decoded.
+    :param pos_label: The greyscale integer value considered to be positive
+    :param ground_truth_folder_path: Path to the ground truth image stack folder or volume file
+    :param predicted_folder_path: Path to the predicted image stack folder or volume file
+    :param cache_dir: Path to the result cache folder, created if it doesn't exist
+    :param roi_mask_folder_path: Optional path to the ROI mask image stack folder or volume file
+    :param workers: number of threads counting the new or changed slices, None for one per core
+    :param hash_contents: key the slices on a hash of their files' contents instead of path, size and modification time
+    :return: (slices, 5) array of the PROFILE_COLUMNS counts of each slice, the number of ROI voxels (None if there is
+             no ROI mask), the number of slices that were counted rather than read from the cache
+    """
+    paths = [ground_truth_folder_path, predicted_folder_path]
+    if roi_mask_folder_path is not None:
+        paths.append(roi_mask_folder_path)
+
+    # Folders are listed rather than opened as sources so that a fully cached run decodes nothing
+    sources = [stack_file_paths(path) if os.path.isdir(path) else open_volume_source(path) for path in paths]
+    try:
+        if len(sources[1]) != len(sources[0]):
+            raise ValueError("Datasets are not the same size")
+        if len(sources) == 3 and len(sources[2]) != len(sources[0]):
+            raise ValueError("Mask dimensions don't match the datasets")
+
+        keys = [combined_key(pos_label, *slice_pair)
+                for slice_pair in zip(*(slice_keys(source, hash_contents) for source in sources))]
+
+        confusion_dir = os.path.join(cache_dir, "confusion")
+        os.makedirs(confusion_dir, exist_ok=True)
+        entry_path = os.path.join(confusion_dir, combined_key("confusion", *map(os.path.abspath, paths)) + ".json")
+
+        entry = _load_entry(entry_path)
+        cached_counts = {} if entry is None else dict(zip(entry["slice_keys"], entry["counts"]))
+        missing = [index for index, key in enumerate(keys) if key not in cached_counts]
+
+        def count_slice(index):
+            ground_truth, predicted = read_slice(sources[0], index), read_slice(sources[1], index)
+            if ground_truth.shape != predicted.shape:
+                raise ValueError("Datasets are not the same size")
+
+            roi_voxels = None
+            roi_voxel_count = 0
+            if len(sources) == 3:
+                roi_mask = read_slice(sources[2], index)
+                if roi_mask.shape != ground_truth.shape:
+                    raise ValueError("Mask dimensions don't match the datasets")
+                roi_voxels = roi_mask == pos_label
+                roi_voxel_count = int(np.count_nonzero(roi_voxels))
+
+            counts = [int(count) for count in binary_confusion_counts(ground_truth, predicted, pos_label, roi_voxels)]
+            return counts + [roi_voxel_count]
+
+        for index, counts in tqdm(zip(missing, map_ordered(count_slice, missing, workers)),
+                                  total=len(missing),
+                                  desc="Counting Changed Slices",
+                                  unit="Slice"):
+            cached_counts[keys[index]] = counts
+    finally:
+        close_sources(*sources)
+
+    counts = [cached_counts[key] for key in keys]
+    _save_entry(entry_path, {"slice_keys": keys, "counts": counts})
+
+    counts = np.array(counts, dtype=np.int64).reshape(-1, 6)
+    roi_size = int(counts[:, 5].sum()) if roi_mask_folder_path is not None else None
+
+    return counts[:, :5], roi_size, len(missing)
@@ -0,0 +1,112 @@
+import csv
+
+import numpy as np
+
+from Source.Tools.confusion_matrix_stats_calculator import PROFILE_COLUMNS, STAT_BLOC_COLUMNS, confusion_stats
+
+
+def profile_stats(slice_profile):
+    """
+    Calculates the confusion matrix statistics of every slice (or tile) of a slice profile.
+    :param slice_profile: Array of counts from confusion_matrix_statistics with profile=True, PROFILE_COLUMNS last
+    :return: Dictionary of arrays keyed by STAT_BLOC_COLUMNS, each shaped like the profile without its last axis
+             (NaN where a statistic is undefined, e.g. the precision of a slice without any predicted positives)
+    """
+    tn, fp, fn, tp = np.moveaxis(np.asarray(slice_profile, dtype=np.int64)[..., :4], -1, 0)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return dict(zip(STAT_BLOC_COLUMNS, confusion_stats(tn, fp, fn, tp)))
+
+
+def slice_profile_export(slice_profile, output_path, idx_offset=0):
+    """
+    Writes the counts and statistics of every slice (and tile) of a slice profile to a CSV file.
+    :param slice_profile: Array of counts from confusion_matrix_statistics with profile=True
+    :param output_path: Path to the CSV file
+    :param idx_offset: the index your dataset begins numbering at
+    """
+    slice_profile = np.asarray(slice_profile)
+    stats = profile_stats(slice_profile)
+    tiled = slice_profile.ndim == 4
+
+    header = ["slice"] + (["tile_row", "tile_column"] if tiled else []) + list(PROFILE_COLUMNS) + \
+        list(STAT_BLOC_COLUMNS[4:])
+
+    with open(output_path, "w", newline="") as output_file:
+        writer = csv.writer(output_file)
+        writer.writerow(header)
+
+        for index in np.ndindex(slice_profile.shape[:-1]):
+            position = [index[0] + idx_offset] + list(index[1:])
+            counts = slice_profile[index].tolist()
+            values = [stats[column][index].item() for column in STAT_BLOC_COLUMNS[4:]]
+            writer.writerow(position + counts + values)
+
+
+def slice_profile_plot(slice_profile, idx_offset=0, stat="f1"):
+    """
+    Plots a statistic per slice of a slice profile using matplotlib, tiles are combined into their slice.
+    :param slice_profile: Array of counts from confusion_matrix_statistics with profile=True
+    :param idx_offset: the starting index
+    :param stat: "precision", "recall", "f1" or "pixel_error"
+    :return: Plot
+    """
+    import matplotlib.pyplot as plt
+
+    slice_profile = np.asarray(slice_profile)
+    if slice_profile.ndim == 4:
+        slice_profile = slice_profile.sum(axis=(1, 2))
+
+    stat_values = profile_stats(slice_profile)[stat]
+    global_value = profile_stats(slice_profile.sum(axis=0))[stat]
+
+    # Generate the x axis values
+    x = np.arange(idx_offset, idx_offset + len(stat_values))
+    plt.plot(x, stat_values, label=f'{stat} per slice', marker='.')
+
+    # Adding the value of the whole volume and the median of the slices
+    plt.axhline(global_value, color='r', linestyle='--', label=f'Volume: {global_value:.4f}')
+    plt.axhline(np.nanmedian(stat_values), color='g', linestyle='-.',
+                label=f'Median: {np.nanmedian(stat_values):.4f}')
+
+    # Adding labels and title
+    plt.xlabel('Slice')
+    plt.ylabel(stat)
+    plt.legend()
+
+    # Add major grid lines
+    plt.grid(which='major', linestyle='-', linewidth='0.5', color='black')
+
+    # Add minor grid lines
+    plt.minorticks_on()
+    plt.grid(which='minor', linestyle=':', linewidth='0.5', color='gray')
+    plt.show()
+
+
+def bootstrap_confidence_interval(slice_profile, stat="f1", n_resamples=1000, confidence=0.95, seed=None):
+    """
+    Estimates a confidence interval of a volume statistic by resampling the slices with replacement. Each resample
+    only sums the small per-slice count arrays, so no data is read again.
+    :param slice_profile: Array of counts from confusion_matrix_statistics with profile=True
+    :param stat: "precision", "recall", "f1" or "pixel_error"
+    :param n_resamples: Number of bootstrap resamples
+    :param confidence: Width of the percentile interval
+    :param seed: Optional random seed for reproducible intervals
+    :return: The statistic of the whole volume, and the lower and upper bounds of the interval
+    """
+    slice_profile = np.asarray(slice_profile, dtype=np.int64)
+    if slice_profile.ndim == 4:
+        slice_profile = slice_profile.sum(axis=(1, 2))
+
+    number_of_slices = len(slice_profile)
+    rng = np.random.default_rng(seed)
+
+    # Each row holds how many times every slice was drawn in one resample
+    draws = rng.multinomial(number_of_slices, np.full(number_of_slices, 1 / number_of_slices), size=n_resamples)
+    resampled_counts = draws @ slice_profile
+
+    resampled_values = profile_stats(resampled_counts)[stat]
+    tail = (1 - confidence) / 2 * 100
+    lower, upper = np.nanpercentile(resampled_values, [tail, 100 - tail])
+
+    return profile_stats(slice_profile.sum(axis=0))[stat], lower, upper
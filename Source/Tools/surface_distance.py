@@ -0,0 +1,354 @@
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from tqdm import tqdm
+
+from Source.Tools.volume_sources import close_sources, open_volume_source
+
+# Names of the metrics returned by surface_distance_metrics
+SURFACE_METRIC_COLUMNS = ("hausdorff", "hd95", "assd")
+
+# Surfaces shared by the worker processes, opened once per process by _open_shared_surfaces
+_shared_surfaces = {}
+
+
+def surface_mask(mask):
+    """
+    Finds the surface voxels of a binary volume, the voxels of the object with a face neighbour outside of it. Voxels
+    on the edge of the volume count as surface voxels.
+    :param mask: Boolean volume
+    :return: Boolean volume of the surface voxels
+    """
+    from scipy.ndimage import binary_erosion, generate_binary_structure
+
+    structure = generate_binary_structure(mask.ndim, 1)
+    return mask & ~binary_erosion(mask, structure=structure, iterations=1, border_value=0)
+
+
+def surface_distance_stats(predicted_to_ground_truth, ground_truth_to_predicted):
+    """
+    Summarises the distances from each surface voxel to the nearest voxel of the other surface, matching the
+    definitions used by MedPy.
+    :param predicted_to_ground_truth: Distances of the predicted surface voxels to the ground truth surface
+    :param ground_truth_to_predicted: Distances of the ground truth surface voxels to the predicted surface
+    :return: Dictionary with the "hausdorff" distance, the 95th percentile of both sets of distances ("hd95") and the
+             average symmetric surface distance ("assd")
+    """
+    if not len(predicted_to_ground_truth) or not len(ground_truth_to_predicted):
+        raise ValueError("Both volumes must contain at least one positive voxel")
+
+    return {"hausdorff": float(max(predicted_to_ground_truth.max(), ground_truth_to_predicted.max())),
+            "hd95": float(np.percentile(np.concatenate((predicted_to_ground_truth, ground_truth_to_predicted)), 95)),
+            "assd": float((predicted_to_ground_truth.mean() + ground_truth_to_predicted.mean()) / 2)}
+
+
+def full_volume_surface_distances(ground_truth, predicted, pos_label, spacing=(1, 1, 1), roi_voxels=None):
+    """
+    Reference implementation of the surface distance metrics on whole in-memory volumes.
+    :param ground_truth: Ground truth image volume
+    :param predicted: Predicted image volume of the same shape
+    :param pos_label: The greyscale integer value considered to be positive
+    :param spacing: Size of a voxel along each axis of the volumes
+    :param roi_voxels: Optional boolean array of the same shape, voxels outside of it are treated as negative
+    :return: Dictionary of the SURFACE_METRIC_COLUMNS metrics
+    """
+    from scipy.ndimage import distance_transform_edt
+
+    ground_truth_mask = ground_truth == pos_label
+    predicted_mask = predicted == pos_label
+    if roi_voxels is not None:
+        ground_truth_mask &= roi_voxels
+        predicted_mask &= roi_voxels
+
+    ground_truth_surface = surface_mask(ground_truth_mask)
+    predicted_surface = surface_mask(predicted_mask)
+    if not ground_truth_surface.any() or not predicted_surface.any():
+        raise ValueError("Both volumes must contain at least one positive voxel")
+
+    predicted_to_ground_truth = distance_transform_edt(~ground_truth_surface, sampling=spacing)[predicted_surface]
+    ground_truth_to_predicted = distance_transform_edt(~predicted_surface, sampling=spacing)[ground_truth_surface]
+
+    return surface_distance_stats(predicted_to_ground_truth, ground_truth_to_predicted)
+
+
+def _positive_slab(sources, start, stop, pos_label):
+    """
+    Reads matching slabs of the ground truth, prediction and optional ROI mask as positive voxel masks.
+    :return: ground truth and predicted boolean slabs, restricted to the ROI
+    """
+    ground_truth = sources[0].read_slab(start, stop) == pos_label
+    predicted = sources[1].read_slab(start, stop) == pos_label
+
+    if ground_truth.shape != predicted.shape:
+        raise ValueError("Datasets are not the same size")
+
+    if len(sources) == 3:
+        roi_voxels = sources[2].read_slab(start, stop) == pos_label
+        if roi_voxels.shape != ground_truth.shape:
+            raise ValueError("Mask dimensions don't match the datasets")
+        ground_truth &= roi_voxels
+        predicted &= roi_voxels
+
+    return ground_truth, predicted
+
+
+def union_bounding_box(sources, pos_label, slab_size=16):
+    """
+    Finds the bounding box of the positive voxels of either volume, streaming the volumes slab by slab.
+    :return: ((first slice, last slice + 1), (first row, last row + 1), (first column, last column + 1)), or None if
+             neither volume has a positive voxel
+    """
+    number_of_slices = len(sources[0])
+    occupied = [np.zeros(number_of_slices, dtype=bool), np.zeros(sources[0].slice_shape[0], dtype=bool),
+                np.zeros(sources[0].slice_shape[1], dtype=bool)]
+
+    for start in range(0, number_of_slices, slab_size):
+        ground_truth, predicted = _positive_slab(sources, start, start + slab_size, pos_label)
+        union = ground_truth | predicted
+
+        occupied[0][start:start + slab_size] = union.any(axis=(1, 2))
+        occupied[1] |= union.any(axis=(0, 2))
+        occupied[2] |= union.any(axis=(0, 1))
+
+    if not occupied[0].any():
+        return None
+
+    return tuple((int(np.argmax(axis)), int(len(axis) - np.argmax(axis[::-1]))) for axis in occupied)
+
+
+def _open_shared_surfaces(surface_paths, in_plane_paths, spacing):
+    """
+    Process pool initializer mapping the ground truth and predicted surface volumes and their in-plane squared distance
+    volumes.
+    """
+    _shared_surfaces["surfaces"] = [np.load(path, mmap_mode="r") for path in surface_paths]
+    _shared_surfaces["in_plane"] = [np.load(path, mmap_mode="r+") for path in in_plane_paths]
+    _shared_surfaces["spacing"] = spacing
+
+
+def _in_plane_squared_distances(target, start, stop):
+    """
+    First pass of the separable distance transform: the squared distance from every voxel of a slab to the nearest
+    surface voxel of one volume in the same slice, written to the shared in-plane distance volume. Slices without a
+    surface voxel are infinitely far.
+    :param target: 0 for the ground truth surface, 1 for the predicted surface
+    :param start: Index of the first slice of the slab
+    :param stop: Index after the last slice of the slab
+    """
+    from scipy.ndimage import distance_transform_edt
+
+    surface = _shared_surfaces["surfaces"][target]
+    in_plane = _shared_surfaces["in_plane"][target]
+    row_spacing, column_spacing = _shared_surfaces["spacing"][1:]
+    rows, columns = np.indices(surface.shape[1:])
+
+    for index in range(start, stop):
+        surface_slice = np.asarray(surface[index])
+        if not surface_slice.any():
+            in_plane[index] = np.inf
+            continue
+
+        # Squared from the nearest voxel's indices rather than the distances, so they are exact. The nearest voxel is
+        # found with the real spacing, since with unequal row and column spacing it isn't the nearest in voxels
+        nearest_rows, nearest_columns = distance_transform_edt(~surface_slice, sampling=(row_spacing, column_spacing),
+                                                               return_distances=False, return_indices=True)
+        in_plane[index] = ((row_spacing * (nearest_rows - rows)) ** 2 +
+                           (column_spacing * (nearest_columns - columns)) ** 2)
+
+    in_plane.flush()
+
+
+def lower_envelope_distances(squared_distances, spacing=1):
+    """
+    Exact 1D squared distance transform along the first axis of every column of an array at once, the lower envelope
+    of the parabolas (spacing * (z - z'))^2 + squared_distances[z'] (Felzenszwalb and Huttenlocher). Applied to the
+    in-plane squared distances of each slice it gives the exact 3D squared distances.
+    :param squared_distances: Array of squared distances along its first axis, inf where there is no surface
+    :param spacing: Distance between consecutive positions along the first axis
+    :return: Array of the same shape with the squared distance of each voxel to the nearest surface voxel
+    """
+    number_of_slices = len(squared_distances)
+    columns = squared_distances.reshape(number_of_slices, -1)
+    scale = float(spacing) ** 2
+
+    # Slice of each parabola on the lower envelope, the position each one starts at, and the last one of each column
+    vertices = np.zeros(columns.shape, dtype=np.int64)
+    boundaries = np.empty((number_of_slices + 1, columns.shape[1]))
+    top = np.full(columns.shape[1], -1, dtype=np.int64)
+
+    for q in range(number_of_slices):
+        candidates = np.flatnonzero(np.isfinite(columns[q]))
+
+        # The first parabola of a column covers every position
+        first = candidates[top[candidates] < 0]
+        vertices[0, first] = q
+        boundaries[0, first] = -np.inf
+        boundaries[1, first] = np.inf
+        top[first] = 0
+
+        # Removes the parabolas hidden by the new one, then adds it where it crosses the last remaining one
+        pending = candidates[top[candidates] >= 0]
+        pending = pending[vertices[top[pending], pending] != q]
+        while len(pending):
+            k = top[pending]
+            v = vertices[k, pending]
+            crossing = (((columns[q, pending] + scale * q * q) - (columns[v, pending] + scale * v * v)) /
+                        (2 * scale * (q - v)))
+
+            hidden = crossing <= boundaries[k, pending]
+            top[pending[hidden]] -= 1
+
+            added = pending[~hidden]
+            k = top[added] + 1
+            vertices[k, added] = q
+            boundaries[k, added] = crossing[~hidden]
+            boundaries[k + 1, added] = np.inf
+            top[added] = k
+
+            pending = pending[hidden]
+
+    result = np.full(columns.shape, np.inf)
+    covered = np.flatnonzero(top >= 0)
+    k = np.zeros(len(covered), dtype=np.int64)
+
+    for z in range(number_of_slices):
+        # Moves each column to the parabola covering position z
+        while True:
+            advance = boundaries[k + 1, covered] < z
+            if not advance.any():
+                break
+            k[advance] += 1
+
+        v = vertices[k, covered]
+        result[z, covered] = scale * (z - v) ** 2 + columns[v, covered]
+
+    return result.reshape(squared_distances.shape)
+
+
+def _block_surface_distances(target, first_row, last_row):
+    """
+    Second pass of the separable distance transform: the distances from the surface voxels of one volume in a block of
+    rows to the nearest surface voxel of the other volume, from the lower envelope along the slices of the other
+    volume's in-plane squared distances. The block spans every slice, with few enough rows to stay within the slab
+    memory budget.
+    :param target: 0 to measure the predicted surface against the ground truth surface, 1 for the reverse
+    :param first_row: Index of the first row of the block
+    :param last_row: Index after the last row of the block
+    :return: Array of the distances of the block's surface voxels
+    """
+    query_surface = np.asarray(_shared_surfaces["surfaces"][1 - target][:, first_row:last_row])
+    if not query_surface.any():
+        return np.empty(0)
+
+    in_plane = np.asarray(_shared_surfaces["in_plane"][target][:, first_row:last_row])
+    squared_distances = lower_envelope_distances(in_plane, _shared_surfaces["spacing"][0])[query_surface]
+
+    if np.isinf(squared_distances).any():
+        raise ValueError("Both volumes must contain at least one positive voxel")
+
+    return np.sqrt(squared_distances)
+
+
+def _write_surfaces(sources, pos_label, bounding_box, scratch_folder, slab_size):
+    """
+    Extracts the ground truth and predicted surfaces inside the bounding box slab by slab into memory-mapped scratch
+    volumes. Each slab is read with one extra slice on either side so the erosion is the same as on the whole volume.
+    :return: Paths to the ground truth and predicted surface volumes
+    """
+    (first_slice, last_slice), (first_row, last_row), (first_column, last_column) = bounding_box
+    number_of_slices = len(sources[0])
+    crop_shape = (last_slice - first_slice, last_row - first_row, last_column - first_column)
+
+    surface_paths = [os.path.join(scratch_folder, name + ".npy") for name in ("ground_truth", "predicted")]
+    surfaces = [np.lib.format.open_memmap(path, mode="w+", dtype=bool, shape=crop_shape) for path in surface_paths]
+
+    for start in tqdm(range(first_slice, last_slice, slab_size), desc="Extracting Surfaces", unit="Slab"):
+        stop = min(start + slab_size, last_slice)
+        read_start, read_stop = max(start - 1, 0), min(stop + 1, number_of_slices)
+        masks = _positive_slab(sources, read_start, read_stop, pos_label)
+
+        for surface, mask in zip(surfaces, masks):
+            # Voxels outside the bounding box are all negative, so cropping the rows and columns changes nothing
+            mask = mask[:, first_row:last_row, first_column:last_column]
+            surface[start - first_slice:stop - first_slice] = surface_mask(mask)[start - read_start:stop - read_start]
+
+    for surface in surfaces:
+        surface.flush()
+
+    return surface_paths
+
+
+def surface_distance_metrics(pos_label, ground_truth_folder_path, predicted_folder_path, roi_mask_folder_path=None,
+                             spacing=(1, 1, 1), slab_size=16, workers=None, scratch_dir=None):
+    """
+    Calculates the Hausdorff distance, HD95 and average symmetric surface distance between two segmentations without
+    holding either volume in memory. The surfaces are extracted slab by slab and cropped to the bounding box of both
+    segmentations. The exact distance transforms are then split into two passes run in a process pool: 2D transforms
+    of each slice, then a 1D lower envelope along the slices over blocks of rows. The memory of each worker depends on
+    the slab size only, however far apart the surfaces are, and the results are the same as
+    full_volume_surface_distances.
+    :param pos_label: The greyscale integer value considered to be positive
+    :param ground_truth_folder_path: Path to the ground truth image stack folder or volume file
+    :param predicted_folder_path: Path to the predicted image stack folder or volume file
+    :param roi_mask_folder_path: Optional path to the ROI mask image stack folder or volume file, voxels outside of the
+                                 ROI are treated as negative
+    :param spacing: Size of a voxel along the (slice, row, column) axes
+    :param slab_size: Number of slices per task of the first pass, the second pass takes blocks of rows spanning every
+                      slice with as many voxels, which bounds the memory of each worker
+    :param workers: Number of worker processes, None for one per core
+    :param scratch_dir: Folder for the temporary surface and in-plane distance volumes (8 bytes per voxel of the
+                        bounding box for each volume), None for the system's temporary folder
+    :return: Dictionary of the SURFACE_METRIC_COLUMNS metrics
+    """
+    paths = [ground_truth_folder_path, predicted_folder_path]
+    if roi_mask_folder_path is not None:
+        paths.append(roi_mask_folder_path)
+
+    sources = [open_volume_source(path) for path in paths]
+    try:
+        if any(source.shape != sources[0].shape for source in sources[1:]):
+            raise ValueError("Datasets are not the same size")
+
+        bounding_box = union_bounding_box(sources, pos_label, slab_size)
+        if bounding_box is None:
+            raise ValueError("Both volumes must contain at least one positive voxel")
+
+        with tempfile.TemporaryDirectory(dir=scratch_dir) as scratch_folder:
+            surface_paths = _write_surfaces(sources, pos_label, bounding_box, scratch_folder, slab_size)
+            crop_shape = tuple(last - first for first, last in bounding_box)
+
+            in_plane_paths = [os.path.join(scratch_folder, name + "_in_plane.npy")
+                              for name in ("ground_truth", "predicted")]
+            for path in in_plane_paths:
+                # Created here and filled by the workers
+                np.lib.format.open_memmap(path, mode="w+", dtype=np.float64, shape=crop_shape).flush()
+
+            slabs = [(start, min(start + slab_size, crop_shape[0])) for start in range(0, crop_shape[0], slab_size)]
+            block_rows = max(1, slab_size * crop_shape[1] // crop_shape[0])
+            blocks = [(first_row, min(first_row + block_rows, crop_shape[1]))
+                      for first_row in range(0, crop_shape[1], block_rows)]
+
+            distances = [[], []]
+            with ProcessPoolExecutor(max_workers=workers, initializer=_open_shared_surfaces,
+                                     initargs=(surface_paths, in_plane_paths, tuple(spacing))) as executor:
+                slab_tasks = [(target, start, stop) for target in (0, 1) for start, stop in slabs]
+                for _ in tqdm(executor.map(_in_plane_squared_distances, *zip(*slab_tasks)),
+                              total=len(slab_tasks),
+                              desc="Slice Distance Transforms",
+                              unit="Slab"):
+                    pass
+
+                block_tasks = [(target, first_row, last_row) for target in (0, 1) for first_row, last_row in blocks]
+                results = executor.map(_block_surface_distances, *zip(*block_tasks))
+
+                for (target, _, _), block_distances in tqdm(zip(block_tasks, results),
+                                                            total=len(block_tasks),
+                                                            desc="Measuring Surface Distances",
+                                                            unit="Block"):
+                    distances[target].append(block_distances)
+
+        return surface_distance_stats(np.concatenate(distances[0]), np.concatenate(distances[1]))
+    finally:
+        close_sources(*sources)
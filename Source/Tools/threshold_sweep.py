@@ -0,0 +1,195 @@
+import argparse
+import contextlib
+import sys
+
+import numpy as np
+from tqdm import tqdm
+
+from Source.Tools.console import OUTPUT_FORMATS, write_records
+from Source.Tools.confusion_matrix_stats_calculator import dataset_source, roi_slice_boxes
+from Source.Tools.image_io import map_ordered
+from Source.Tools.volume_sources import close_sources
+
+# Names of the summary statistics returned by threshold_sweep, in order
+SWEEP_COLUMNS = ("best_threshold", "precision", "recall", "f1", "iou", "roc_auc", "average_precision")
+
+# Columns of the curve returned by threshold_sweep, one row per distinct operating point
+CURVE_COLUMNS = ("threshold", "tp", "fp", "fn", "tn", "precision", "recall", "f1", "iou", "false_positive_rate")
+
+
+def intensity_histograms(pos_label, ground_truth_folder_path, predicted_folder_path, roi_mask_folder_path=None,
+                         cache_dir=None, workers=None):
+    """
+    Streams the ground truth and a probability map prediction once, counting how many positive and negative ground
+    truth voxels have each predicted intensity. With an ROI mask only the slices and boxes holding ROI voxels are read.
+    :param pos_label: The greyscale integer value considered to be positive in the ground truth
+    :param ground_truth_folder_path: Path to the ground truth image stack folder or volume file
+    :param predicted_folder_path: Path to the predicted probability map image stack folder or volume file, 8 or 16-bit
+    :param roi_mask_folder_path: Optional path to the ROI mask image stack folder or volume file
+    :param cache_dir: Optional path to a volume cache folder to read the datasets from memory-mapped cached volumes
+    :param workers: Number of decoding threads, None for one per core
+    :return: Histogram of the predicted intensities of the positive voxels, the same for the negative voxels, and the
+             number of counted ground truth voxels that are neither 0 nor pos_label
+    """
+    sources = [dataset_source(path, cache_dir, workers) for path in (ground_truth_folder_path, predicted_folder_path)]
+    roi_source = None
+    try:
+        if sources[1].shape != sources[0].shape:
+            raise ValueError("Datasets are not the same size")
+        if sources[1].dtype.kind not in "ub" or sources[1].dtype.itemsize > 2:
+            raise ValueError(f"Predictions must be 8 or 16-bit unsigned integer probability maps, not "
+                             f"{sources[1].dtype}")
+
+        number_of_levels = 2 ** (8 * sources[1].dtype.itemsize) if sources[1].dtype.kind == "u" else 2
+
+        if roi_mask_folder_path is not None:
+            roi_source = dataset_source(roi_mask_folder_path, cache_dir, workers)
+            if roi_source.shape != sources[0].shape:
+                raise ValueError("Mask dimensions don't match the datasets")
+            boxes, _ = roi_slice_boxes(roi_source, pos_label, workers, packed=True)
+        else:
+            full_slice = ((0, sources[0].slice_shape[0]), (0, sources[0].slice_shape[1]), None)
+            boxes = [full_slice] * len(sources[0])
+
+        def slice_histograms(index):
+            rows, columns, roi_bits = boxes[index]
+            ground_truth = sources[0].read_region(index, rows, columns)
+            predicted = sources[1].read_region(index, rows, columns)
+
+            # The ROI boxes are kept packed for the whole sweep and only unpacked one slice at a time
+            roi_voxels = None
+            if roi_bits is not None:
+                roi_voxels = np.unpackbits(roi_bits, count=ground_truth.size).reshape(ground_truth.shape).view(bool)
+
+            positive = ground_truth == pos_label
+            negative = ground_truth == 0
+            unlabeled = ~(positive | negative)
+            if roi_voxels is not None:
+                positive &= roi_voxels
+                negative &= roi_voxels
+                unlabeled &= roi_voxels
+
+            return (np.bincount(predicted[positive], minlength=number_of_levels),
+                    np.bincount(predicted[negative], minlength=number_of_levels),
+                    np.count_nonzero(unlabeled))
+
+        positive_histogram = np.zeros(number_of_levels, dtype=np.int64)
+        negative_histogram = np.zeros(number_of_levels, dtype=np.int64)
+        unlabeled = 0
+        roi_slices = [index for index, box in enumerate(boxes) if box is not None]
+
+        for slice_positive, slice_negative, slice_unlabeled in tqdm(map_ordered(slice_histograms, roi_slices, workers),
+                                                                    total=len(roi_slices),
+                                                                    desc="Building Histograms",
+                                                                    unit="Slice"):
+            positive_histogram += slice_positive
+            negative_histogram += slice_negative
+            unlabeled += slice_unlabeled
+
+        return positive_histogram, negative_histogram, unlabeled
+    finally:
+        close_sources(*sources, roi_source)
+
+
+def threshold_curves(positive_histogram, negative_histogram):
+    """
+    Derives the confusion matrix and its statistics at every threshold from the intensity histograms with cumulative
+    sums. A voxel is predicted positive at threshold t when its intensity is at least t.
+    :param positive_histogram: Number of positive voxels with each predicted intensity
+    :param negative_histogram: Number of negative voxels with each predicted intensity
+    :return: Dictionary of CURVE_COLUMNS arrays for the thresholds 0 to the number of intensities (all negative), with
+             NaN where a statistic is undefined
+    """
+    # Voxels at or above each threshold, with a final threshold above every intensity
+    tp = np.append(np.cumsum(positive_histogram[::-1])[::-1], 0)
+    fp = np.append(np.cumsum(negative_histogram[::-1])[::-1], 0)
+    fn = tp[0] - tp
+    tn = fp[0] - fp
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = tp / (tp + fp)
+        recall = tp / (tp + fn)
+        f1 = 2 * tp / (2 * tp + fp + fn)
+        iou = tp / (tp + fp + fn)
+        false_positive_rate = fp / (fp + tn)
+
+    return {"threshold": np.arange(len(tp)), "tp": tp, "fp": fp, "fn": fn, "tn": tn, "precision": precision,
+            "recall": recall, "f1": f1, "iou": iou, "false_positive_rate": false_positive_rate}
+
+
+def threshold_sweep(pos_label, ground_truth_folder_path, predicted_folder_path, roi_mask_folder_path=None,
+                    cache_dir=None, workers=None):
+    """
+    Evaluates a probability map prediction at every possible threshold in a single pass over the datasets, instead of
+    binarizing and rerunning confusion_matrix_statistics once per threshold.
+    :param pos_label: The greyscale integer value considered to be positive in the ground truth
+    :param ground_truth_folder_path: Path to the ground truth image stack folder or volume file
+    :param predicted_folder_path: Path to the predicted probability map image stack folder or volume file, 8 or 16-bit
+    :param roi_mask_folder_path: Optional path to the ROI mask image stack folder or volume file
+    :param cache_dir: Optional path to a volume cache folder to read the datasets from memory-mapped cached volumes
+    :param workers: Number of decoding threads, None for one per core
+    :return: Dictionary of the SWEEP_COLUMNS statistics at the threshold with the best F1-score, and the PR/ROC curve as
+             a list of CURVE_COLUMNS rows, one per threshold that changes the predictions
+    """
+    positive_histogram, negative_histogram, unlabeled = intensity_histograms(
+        pos_label, ground_truth_folder_path, predicted_folder_path, roi_mask_folder_path, cache_dir, workers)
+
+    if unlabeled:
+        print(f"Warning: {unlabeled} ground truth voxels are neither 0 nor {pos_label} and were left out of the sweep.")
+
+    curves = threshold_curves(positive_histogram, negative_histogram)
+
+    # Only thresholds at an intensity some voxel has give a distinct operating point, plus the all negative one
+    operating_points = np.append(np.flatnonzero(positive_histogram + negative_histogram), len(positive_histogram))
+
+    if np.all(np.isnan(curves["f1"][operating_points])):
+        raise ValueError("There are no positive voxels in either dataset to sweep thresholds over")
+    best = int(operating_points[np.nanargmax(curves["f1"][operating_points])])
+
+    # Areas under the ROC curve (trapezoids) and the precision-recall curve (average precision), from the highest
+    # threshold down
+    false_positive_rate = curves["false_positive_rate"][operating_points][::-1]
+    recall = curves["recall"][operating_points][::-1]
+    precision = curves["precision"][operating_points][::-1]
+    roc_auc = float(np.sum(np.diff(false_positive_rate) * (recall[1:] + recall[:-1]) / 2))
+    average_precision = float(np.nansum(np.diff(recall) * precision[1:]))
+
+    summary = {"best_threshold": best, "precision": float(curves["precision"][best]),
+               "recall": float(curves["recall"][best]), "f1": float(curves["f1"][best]),
+               "iou": float(curves["iou"][best]), "roc_auc": roc_auc, "average_precision": average_precision}
+
+    curve = [{column: curves[column][threshold].item() for column in CURVE_COLUMNS} for threshold in operating_points]
+
+    return summary, curve
+
+
+def main(argv=None):
+    """
+    Command line entry point, run with python -m Source.Tools.threshold_sweep --help for the options.
+    :param argv: Optional list of the command line arguments, None for sys.argv
+    """
+    parser = argparse.ArgumentParser(description="Sweep every threshold of a probability map prediction against its "
+                                                 "ground truth in a single pass.")
+    parser.add_argument("ground_truth", help="ground truth image stack folder or volume file")
+    parser.add_argument("predicted", help="8 or 16-bit probability map image stack folder or volume file")
+    parser.add_argument("--roi", default=None, help="ROI mask image stack folder or volume file")
+    parser.add_argument("--pos-label", type=int, default=255, help="greyscale value considered positive")
+    parser.add_argument("--cache-dir", default=None, help="volume cache folder to keep the decoded datasets in")
+    parser.add_argument("--curve", default=None, help=".csv or .json file to write the PR/ROC curve to")
+    parser.add_argument("--output", default=None, help=".csv or .json file to write the best threshold to, stdout "
+                                                       "if unset")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default=None,
+                        help="format of the summary, by default the output file's extension or JSON on stdout")
+    args = parser.parse_args(argv)
+
+    # Progress and warnings go to stderr so the table on stdout can be piped
+    with contextlib.redirect_stdout(sys.stderr):
+        summary, curve = threshold_sweep(args.pos_label, args.ground_truth, args.predicted, args.roi, args.cache_dir)
+
+    write_records([summary], SWEEP_COLUMNS, args.output, args.format)
+    if args.curve is not None:
+        write_records(curve, CURVE_COLUMNS, args.curve)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,32 @@
+import argparse
+import contextlib
+import json
 import math
 import os
-import tkinter as tk
-from tkinter import filedialog
+import sys
+import tempfile
 
-import matplotlib.pyplot as plt
 import numpy as np
-from PIL import Image
-from scipy.signal import argrelextrema
 from tqdm import tqdm
 
+from Source.Tools.console import OUTPUT_FORMATS, ask_directory, write_records
+from Source.Tools.image_io import Prefetch, block_reduce, map_images
+from Source.Tools.instrumentation import configure, instrumented, stage
+from Source.Tools.volume_cache import cached_volume
+from Source.Tools.volume_sources import ArraySource, VolumeSource, close_sources, is_volume_file, open_volume_source
+
+# Radius of points that are a strict local extremum at every order
+RADIUS_UNBOUNDED = np.iinfo(np.int64).max
+
+# Extensions of the image files that make up a dataset
+IMAGE_EXTENSIONS = (".tiff", ".tif", ".png", ".jpg", ".jpeg", ".bmp")
+
+# Columns of the selection written by main
+SELECTION_COLUMNS = ("slice", "extremum", "score")
+
+# Number of rounds the trimmed outliers are removed in by default, each round reads the scratch volume once
+DEFAULT_OUTLIER_ROUNDS = 8
+
 
 def get_total_size(file_paths):
     """
@@ -49,27 +67,87 @@ def collect_file_paths(path, accepted_extensions=('.tiff',)):
     else:
         raise ValueError(f"Provided path is neither a valid file nor directory containing one: {path}")
 
-def image_list_avg(folder_path):
+def dataset_file_paths(folder_path):
     """
-    Loads images, filters out non-image files, and calculates their average image.
-    :param folder_path: path to the folder containing the images.
-    :return: list of file paths to each image, the average image as an array of values
+    Collects the image files of a dataset, filtering out non-image files, and prints the size of the dataset.
+    :param folder_path: path to the folder containing the images, or to a multi-page TIFF or raw volume file
+    :return: list of file paths to each image, or a VolumeSource of the slices of a volume file
     """
-    valid_extensions = (".tiff", ".tif", ".png", ".jpg", ".jpeg", ".bmp")
-    file_paths = collect_file_paths(folder_path, valid_extensions)
+    if is_volume_file(folder_path):
+        volume_source = open_volume_source(folder_path)
+        print(f"Dataset size: {volume_source.total_file_size() / 1073741824: .2f} GB")
+        return volume_source
+
+    file_paths = collect_file_paths(folder_path, IMAGE_EXTENSIONS)
 
     # Calculate size of dataset
     total_size = get_total_size(file_paths) / 1073741824
     print(f"Dataset size: {total_size: .2f} GB")
 
+    return file_paths
+
+def map_dataset(function, file_paths, workers=None, dtype=None, cache_dir=None, downsample_factor=1, prefetch=None):
+    """
+    Applies a function to each image of a dataset on a thread pool, yielding the results in slice order.
+    :param function: Function applied to each image array
+    :param file_paths: list of file paths to each image, or a VolumeSource from dataset_file_paths
+    :param workers: number of decoding threads, None for one per core
+    :param dtype: optional data type to convert the intensity values to
+    :param cache_dir: optional path to a volume cache folder to read the images of a folder from a memory-mapped cached
+                      volume (volume files are read directly)
+    :param downsample_factor: integer factor the images are mean pooled by in the decoding threads before the function
+                              is applied, 1 for full resolution
+    :param prefetch: optional Prefetch setting how many images are decoded (or read from the cached volume) ahead and
+                     recording the time spent waiting on them
+    :return: Generator of the function results
+    """
+    if isinstance(downsample_factor, bool) or not isinstance(downsample_factor, int) or downsample_factor < 1:
+        raise ValueError("Downsample factor must be an int >= 1")
+
+    if downsample_factor > 1:
+        full_resolution_function = function
+
+        def function(image_array):
+            return full_resolution_function(block_reduce(image_array, downsample_factor))
+
+    if isinstance(file_paths, VolumeSource):
+        return file_paths.map_slices(function, workers, dtype, prefetch)
+
+    if cache_dir is not None:
+        # Slices of the memory-mapped cached volume are read and processed in the worker threads like decoded images
+        volume = cached_volume(file_paths, cache_dir, workers=workers)
+        return ArraySource(volume).map_slices(function, workers, dtype, prefetch)
+
+    return map_images(function, file_paths, workers, dtype, prefetch)
+
+def image_list_avg(folder_path, workers=None, cache_dir=None, downsample_factor=1, prefetch=None):
+    """
+    Loads images, filters out non-image files, and calculates their average image.
+    :param folder_path: path to the folder containing the images, or to a multi-page TIFF or raw volume file
+    :param workers: number of threads decoding the images ahead of the summation, None for one per core
+    :param cache_dir: optional path to a volume cache folder to read the images from a memory-mapped cached volume
+    :param downsample_factor: integer factor the images are mean pooled by before averaging, 1 for full resolution
+    :param prefetch: optional Prefetch setting the read-ahead depth and recording the time spent waiting on reads
+    :return: list of file paths to each image (a VolumeSource for volume files), the average image as an array of values
+    """
+    with stage("listing"):
+        file_paths = dataset_file_paths(folder_path)
+
     summed_array = 0
 
-    for f, file_path in tqdm(enumerate(file_paths),
-                             total=len(file_paths),
-                             desc="Calculating Average Image",
-                             unit="Image"):
+    image_arrays = map_dataset(lambda image_array: image_array, file_paths, workers, float, cache_dir,
+                               downsample_factor, prefetch)
+
+    # Images are decoded in parallel but summed in order, so the result matches a sequential sum exactly
+    with stage("averaging") as averaging_stage:
+        for image_array in tqdm(image_arrays,
+                                total=len(file_paths),
+                                desc="Calculating Average Image",
+                                unit="Image"):
 
-        summed_array += np.array(Image.open(file_path), dtype=float)
+            summed_array += image_array
+
+        averaging_stage.add(slices=len(file_paths))
 
     avg_img = summed_array / len(file_paths)
 
@@ -78,31 +156,206 @@ def image_list_avg(folder_path):
 def array_mse_calc(array1, array2):
     return np.mean((array1-array2) ** 2)
 
-def average_pixel_difference_calc(average_image_array, dataset_file_paths):
+def average_pixel_difference_calc(average_image_array, dataset_file_paths, workers=None, cache_dir=None,
+                                  downsample_factor=1, prefetch=None):
     """
     Calculate the average pixel difference between each image and the average image.
-    :param dataset_file_paths: list of file paths to images in dataset
+    :param dataset_file_paths: list of file paths to images in dataset, or a VolumeSource of its slices
     :param average_image_array: the average image array.
+    :param workers: number of threads decoding and scoring the images, None for one per core
+    :param cache_dir: optional path to a volume cache folder to read the images from a memory-mapped cached volume
+    :param downsample_factor: integer factor the images are mean pooled by before scoring, the average image must have
+                              been calculated with the same factor
+    :param prefetch: optional Prefetch setting the read-ahead depth and recording the time spent waiting on reads
     :return: list of difference scores
     """
 
     # Initialize the list of image scores (MSE values)
     difference_scores = []
 
-    for f, file_path in tqdm(enumerate(dataset_file_paths),
-                             total=len(dataset_file_paths),
-                             desc="Calculating Difference Scores",
-                             unit="Image"):
+    # Each thread opens an image and scores the MSE of its pixels compared to the average image
+    scores = map_dataset(lambda image_array: array_mse_calc(image_array, average_image_array), dataset_file_paths,
+                         workers, cache_dir=cache_dir, downsample_factor=downsample_factor, prefetch=prefetch)
+
+    with stage("scoring") as scoring_stage:
+        for difference_score in tqdm(scores,
+                                     total=len(dataset_file_paths),
+                                     desc="Calculating Difference Scores",
+                                     unit="Image"):
 
-        # Open anc convert each image into a numpy array of intensity values
-        image_array = np.array(Image.open(file_path))
+            difference_scores.append(difference_score)
 
-        # MSE of the image pixels compared to the average image
-        difference_score = array_mse_calc(image_array,average_image_array)
-        difference_scores.append(difference_score)
+        scoring_stage.add(slices=len(dataset_file_paths))
 
     return difference_scores
 
+def decode_to_scratch(file_paths, scratch_folder, workers=None, downsample_factor=1):
+    """
+    Decodes every image of a dataset once into a memory-mapped scratch volume, summing them along the way.
+    :param file_paths: list of file paths to each image, or a VolumeSource from dataset_file_paths
+    :param scratch_folder: folder to create the scratch volume in
+    :param workers: number of threads decoding the images ahead of the summation, None for one per core
+    :param downsample_factor: integer factor the images are mean pooled by before they are stored
+    :return: the (images, rows, columns) scratch volume, the sum of the images as a float array
+    """
+    number_of_images = len(file_paths)
+    scratch_volume = None
+    summed_array = 0
+
+    image_arrays = map_dataset(lambda image_array: image_array, file_paths, workers,
+                               downsample_factor=downsample_factor)
+
+    for i, image_array in tqdm(enumerate(image_arrays),
+                               total=number_of_images,
+                               desc="Calculating Average Image",
+                               unit="Image"):
+
+        # The first image sets the size and type of the scratch volume
+        if scratch_volume is None:
+            scratch_volume = np.lib.format.open_memmap(os.path.join(scratch_folder, "scratch.npy"), mode="w+",
+                                                       dtype=image_array.dtype,
+                                                       shape=(number_of_images,) + image_array.shape)
+
+        if image_array.shape != scratch_volume.shape[1:] or image_array.dtype != scratch_volume.dtype:
+            raise ValueError(f"Image {i} of the dataset does not match the size and type of the first image")
+
+        scratch_volume[i] = image_array
+        summed_array += image_array.astype(float)
+
+    return scratch_volume, summed_array
+
+def single_decode_avg_and_scores(folder_path, workers=None, scratch_dir=None, downsample_factor=1):
+    """
+    Calculates the average image and the difference scores of every image while decoding each image only once. The
+    decoded images are written to a memory-mapped scratch volume during the averaging pass and scored from there, so
+    memory stays bounded and the scores are the same as image_list_avg followed by average_pixel_difference_calc.
+    :param folder_path: path to the folder containing the images, or to a multi-page TIFF or raw volume file
+    :param workers: number of threads decoding the images ahead of the summation, None for one per core
+    :param scratch_dir: folder for the temporary scratch volume, None for the system's temporary folder (a fast local
+                        disk is best when the dataset is on a network mount)
+    :param downsample_factor: integer factor the images are mean pooled by before averaging and scoring, which also
+                              shrinks the scratch volume by its square
+    :return: list of file paths to each image, the average image as an array of values, list of difference scores
+    """
+    file_paths = dataset_file_paths(folder_path)
+    number_of_images = len(file_paths)
+
+    with tempfile.TemporaryDirectory(dir=scratch_dir) as scratch_folder:
+        scratch_volume, summed_array = decode_to_scratch(file_paths, scratch_folder, workers, downsample_factor)
+
+        avg_img = summed_array / number_of_images
+
+        difference_scores = []
+        for image_array in tqdm(scratch_volume,
+                                total=number_of_images,
+                                desc="Calculating Difference Scores",
+                                unit="Image"):
+
+            difference_scores.append(array_mse_calc(image_array, avg_img))
+
+        del scratch_volume
+
+    return file_paths, avg_img, difference_scores
+
+def scratch_dot(scratch_volume, vector, chunk_size=64):
+    """
+    Dot product of every image in a scratch volume with a vector, read a chunk of images at a time.
+    :param scratch_volume: (images, rows, columns) array or memmap
+    :param vector: flat float array with one value per pixel
+    :param chunk_size: number of images converted to float at a time
+    :return: float array of one dot product per image
+    """
+    number_of_images = len(scratch_volume)
+    dots = np.empty(number_of_images)
+
+    for start in range(0, number_of_images, chunk_size):
+        chunk = scratch_volume[start:start + chunk_size].reshape(-1, vector.size)
+        dots[start:start + chunk_size] = chunk.astype(float) @ vector
+
+    return dots
+
+def trimmed_avg_and_scores(folder_path, number_of_outliers, outliers_per_round=None, workers=None, scratch_dir=None,
+                           downsample_factor=1):
+    """
+    Calculates a robust average image by repeatedly removing the images that differ most from the average, then scores
+    every image against that trimmed average. Each image is decoded once. Rather than rescoring every image after each
+    removal, each image keeps sufficient statistics of its MSE to the mean of the kept images:
+    its squared distance q to the full average m0, and its dot product d with the kept images' summed offsets s from
+    m0, so that MSE = (q - 2 d / n + |s|^2 / n^2) / pixels with |s|^2 the sum of d over the kept images. Removing images
+    updates every score with O(images) scalar work plus one dot product of the scratch volume with the removed images'
+    summed offsets per round, which reads the scratch volume but doesn't decode anything.
+    :param folder_path: path to the folder containing the images, or to a multi-page TIFF or raw volume file
+    :param number_of_outliers: total number of images to leave out of the average
+    :param outliers_per_round: number of the highest scoring images removed before the scores are updated, 1 matches
+                               recalculating after every removal but reads the scratch volume once per outlier. None
+                               to remove the outliers in DEFAULT_OUTLIER_ROUNDS rounds
+    :param workers: number of threads decoding the images ahead of the summation, None for one per core
+    :param scratch_dir: folder for the temporary scratch volume, None for the system's temporary folder
+    :param downsample_factor: integer factor the images are mean pooled by before averaging and scoring
+    :return: list of file paths to each image, the trimmed average image, list of difference scores of every image to
+             the trimmed average, list of the removed image indices in the order they were removed
+    """
+    if outliers_per_round is None:
+        outliers_per_round = max(1, number_of_outliers // DEFAULT_OUTLIER_ROUNDS)
+    if outliers_per_round < 1:
+        raise ValueError("At least one outlier must be removed per round")
+
+    file_paths = dataset_file_paths(folder_path)
+    number_of_images = len(file_paths)
+
+    if not 0 <= number_of_outliers < number_of_images:
+        raise ValueError("The number of outliers must be at least 0 and less than the number of images")
+
+    with tempfile.TemporaryDirectory(dir=scratch_dir) as scratch_folder:
+        scratch_volume, summed_array = decode_to_scratch(file_paths, scratch_folder, workers, downsample_factor)
+
+        # Offsets are taken from the full average so the statistics don't lose precision to large pixel values
+        full_avg = (summed_array / number_of_images).ravel()
+        number_of_pixels = full_avg.size
+
+        squared_distance = np.empty(number_of_images)
+        for i, image_array in enumerate(scratch_volume):
+            squared_distance[i] = np.sum((image_array.ravel() - full_avg) ** 2)
+
+        # The offsets of all images sum to zero, so every image starts with a zero dot product
+        offset_dots = np.zeros(number_of_images)
+        summed_offsets = np.zeros(number_of_pixels)
+        kept = np.ones(number_of_images, dtype=bool)
+        number_kept = number_of_images
+        removed = []
+
+        def mse_scores():
+            return (squared_distance - 2 * offset_dots / number_kept +
+                    offset_dots[kept].sum() / number_kept ** 2) / number_of_pixels
+
+        scores = mse_scores()
+
+        with tqdm(total=number_of_outliers, desc="Removing Outliers", unit="Image") as progress_bar:
+            while len(removed) < number_of_outliers:
+                round_size = min(outliers_per_round, number_of_outliers - len(removed))
+                kept_indices = np.flatnonzero(kept)
+                outliers = kept_indices[np.argsort(scores[kept_indices])[::-1][:round_size]]
+
+                removed_offsets = np.zeros(number_of_pixels)
+                for outlier in outliers:
+                    removed_offsets += scratch_volume[outlier].ravel() - full_avg
+
+                # x_i . r = (x_i - m0) . r, with m0 . r taken out once
+                offset_dots -= scratch_dot(scratch_volume, removed_offsets) - full_avg @ removed_offsets
+                summed_offsets -= removed_offsets
+                kept[outliers] = False
+                number_kept -= len(outliers)
+                removed.extend(outliers.tolist())
+
+                scores = mse_scores()
+                progress_bar.update(len(outliers))
+
+        avg_img = (full_avg + summed_offsets / number_kept).reshape(scratch_volume.shape[1:])
+
+        del scratch_volume
+
+    return file_paths, avg_img, scores.tolist(), removed
+
 def img_diff_plot(average_difference_array, idx_offset):
     """
     Plots the MSE per slice of a serial dataset using matplotlib
@@ -110,6 +363,8 @@ def img_diff_plot(average_difference_array, idx_offset):
     :param idx_offset: the starting index
     :return: Plot
     """
+    import matplotlib.pyplot as plt
+
     print("Note: you will need to exit the plot preview before entering a new number.")
 
     # Calculate the average difference scores
@@ -148,6 +403,8 @@ def local_extrema_by_mode(array, mode, order=1, index_offset=1):
     :return: total_extrema: total number of local extrema found, extrema: Dictionary with max and or min keys holding
     tuples of the extrema indices
     """
+    from scipy.signal import argrelextrema
+
     extrema = {}
 
     if mode in ("max", "both"):
@@ -161,35 +418,355 @@ def local_extrema_by_mode(array, mode, order=1, index_offset=1):
     return total_extrema, extrema
 
 
-def training_slice_selector(dataset_path=None, desired_number_of_slices=None, mode="both", idx_offset=0):
+def extremum_radius(array):
+    """
+    Finds the largest order at which each point of a 1D array is a strict local maximum, matching the clipped edge
+    handling of scipy's argrelextrema so the point is returned by argrelextrema(array, np.greater, order) exactly when
+    its radius is at least the order.
+    :param array: 1D dataset being analyzed
+    :return: 1D integer array of radii, 0 for points that are never a local maximum and RADIUS_UNBOUNDED for points
+    that are greater than every other point within reach
+    """
+    number_of_points = len(array)
+    radii = np.zeros(number_of_points, dtype=np.int64)
+
+    # NaN values compare false against everything, so they block every neighbour and are never extrema themselves
+    values = np.where(np.isnan(array), np.inf, array).tolist()
+
+    # Distance to the nearest point on each side that isn't strictly smaller, found with monotonic stacks
+    left_distance = [RADIUS_UNBOUNDED] * number_of_points
+    right_distance = [RADIUS_UNBOUNDED] * number_of_points
+
+    stack = []
+    for i in range(number_of_points):
+        while stack and values[stack[-1]] < values[i]:
+            stack.pop()
+        if stack:
+            left_distance[i] = i - stack[-1]
+        stack.append(i)
+
+    stack = []
+    for i in reversed(range(number_of_points)):
+        while stack and values[stack[-1]] < values[i]:
+            stack.pop()
+        if stack:
+            right_distance[i] = stack[-1] - i
+        stack.append(i)
+
+    # The end points are compared against themselves by the clipped comparison, so they're never extrema
+    for i in range(1, number_of_points - 1):
+        radii[i] = min(left_distance[i], right_distance[i]) - 1
+
+    radii[np.isnan(array)] = 0
+
+    return radii
+
+
+def extremum_radii(array):
+    """
+    Precomputes the strict local maximum and minimum radius of every point so that the extrema at any order, and the
+    best order for any number of extrema, can be found without rerunning argrelextrema.
+    :param array: 1D dataset being analyzed
+    :return: Dictionary with "max" and "min" keys holding the radius of each point
+    """
+    array = np.asarray(array, dtype=float)
+
+    return {"max": extremum_radius(array), "min": extremum_radius(-array)}
+
+
+def extrema_at_order(radii, mode, order=1, index_offset=1):
+    """
+    Equivalent of local_extrema_by_mode using precomputed extremum radii.
+    :param radii: Dictionary of radii from extremum_radii
+    :param mode: "max", "min", or "both" determines which extrema values to look for
+    :param order: the number of points considered on either side of a potential local extrema
+    :param index_offset: the starting index for your data (default to 1 to match image stack numbering)
+    :return: total_extrema: total number of local extrema found, extrema: Dictionary with max and or min keys holding
+    tuples of the extrema indices
+    """
+    if int(order) != order or order < 1:
+        raise ValueError("Order must be an int >= 1")
+
+    extrema = {}
+
+    if mode in ("max", "both"):
+        extrema["max"] = np.nonzero(radii["max"] >= order)[0] + index_offset
+
+    if mode in ("min", "both"):
+        extrema["min"] = np.nonzero(radii["min"] >= order)[0] + index_offset
+
+    total_extrema = sum(len(indices) for indices in extrema.values())
+
+    return total_extrema, extrema
+
+
+def order_for_slice_count(radii, mode, desired_number_of_slices, number_of_images):
+    """
+    Finds the largest order, up to half the number of images, that still returns at least the desired number of
+    extrema. This is the order the search from the highest order down to 1 settles on, found with a single sort.
+    :param radii: Dictionary of radii from extremum_radii
+    :param mode: "max", "min", or "both" determines which extrema values to look for
+    :param desired_number_of_slices: the minimum number of extrema to return
+    :param number_of_images: the number of images in the dataset
+    :return: the order
+    """
+    highest_order = math.floor(number_of_images / 2)
+
+    if desired_number_of_slices < 1:
+        return highest_order
+
+    mode_radii = [radii[key] for key in ("max", "min") if mode in (key, "both")]
+    sorted_radii = np.sort(np.concatenate(mode_radii))[::-1]
+
+    # The extrema count at an order is the number of radii at least that large, so the n-th largest radius is the
+    # largest order returning n extrema
+    if desired_number_of_slices > len(sorted_radii):
+        return 0
+
+    return int(min(highest_order, sorted_radii[desired_number_of_slices - 1]))
+
+
+def select_training_slices(radii, mode, desired_number_of_slices, number_of_images, index_offset=0):
+    """
+    Selects at least the desired number of extrema at the largest order that still returns that many.
+    :param radii: Dictionary of radii from extremum_radii
+    :param mode: "max", "min", or "both" determines which extrema values to look for
+    :param desired_number_of_slices: the number of training slices wanted
+    :param number_of_images: the number of images in the dataset
+    :param index_offset: the starting index of the dataset
+    :return: total_extrema: total number of local extrema found, extrema: Dictionary with max and or min keys holding
+    the selected slice numbers
+    """
+    # Order determines how many points on either side of the local extrema are considered to classify it as such
+    order = 1
+    total_extrema, local_extrema = extrema_at_order(radii, mode, order, index_offset)
+
+    # If the number of local extrema slices is greater than the number of desired slices, increase the order
+    if total_extrema > desired_number_of_slices:
+
+        # The largest order possible to give desired results
+        order = order_for_slice_count(radii, mode, desired_number_of_slices, number_of_images)
+        total_extrema, local_extrema = extrema_at_order(radii, mode, order, index_offset)
+
+    # If the number of extrema slices returned at order 1 is less than desired, inform the user
+    else:
+        print(f"To select {desired_number_of_slices} slices for training data, "
+              f"please provide more data or change mode.")
+
+    return total_extrema, local_extrema
+
+
+def downsampling_agreement(dataset_path, downsample_factor, desired_number_of_slices, mode="both", sample_size=200,
+                           workers=None):
+    """
+    Compares the slices selected at full resolution and from downsampled images on a contiguous sample of a dataset,
+    to check that a downsampling factor is safe to use on the whole dataset.
+    :param dataset_path: the path to the image stack dataset folder, or to a multi-page TIFF or raw volume file
+    :param downsample_factor: integer factor the images are mean pooled by
+    :param desired_number_of_slices: how many training slices to select from the whole dataset, scaled down to the
+                                     sample
+    :param mode: "max", "min", or "both" determines which extrema values to look for
+    :param sample_size: number of consecutive slices from the middle of the dataset that are scored both ways
+    :param workers: number of decoding threads, None for one per core
+    :return: Dictionary of the agreement report: the "sample" (first, last) slice indices, the slices selected at
+             "full_resolution" and "downsampled", their "jaccard" index, the fraction of full resolution slices
+             "matched_within_one" slice by a downsampled selection, and the "score_rank_correlation" (Spearman) of the
+             two sets of difference scores
+    """
+    if mode not in ("max", "min", "both"):
+        raise ValueError(f"The agreement report compares extrema selections, it can't be made in the '{mode}' mode")
+
+    file_paths = dataset_file_paths(dataset_path)
+    number_of_images = len(file_paths)
+
+    # Extrema depend on neighbouring slices, so the sample is a contiguous run rather than scattered slices
+    sample_size = min(sample_size, number_of_images)
+    start = (number_of_images - sample_size) // 2
+    if isinstance(file_paths, VolumeSource):
+        sample = file_paths.subset(start, start + sample_size)
+    else:
+        sample = file_paths[start:start + sample_size]
+
+    sample_desired = max(1, round(desired_number_of_slices * sample_size / number_of_images))
+
+    selections = {}
+    scores = {}
+    for name, factor in (("full_resolution", 1), ("downsampled", downsample_factor)):
+        avg_img = 0
+        for image_array in map_dataset(lambda image_array: image_array, sample, workers, float,
+                                       downsample_factor=factor):
+            avg_img += image_array
+        avg_img = avg_img / sample_size
+
+        scores[name] = np.array(list(map_dataset(lambda image_array: array_mse_calc(image_array, avg_img), sample,
+                                                 workers, downsample_factor=factor)))
+        _, extrema = select_training_slices(extremum_radii(scores[name]), mode, sample_desired, sample_size, start)
+        selections[name] = np.sort(np.concatenate(list(extrema.values())))
+
+    close_sources(file_paths)
+
+    full_resolution, downsampled = selections["full_resolution"], selections["downsampled"]
+    union = np.union1d(full_resolution, downsampled)
+
+    # Spearman's correlation is the correlation of the ranks
+    ranks = [np.argsort(np.argsort(scores[name])) for name in ("full_resolution", "downsampled")]
+
+    matched = [np.min(np.abs(downsampled - slice_number)) <= 1 if downsampled.size else False
+               for slice_number in full_resolution]
+
+    return {"downsample_factor": downsample_factor,
+            "sample": (start, start + sample_size - 1),
+            "full_resolution": full_resolution.tolist(),
+            "downsampled": downsampled.tolist(),
+            "jaccard": len(np.intersect1d(full_resolution, downsampled)) / len(union) if union.size else 1.0,
+            "matched_within_one": float(np.mean(matched)) if matched else 1.0,
+            "score_rank_correlation": float(np.corrcoef(ranks[0], ranks[1])[0, 1]) if sample_size > 1 else 1.0}
+
+
+def diverse_mode_selector(dataset_path, desired_number_of_slices, idx_offset=0, cache_dir=None, scratch_dir=None,
+                          downsample_factor=None):
+    """
+    The 'diverse' mode of training_slice_selector, picking slices by farthest-point sampling of a streaming PCA
+    embedding of the slices instead of the extrema of their difference scores.
+    :return: Dictionary with a "diverse" key holding the selected slice numbers, and an array of each slice number
+             with its embedding distance from the centre of the dataset
+    """
+    from Source.Tools.diversity_selection import diverse_training_slices
+
+    # If unentered, prompt for the starting index and the number of training slices, only accepting integer values
+    if idx_offset is None:
+        while True:
+            try:
+                print()
+                idx_offset = int(input("Starting index not specified, please enter it now: "))
+            except ValueError:
+                print()
+                print("Invalid index, please enter an integer")
+                continue
+            else:
+                break
+
+    if desired_number_of_slices is None:
+        while True:
+            try:
+                print()
+                desired_number_of_slices = int(input("Enter the number of training images: "))
+            except ValueError:
+                print()
+                print("Invalid number of training images, please enter an integer")
+                continue
+            else:
+                break
+
+    selected, centre_distance = diverse_training_slices(dataset_path, desired_number_of_slices, idx_offset,
+                                                        downsample_factor=downsample_factor, cache_dir=cache_dir,
+                                                        scratch_dir=scratch_dir)
+    print("Total training slices returned: ", len(selected))
+
+    slices = np.arange(idx_offset, idx_offset + len(centre_distance))
+
+    return {"diverse": selected}, np.column_stack((slices, centre_distance))
+
+@instrumented("training_slice_selector")
+def training_slice_selector(dataset_path=None, desired_number_of_slices=None, mode="both", idx_offset=0,
+                            cache_dir=None, single_decode=False, scratch_dir=None, downsample_factor=None,
+                            number_of_outliers=0, result_cache_dir=None, prefetch=None, outliers_per_round=None):
     """
     Selects the desired number of image slices from the input dataset for training data using the local extrema of the
     average pixel difference scores.
     :param idx_offset: the index your dataset begins numbering at (typically either 0 or 1 unless using a subset)
-    :param mode: 'max' to identify the most unique images, 'min' for the least unique images, or 'both' for a
-                combination of the two
-    :param dataset_path: the path to the image stack dataset folder
+    :param mode: 'max' to identify the most unique images, 'min' for the least unique images, 'both' for a
+                combination of the two, or 'diverse' for slices spread out in a PCA embedding of the slices (see
+                diversity_selection)
+    :param dataset_path: the path to the image stack dataset folder, or to a multi-page TIFF or raw volume file
     :param desired_number_of_slices: how many image slices you want to identify for use as training data
+    :param cache_dir: optional path to a volume cache folder, the dataset is then decoded once into a memory-mapped
+                      cached volume that both the averaging and scoring passes (and later runs) read from
+    :param single_decode: decode each image only once by scoring from a temporary memory-mapped scratch volume instead
+                          of reading the dataset a second time (ignored when cache_dir is given, which already does so)
+    :param scratch_dir: folder for the single_decode scratch volume, None for the system's temporary folder
+    :param downsample_factor: integer factor the images are mean pooled by before averaging and scoring, which cuts the
+                              compute and memory by its square, see downsampling_agreement to pick a safe factor. None
+                              for full resolution, or diversity_selection's default factor in the 'diverse' mode
+    :param number_of_outliers: number of the most different images to trim from the average image before scoring, see
+                               trimmed_avg_and_scores (decodes each image once like single_decode)
+    :param result_cache_dir: optional path to a result cache folder keeping the average image and difference scores
+                             between runs, so rerunning on an unchanged dataset with another slice count or mode
+                             decodes nothing and only new or changed slices are decoded otherwise
+    :param prefetch: optional Prefetch setting how many images the averaging and scoring passes decode ahead, and
+                     recording how long they waited on reads
+    :param outliers_per_round: number of outliers trimmed per round, see trimmed_avg_and_scores
     :return: list of the local maxima and minima slice numbers totaling the desired number of training slices
     """
-
-    root = tk.Tk()
-    root.withdraw()  # Hide the root window
-
     if dataset_path is None:
-        dataset_path = filedialog.askdirectory(title="Select dataset folder")
+        dataset_path = ask_directory("Select dataset folder")
 
     if dataset_path:
         print("Dataset folder path:", dataset_path)
     else:
         raise ValueError("No dataset path provided")
 
-    # Load images and calculate initial average image
-    file_paths, avg_img = image_list_avg(dataset_path)
+    if mode == "diverse":
+        # The diverse mode selects from the slice embedding, which has no difference scores to cache or trim
+        if result_cache_dir is not None:
+            raise ValueError("The diverse mode doesn't use the result cache, leave out the result cache or choose the "
+                             "max, min or both mode")
+        if number_of_outliers:
+            raise ValueError("The diverse mode doesn't trim outliers, leave out the outliers or choose the max, min or "
+                             "both mode")
+        if single_decode:
+            raise ValueError("The diverse mode always decodes each image once, leave out single_decode")
+
+        return diverse_mode_selector(dataset_path, desired_number_of_slices, idx_offset, cache_dir, scratch_dir,
+                                     downsample_factor)
+
+    if downsample_factor is None:
+        downsample_factor = 1
+
+    if result_cache_dir is not None and number_of_outliers:
+        raise ValueError("Trimmed scores are not kept in the result cache, leave out the result cache or the outliers")
+
+    if result_cache_dir is not None:
+        from Source.Tools.result_cache import cached_avg_and_scores
+
+        # Reuses the scores of an unchanged dataset, or decodes only its new and changed slices
+        with stage("cached_scoring") as scoring_stage:
+            file_paths, avg_img, difference_scores, decoded = cached_avg_and_scores(dataset_path, result_cache_dir,
+                                                                                    downsample_factor)
+            scoring_stage.add(slices=decoded)
+    elif number_of_outliers:
+        # Load images once, trimming the outliers from the average image and scoring each image against what's left
+        with stage("trimmed_scoring") as scoring_stage:
+            file_paths, avg_img, difference_scores, _ = trimmed_avg_and_scores(dataset_path, number_of_outliers,
+                                                                               outliers_per_round,
+                                                                               scratch_dir=scratch_dir,
+                                                                               downsample_factor=downsample_factor)
+            scoring_stage.add(slices=len(file_paths))
+    elif single_decode and cache_dir is None:
+        # Load images once, calculating the average image and scoring each image from the scratch volume
+        with stage("single_decode_scoring") as scoring_stage:
+            file_paths, avg_img, difference_scores = single_decode_avg_and_scores(dataset_path,
+                                                                                  scratch_dir=scratch_dir,
+                                                                                  downsample_factor=downsample_factor)
+            scoring_stage.add(slices=len(file_paths))
+    else:
+        # Load images and calculate initial average image
+        file_paths, avg_img = image_list_avg(dataset_path, cache_dir=cache_dir, downsample_factor=downsample_factor,
+                                             prefetch=prefetch)
+
+        # Score each image
+        difference_scores = average_pixel_difference_calc(avg_img, file_paths, cache_dir=cache_dir,
+                                                          downsample_factor=downsample_factor, prefetch=prefetch)
+
+    # The scores are all the selection needs, so a volume file's handles are closed here
     number_of_images = len(file_paths)
+    close_sources(file_paths)
+    average_difference_array = np.array(difference_scores)
 
-    # Score each image
-    average_difference_array = np.array(average_pixel_difference_calc(avg_img, file_paths))
+    # The extremum radius of every slice makes the extrema at any order a lookup
+    with stage("extremum_radii") as extrema_stage:
+        radii = extremum_radii(average_difference_array)
+        extrema_stage.add(slices=number_of_images)
 
     # If unentered, prompt the user to enter the starting index of the dataset, only accepting integer values
     if idx_offset is None:
@@ -233,14 +810,12 @@ def training_slice_selector(dataset_path=None, desired_number_of_slices=None, mo
 
                 if desired_number_of_slices == -1:
                     if 'local_extrema' not in locals():
-                        total_extrema, local_extrema = local_extrema_by_mode(average_difference_array, mode, 1,
-                                                                             idx_offset)
+                        total_extrema, local_extrema = extrema_at_order(radii, mode, 1, idx_offset)
                     break
 
                 # Order determines how many points on either side of the local extrema are considered to classify it
                 order = 1
-                total_extrema, local_extrema = local_extrema_by_mode(average_difference_array, mode, order,
-                                                                     idx_offset)
+                total_extrema, local_extrema = extrema_at_order(radii, mode, order, idx_offset)
 
                 if desired_number_of_slices >= number_of_images:
                     print("The dataset is not large enough to select this many slices. Try again.")
@@ -249,16 +824,9 @@ def training_slice_selector(dataset_path=None, desired_number_of_slices=None, mo
                 # If the number of local extrema slices is greater than the number of desired slices, increase the order
                 if total_extrema > desired_number_of_slices:
 
-                    # Start at the highest order possible and work down
-                    order = math.floor(number_of_images / 2)
-                    total_extrema, local_extrema = local_extrema_by_mode(average_difference_array, mode, order,
-                                                                         idx_offset)
-
-                    # Loop ends when the order is the largest possible to give desired results
-                    while total_extrema < desired_number_of_slices and order >= 1:
-                        order -= 1
-                        total_extrema, local_extrema = local_extrema_by_mode(average_difference_array, mode, order,
-                                                                             idx_offset)
+                    # The largest order possible to give desired results
+                    order = order_for_slice_count(radii, mode, desired_number_of_slices, number_of_images)
+                    total_extrema, local_extrema = extrema_at_order(radii, mode, order, idx_offset)
 
                     # Inform the user how many images were requested and how many were identified by the closest order
                     print(f"Order to select a minimum of {desired_number_of_slices} training image slices: {order}")
@@ -277,51 +845,114 @@ def training_slice_selector(dataset_path=None, desired_number_of_slices=None, mo
                 print("Invalid input. Please enter an integer.")
 
     else:
-        # Order determines how many points on either side of the local extrema are considered to classify it as such
-        order = 1
-        total_extrema, local_extrema = local_extrema_by_mode(average_difference_array, mode, order, idx_offset)
-
-        # If the number of local extrema slices is greater than the number of desired slices, increase the order
-        if total_extrema > desired_number_of_slices:
-
-            # Start at the highest order possible and work down
-            order = math.floor(number_of_images / 2)
-            total_extrema, local_extrema = local_extrema_by_mode(average_difference_array, mode, order,
-                                                                 idx_offset)
-
-            # Loop ends when the order is the largest possible to give desired results
-            while total_extrema < desired_number_of_slices and order >= 1:
-                order -= 1
-                total_extrema, local_extrema = local_extrema_by_mode(average_difference_array, mode, order,
-                                                                     idx_offset)
-
-        # If the number of extrema slices returned at order 1 is less than desired, inform the user
-        else:
-            print(f"To select {desired_number_of_slices} slices for training data, "
-                  f"please provide more data or change mode.")
+        with stage("extrema_search"):
+            total_extrema, local_extrema = select_training_slices(radii, mode, desired_number_of_slices,
+                                                                  number_of_images, idx_offset)
 
     slices = np.arange(idx_offset, idx_offset+number_of_images)
     average_difference_array = np.column_stack((slices, average_difference_array))
 
     return local_extrema, average_difference_array
 
-def main():
-    """Intended future features are changing the difference scoring method and having the option to export the
-    identified training data to a new directory"""
-
-    # Input the dataset path, enter None if you wish to browse for the directory (None by default)
-    folder_path = None
-
-    # Number of training image slices you want identified from the dataset, enter None to be prompted (None by default)
-    training_data_quantity = None
+def selection_rows(local_extrema, average_difference_array):
+    """
+    Lists the selected training slices with their difference scores.
+    :param local_extrema: Dictionary with max and or min keys holding the selected slice numbers
+    :param average_difference_array: (slice number, score) array from training_slice_selector
+    :return: List of dictionaries with the SELECTION_COLUMNS keys, in slice order
+    """
+    scores = dict(zip(average_difference_array[:, 0].astype(int).tolist(), average_difference_array[:, 1].tolist()))
 
-    # Enter the index of the first image in the dataset, enter None to be prompted (0 by default)
-    starting_index = None
+    rows = [{"slice": int(slice_number), "extremum": extremum, "score": scores[int(slice_number)]}
+            for extremum, slice_numbers in local_extrema.items() for slice_number in slice_numbers]
 
-    local_extrema, avg_diff_array = training_slice_selector(folder_path, training_data_quantity, mode="both",
-                                                            idx_offset=starting_index)
+    return sorted(rows, key=lambda row: row["slice"])
 
-    print(f"Final Slice Selection: {local_extrema}")
+def main(argv=None):
+    """
+    Command line entry point, run with python -m Source.Tools.training_data_selector --help for the options. The
+    dataset folder is browsed for and the number of slices prompted for when they aren't given, otherwise it runs
+    without a display. Intended future features are changing the difference scoring method and having the option to
+    export the identified training data to a new directory.
+    :param argv: Optional list of the command line arguments, None for sys.argv
+    """
+    parser = argparse.ArgumentParser(description="Select training slices from the local extrema of each slice's "
+                                                 "difference to the average image.")
+    parser.add_argument("dataset", nargs="?", default=None,
+                        help="image stack folder or volume file, browsed for if unset")
+    parser.add_argument("--slices", type=int, default=None,
+                        help="number of training slices to select, prompted for if unset")
+    parser.add_argument("--index", default=None,
+                        help="dataset index file, so the dataset can be given as a query matching one indexed folder")
+    parser.add_argument("--mode", choices=("max", "min", "both", "diverse"), default="both",
+                        help="select the most unique slices, the least unique, a combination of the two, or slices "
+                             "spread out in a PCA embedding of the dataset")
+    parser.add_argument("--index-offset", type=int, default=0, help="index the dataset begins numbering at")
+    parser.add_argument("--cache-dir", default=None, help="volume cache folder to keep the decoded dataset in")
+    parser.add_argument("--single-decode", action="store_true", help="decode each image only once")
+    parser.add_argument("--scratch-dir", default=None, help="folder for the single decode scratch volume")
+    parser.add_argument("--result-cache", default=None,
+                        help="result cache folder keeping the scores between runs so reruns only decode changed slices")
+    parser.add_argument("--trim-outliers", type=int, default=0,
+                        help="number of the most different images to leave out of the average image")
+    parser.add_argument("--outliers-per-round", type=int, default=None,
+                        help=f"number of outliers trimmed before the scores are updated, each round re-reads the "
+                             f"scratch volume, so 1 matches trimming one at a time but reads it once per outlier "
+                             f"({DEFAULT_OUTLIER_ROUNDS} rounds if unset)")
+    parser.add_argument("--downsample", type=int, default=None,
+                        help="mean pool the images by this factor before averaging and scoring, 1 if unset (4 for the "
+                             "diverse mode)")
+    parser.add_argument("--agreement-sample", type=int, default=None,
+                        help="before selecting, compare the downsampled and full resolution selections on this many "
+                             "slices and print the agreement report")
+    parser.add_argument("--read-ahead", type=int, default=None,
+                        help="number of images decoded ahead of the averaging and scoring, two per core if unset")
+    parser.add_argument("--instrument", default=None,
+                        help="write a JSON report of each stage's time, throughput and memory to this file")
+    parser.add_argument("--profile-dir", default=None, help="with --instrument, write a cProfile dump of each stage")
+    parser.add_argument("--plot", action="store_true", help="plot the difference scores once the slices are selected")
+    parser.add_argument("--output", default=None, help=".csv or .json file to write the selection to, stdout if unset")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, default=None,
+                        help="format of the selection, by default the output file's extension or JSON on stdout")
+    args = parser.parse_args(argv)
+
+    if args.instrument is not None:
+        configure(args.instrument, args.profile_dir)
+
+    # Progress messages go to stderr so the selection on stdout can be piped
+    with contextlib.redirect_stdout(sys.stderr):
+        if args.index is not None:
+            # Imported here since the index reuses this module's image extensions
+            from Source.Tools.dataset_index import resolve_dataset_argument
+
+            args.dataset = resolve_dataset_argument(args.dataset, args.index)
+
+        if args.agreement_sample is not None:
+            if args.dataset is None or args.slices is None:
+                raise ValueError("The agreement report needs the dataset and the number of slices")
+            if args.mode == "diverse":
+                raise ValueError("The agreement report compares extrema selections, leave out --agreement-sample or "
+                                 "choose the max, min or both mode")
+
+            report = downsampling_agreement(args.dataset, args.downsample or 1, args.slices, args.mode,
+                                            args.agreement_sample)
+            print(json.dumps(report, indent=2))
+
+        prefetch = Prefetch(args.read_ahead)
+        local_extrema, avg_diff_array = training_slice_selector(args.dataset, args.slices, args.mode,
+                                                                args.index_offset, args.cache_dir, args.single_decode,
+                                                                args.scratch_dir, args.downsample, args.trim_outliers,
+                                                                args.result_cache, prefetch, args.outliers_per_round)
+        print(f"Final Slice Selection: {local_extrema}")
+
+        # Shows whether the run was held back by reading the images or by the scoring
+        if prefetch.items:
+            print(prefetch.summary())
+
+        if args.plot:
+            img_diff_plot(avg_diff_array[:, 1], args.index_offset)
+
+    write_records(selection_rows(local_extrema, avg_diff_array), SELECTION_COLUMNS, args.output, args.format)
 
 if __name__ == '__main__':
     main()
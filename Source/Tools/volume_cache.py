@@ -0,0 +1,166 @@
+import hashlib
+import io
+import json
+import os
+import time
+import uuid
+
+import numpy as np
+
+from Source.Tools.image_io import decode_into, read_image
+
+# Largest total size of the cached volumes before the least recently used ones are deleted
+DEFAULT_MAX_CACHE_BYTES = 64 * 1073741824
+
+CACHE_VERSION = 1
+
+
+def volume_cache_key(file_paths):
+    """
+    Identifies an image stack by the path, size and modification time of each of its files, so any change to the stack
+    results in a new key.
+    :param file_paths: List of paths to the images of the stack, in stacking order
+    :return: Hexadecimal key string
+    """
+    file_keys = []
+    for file_path in file_paths:
+        file_stat = os.stat(file_path)
+        file_keys.append([os.path.abspath(file_path), file_stat.st_size, file_stat.st_mtime_ns])
+
+    key_source = json.dumps({"version": CACHE_VERSION, "files": file_keys})
+
+    return hashlib.sha256(key_source.encode()).hexdigest()
+
+
+def npy_file_bytes(shape, dtype):
+    """
+    :param shape: Shape of a volume
+    :param dtype: Data type of the volume
+    :return: Size in bytes of the .npy file holding the volume, header included, the same as its cache entry's size
+    """
+    header = io.BytesIO()
+    np.lib.format.write_array_header_1_0(header, {"descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                                                  "fortran_order": False, "shape": tuple(shape)})
+
+    return header.tell() + int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+
+def cache_entries(cache_dir):
+    """
+    Lists the volumes stored in a cache folder.
+    :param cache_dir: Path to the cache folder
+    :return: List of (last access time, size in bytes, key) tuples, least recently used first
+    """
+    entries = []
+
+    if not os.path.isdir(cache_dir):
+        return entries
+
+    for file_name in os.listdir(cache_dir):
+        if not file_name.endswith(".json"):
+            continue
+
+        key = file_name[:-len(".json")]
+        volume_path = os.path.join(cache_dir, key + ".npy")
+        if not os.path.isfile(volume_path):
+            continue
+
+        # The sidecar's modification time is refreshed on every cache hit to track the last access
+        last_access = os.path.getmtime(os.path.join(cache_dir, file_name))
+        entries.append((last_access, os.path.getsize(volume_path), key))
+
+    return sorted(entries)
+
+
+def evict_volume_cache(cache_dir, max_cache_bytes=DEFAULT_MAX_CACHE_BYTES, incoming_bytes=0):
+    """
+    Deletes the least recently used volumes until the cache and an incoming volume fit in the size limit.
+    :param cache_dir: Path to the cache folder
+    :param max_cache_bytes: Largest total size of the cached volumes
+    :param incoming_bytes: Size of the .npy file of a volume about to be added to the cache (see npy_file_bytes)
+    :return: List of the evicted keys
+    """
+    entries = cache_entries(cache_dir)
+    cache_size = sum(size for _, size, _ in entries)
+    evicted = []
+
+    for _, size, key in entries:
+        if cache_size + incoming_bytes <= max_cache_bytes:
+            break
+
+        for extension in (".json", ".npy"):
+            try:
+                os.remove(os.path.join(cache_dir, key + extension))
+            except FileNotFoundError:
+                pass
+
+        cache_size -= size
+        evicted.append(key)
+
+    return evicted
+
+
+def cached_volume(file_paths, cache_dir, max_cache_bytes=DEFAULT_MAX_CACHE_BYTES, workers=None):
+    """
+    Loads an image stack as a read-only memory-mapped (slices, rows, columns) volume from an on-disk cache. The first
+    load decodes the images straight into a .npy file with a small JSON metadata sidecar, later loads only map it.
+    :param file_paths: List of paths to images of identical size, in stacking order
+    :param cache_dir: Path to the cache folder, created if it doesn't exist
+    :param max_cache_bytes: Largest total size of the cached volumes, least recently used volumes are evicted first
+    :param workers: Number of threads decoding the images on a cache miss, None for one per core
+    :return: Memory-mapped image volume, or an in-memory volume if it's too large to ever fit in the cache
+    """
+    if not file_paths:
+        raise ValueError("No images to stack")
+
+    key = volume_cache_key(file_paths)
+    volume_path = os.path.join(cache_dir, key + ".npy")
+    metadata_path = os.path.join(cache_dir, key + ".json")
+
+    if os.path.isfile(volume_path) and os.path.isfile(metadata_path):
+        os.utime(metadata_path)
+        return np.load(volume_path, mmap_mode="r")
+
+    first_image = read_image(file_paths[0])
+    volume_shape = (len(file_paths),) + first_image.shape
+    volume_bytes = int(np.prod(volume_shape)) * first_image.dtype.itemsize
+
+    # Cached volumes are sized by their files, so the incoming one is too
+    file_bytes = npy_file_bytes(volume_shape, first_image.dtype)
+
+    if file_bytes > max_cache_bytes:
+        print(f"Warning: volume of {volume_bytes / 1073741824: .2f} GB is larger than the cache limit and was not "
+              f"cached.")
+        volume = np.empty(volume_shape, dtype=first_image.dtype)
+        volume[0] = first_image
+        decode_into(file_paths[1:], volume[1:], 0, workers)
+        return volume
+
+    os.makedirs(cache_dir, exist_ok=True)
+    evict_volume_cache(cache_dir, max_cache_bytes, file_bytes)
+
+    # Decodes into a temporary file that is only renamed once it's complete, so interrupted runs never leave a
+    # partial volume behind under a valid key
+    temporary_path = os.path.join(cache_dir, f"{key}.{uuid.uuid4().hex}.tmp.npy")
+    try:
+        volume = np.lib.format.open_memmap(temporary_path, mode="w+", dtype=first_image.dtype, shape=volume_shape)
+        volume[0] = first_image
+        decode_into(file_paths[1:], volume[1:], 0, workers)
+        volume.flush()
+        del volume
+        os.replace(temporary_path, volume_path)
+    finally:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+    metadata = {"version": CACHE_VERSION,
+                "folder": os.path.dirname(os.path.abspath(file_paths[0])),
+                "files": len(file_paths),
+                "shape": list(volume_shape),
+                "dtype": first_image.dtype.str,
+                "bytes": volume_bytes,
+                "created": time.time()}
+    with open(metadata_path, "w") as metadata_file:
+        json.dump(metadata, metadata_file, indent=2)
+
+    return np.load(volume_path, mmap_mode="r")
@@ -0,0 +1,379 @@
+import os
+import threading
+
+import numpy as np
+from PIL import Image
+
+from Source.Tools.image_io import map_ordered, read_image, read_image_region, stack_images
+from Source.Tools.raw_volume import is_raw_volume, open_raw_stack
+
+# Extensions of single files holding every slice of a volume as the pages of a (Big)TIFF
+MULTI_PAGE_EXTENSIONS = (".tif", ".tiff")
+
+# Data types of the uncompressed TIFF raw modes that can be mapped straight from the file
+RAW_MODE_DTYPES = {"L": "u1", "I;8": "u1", "I;16": "<u2", "I;16B": ">u2", "I;16N": "=u2", "I;32": "<i4",
+                   "I;32B": ">i4", "I;32N": "=i4", "F;32F": "<f4", "F;32BF": ">f4"}
+
+
+class VolumeSource:
+    """
+    Lazy, random access to the slices of a volume stored as an image stack folder, a multi-page TIFF or a raw file.
+    Slices are (rows, columns) arrays and slabs are (slices, rows, columns) arrays.
+    """
+
+    def __init__(self, path, number_of_slices, slice_shape, dtype):
+        self.path = path
+        self.number_of_slices = number_of_slices
+        self.slice_shape = tuple(slice_shape)
+        self.dtype = np.dtype(dtype)
+
+    @property
+    def shape(self):
+        return (self.number_of_slices,) + self.slice_shape
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def __len__(self):
+        return self.number_of_slices
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Closes the file handles the source keeps open between reads. Reading the source again reopens them.
+        """
+
+    def read(self, index):
+        """
+        :param index: Index of the slice
+        :return: The slice as an array
+        """
+        raise NotImplementedError
+
+    def read_region(self, index, rows, columns):
+        """
+        Reads the part of a slice inside a box, only decoding what the storage format allows.
+        :param index: Index of the slice
+        :param rows: (first row, last row + 1) of the box
+        :param columns: (first column, last column + 1) of the box
+        :return: The box of the slice as an array
+        """
+        return self.read(index)[rows[0]:rows[1], columns[0]:columns[1]]
+
+    def read_slab(self, start, stop, workers=None):
+        """
+        Reads consecutive slices, decoding them concurrently on a thread pool.
+        :param start: Index of the first slice
+        :param stop: Index after the last slice
+        :param workers: Number of threads, None for one per core
+        :return: (slices, rows, columns) array
+        """
+        stop = min(stop, self.number_of_slices)
+        slab = np.empty((max(stop - start, 0),) + self.slice_shape, dtype=self.dtype)
+
+        for i, slice_array in enumerate(map_ordered(self.read, range(start, stop), workers)):
+            slab[i] = slice_array
+
+        return slab
+
+    def map_slices(self, function, workers=None, dtype=None, prefetch=None):
+        """
+        Reads every slice on a thread pool and applies a function to each of them, yielding the results in order.
+        :param function: Function applied to each slice array in the worker thread
+        :param workers: Number of threads, None for one per core
+        :param dtype: Optional data type to convert the intensity values to
+        :param prefetch: Optional Prefetch setting the read-ahead depth and recording how long the consumer waited
+        :return: Generator of the function results in slice order
+        """
+        def read_slice(index):
+            slice_array = self.read(index)
+            return function(slice_array if dtype is None else slice_array.astype(dtype))
+
+        return map_ordered(read_slice, range(self.number_of_slices), workers, prefetch)
+
+    def total_file_size(self):
+        """
+        :return: Size in bytes of the files holding the volume
+        """
+        return os.path.getsize(self.path)
+
+    def subset(self, start, stop):
+        """
+        :param start: Index of the first slice
+        :param stop: Index after the last slice
+        :return: VolumeSource of the consecutive slices from start to stop
+        """
+        return SliceRangeSource(self, start, stop)
+
+
+class FolderSource(VolumeSource):
+    """
+    Volume stored as one image file per slice.
+    """
+
+    def __init__(self, file_paths, path=None):
+        if not file_paths:
+            raise ValueError("No images to stack")
+
+        self.file_paths = list(file_paths)
+        first_image = read_image(self.file_paths[0])
+        super().__init__(path or os.path.dirname(self.file_paths[0]), len(self.file_paths), first_image.shape,
+                         first_image.dtype)
+
+    def read(self, index):
+        return read_image(self.file_paths[index])
+
+    def read_region(self, index, rows, columns):
+        return read_image_region(self.file_paths[index], rows, columns)
+
+    def read_slab(self, start, stop, workers=None):
+        return stack_images(self.file_paths[start:stop], z_axis=0, workers=workers)
+
+    def total_file_size(self):
+        return sum(os.path.getsize(file_path) for file_path in self.file_paths)
+
+
+class ArraySource(VolumeSource):
+    """
+    Volume already held in a (slices, rows, columns) array or memmap, such as a raw file or a cached volume.
+    """
+
+    def __init__(self, volume, path=None):
+        self.volume = volume
+        super().__init__(path, volume.shape[0], volume.shape[1:], volume.dtype)
+
+    def read(self, index):
+        return np.asarray(self.volume[index])
+
+    def read_region(self, index, rows, columns):
+        return np.asarray(self.volume[index, rows[0]:rows[1], columns[0]:columns[1]])
+
+    def read_slab(self, start, stop, workers=None):
+        return self.volume[start:stop]
+
+
+class SliceRangeSource(VolumeSource):
+    """
+    Consecutive slices of another volume source.
+    """
+
+    def __init__(self, source, start, stop):
+        self.source = source
+        self.start = max(start, 0)
+        stop = min(stop, len(source))
+        super().__init__(source.path, max(stop - self.start, 0), source.slice_shape, source.dtype)
+
+    def read(self, index):
+        if not 0 <= index < self.number_of_slices:
+            raise IndexError(f"Slice {index} is out of range for {self.number_of_slices} slices")
+        return self.source.read(self.start + index)
+
+    def read_region(self, index, rows, columns):
+        if not 0 <= index < self.number_of_slices:
+            raise IndexError(f"Slice {index} is out of range for {self.number_of_slices} slices")
+        return self.source.read_region(self.start + index, rows, columns)
+
+    def read_slab(self, start, stop, workers=None):
+        stop = min(stop, self.number_of_slices)
+        return self.source.read_slab(self.start + start, self.start + stop, workers)
+
+    def total_file_size(self):
+        return self.source.total_file_size() * self.number_of_slices // max(len(self.source), 1)
+
+
+class MultiPageTiffSource(VolumeSource):
+    """
+    Volume stored as the pages of a single multi-page TIFF or BigTIFF. The page directory is indexed once when the
+    file is opened. Uncompressed pages stored contiguously are mapped straight from the file, other pages are decoded
+    with Pillow, each thread keeping its own file handle so pages can be read concurrently. The handles stay open until
+    the source is closed.
+    """
+
+    def __init__(self, file_path):
+        self._handles = {}
+        self._handles_lock = threading.Lock()
+        self._page_offsets = []
+
+        with Image.open(file_path) as img:
+            number_of_pages = getattr(img, "n_frames", 1)
+            slice_shape = (img.size[1], img.size[0])
+
+            # Pillow forgets where a page is stored once it has been decoded, so the first page is decoded from a
+            # separate handle to find the data type before the page directory is indexed
+            with Image.open(file_path) as first_page:
+                dtype = read_image_page(first_page, 0).dtype
+
+            for page in range(number_of_pages):
+                img.seek(page)
+                if (img.size[1], img.size[0]) != slice_shape:
+                    raise ValueError(f"Page {page} of '{file_path}' does not match the size of the first page")
+                self._page_offsets.append(contiguous_page_offset(img, dtype))
+
+        super().__init__(file_path, number_of_pages, slice_shape, dtype)
+
+        self._memory_mapped = all(offset is not None for offset in self._page_offsets)
+        self._file_map = None
+
+    @property
+    def is_memory_mapped(self):
+        """
+        :return: True if the pages are mapped straight from the file rather than decoded
+        """
+        return self._memory_mapped
+
+    def close(self):
+        with self._handles_lock:
+            handles, self._handles = list(self._handles.values()), {}
+        for img in handles:
+            img.close()
+
+        # Pages already read keep the mapping alive until they are released
+        self._file_map = None
+
+    def read(self, index):
+        if not 0 <= index < self.number_of_slices:
+            raise IndexError(f"Page {index} is out of range for {self.number_of_slices} pages")
+
+        if self._memory_mapped:
+            return self._mapped_page(index, (0, self.slice_shape[0]), (0, self.slice_shape[1]))
+
+        # A thread's handle is only reused by a later thread given the same identifier once the first one has ended
+        thread = threading.get_ident()
+        img = self._handles.get(thread)
+        if img is None:
+            img = Image.open(self.path)
+            with self._handles_lock:
+                self._handles[thread] = img
+
+        return read_image_page(img, index)
+
+    def read_region(self, index, rows, columns):
+        if not self._memory_mapped or not 0 <= index < self.number_of_slices:
+            return super().read_region(index, rows, columns)
+
+        return self._mapped_page(index, rows, columns)
+
+    def _mapped_page(self, index, rows, columns):
+        """
+        Views a box of a page mapped from the file, converting only the box if the file's byte order differs.
+        """
+        file_map = self._file_map
+        if file_map is None:
+            file_map = self._file_map = np.memmap(self.path, dtype=np.uint8, mode="r")
+
+        page_dtype = self._page_offsets[index][1]
+        page = np.ndarray(self.slice_shape, dtype=page_dtype, buffer=file_map,
+                          offset=self._page_offsets[index][0])[rows[0]:rows[1], columns[0]:columns[1]]
+        return page.astype(self.dtype, copy=False) if page_dtype != self.dtype else page
+
+
+def read_image_page(img, page):
+    """
+    Decodes one page of an open multi-page image.
+    :param img: Open Pillow image
+    :param page: Index of the page
+    :return: The page as an array
+    """
+    img.seek(page)
+    return np.array(img)
+
+
+def contiguous_page_offset(img, dtype):
+    """
+    Checks whether the current page of an open TIFF is stored uncompressed in one contiguous run of bytes.
+    :param img: Open Pillow TIFF image, seeked to the page
+    :param dtype: Data type of the decoded page
+    :return: (byte offset, stored data type) of the page, or None if it has to be decoded
+    """
+    tiles = sorted(img.tile, key=lambda tile: tile[1][1])
+    width, height = img.size
+
+    if not tiles or any(tile[0] != "raw" for tile in tiles):
+        return None
+
+    raw_mode = tiles[0][3][0]
+    if raw_mode not in RAW_MODE_DTYPES or any(tile[3][0] != raw_mode for tile in tiles):
+        return None
+
+    stored_dtype = np.dtype(RAW_MODE_DTYPES[raw_mode])
+    if stored_dtype.kind != dtype.kind or stored_dtype.itemsize != dtype.itemsize:
+        return None
+
+    row_bytes = width * stored_dtype.itemsize
+    expected_offset = tiles[0][2]
+    expected_row = 0
+
+    for _, extents, offset, args in tiles:
+        stride = args[1] if len(args) > 1 else 0
+        orientation = args[2] if len(args) > 2 else 1
+
+        # Every strip must span the full width, follow the previous one directly and be stored top to bottom
+        if extents != (0, expected_row, width, extents[3]) or offset != expected_offset or \
+                stride not in (0, row_bytes) or orientation != 1:
+            return None
+
+        expected_row = extents[3]
+        expected_offset = offset + (extents[3] - extents[1]) * row_bytes
+
+    if expected_row != height:
+        return None
+
+    return tiles[0][2], stored_dtype
+
+
+def is_volume_file(path):
+    """
+    :param path: Path to a file or folder
+    :return: True if the path is a single file holding a whole volume (multi-page TIFF or raw volume)
+    """
+    if is_raw_volume(path):
+        return True
+
+    if not os.path.isfile(path) or not os.fspath(path).lower().endswith(MULTI_PAGE_EXTENSIONS):
+        return False
+
+    # A TIFF is animated when its first page directory links to another, the same as n_frames > 1 without walking
+    # every page directory of a long BigTIFF
+    try:
+        with Image.open(path) as img:
+            return getattr(img, "is_animated", False)
+    except OSError:
+        return False
+
+
+def close_sources(*sources):
+    """
+    Closes the VolumeSources of datasets once a tool is done with them.
+    :param sources: VolumeSources, or lists of file paths and None which are left as they are
+    """
+    for source in sources:
+        if isinstance(source, VolumeSource):
+            source.close()
+
+
+def open_volume_source(path, file_paths=None):
+    """
+    Opens a volume for lazy slice access, whatever way it is stored.
+    :param path: Path to an image stack folder, a multi-page TIFF or BigTIFF, or a raw volume file
+    :param file_paths: Optional list of the image files of a folder, in stacking order (sorted file names by default)
+    :return: VolumeSource of the volume
+    """
+    if file_paths is not None:
+        return FolderSource(file_paths, path)
+
+    if is_raw_volume(path):
+        return ArraySource(open_raw_stack(path), path)
+
+    if is_volume_file(path):
+        return MultiPageTiffSource(path)
+
+    if os.path.isdir(path):
+        return FolderSource([os.path.join(path, file_name) for file_name in sorted(os.listdir(path))], path)
+
+    raise ValueError(f"Provided path is neither an image stack folder nor a volume file: {path}")
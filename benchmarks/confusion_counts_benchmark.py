@@ -0,0 +1,93 @@
+import os
+import sys
+import time
+
+import numpy as np
+from sklearn.metrics import confusion_matrix
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from Source.Tools.confusion_matrix_stats_calculator import binary_confusion_counts
+
+
+def sklearn_confusion_counts(ground_truth, predicted, pos_label, roi_voxels=None):
+    """
+    The original counting path: flattens the volumes, copies the ROI voxels and passes them to sklearn.
+    :return: tn, fp, fn, tp counts
+    """
+    if roi_voxels is not None:
+        roi_mask_flat = roi_voxels.flatten()
+        ground_truth_flat = ground_truth.flatten()[roi_mask_flat]
+        predicted_flat = predicted.flatten()[roi_mask_flat]
+    else:
+        ground_truth_flat = ground_truth.flatten()
+        predicted_flat = predicted.flatten()
+
+    return confusion_matrix(ground_truth_flat, predicted_flat, labels=[0, pos_label]).ravel()
+
+
+def best_time(function, repeats, *args):
+    """
+    Times a function call several times and keeps the fastest run.
+    :return: the fastest wall time in seconds and the result of the last call
+    """
+    fastest = np.inf
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function(*args)
+        fastest = min(fastest, time.perf_counter() - start)
+    return fastest, result
+
+
+def benchmark_confusion_counts(shape=(512, 512, 64), pos_label=255, error_rate=0.05, roi_fraction=0.7, repeats=3,
+                               seed=0):
+    """
+    Compares the sklearn counting path against binary_confusion_counts on a random binary volume pair.
+    :param shape: Shape of the synthetic volumes
+    :param pos_label: The greyscale integer value considered to be positive
+    :param error_rate: Fraction of predicted voxels flipped relative to the ground truth
+    :param roi_fraction: Fraction of voxels inside the ROI mask, None to benchmark without a mask
+    :param repeats: Number of timed runs per method, the fastest is reported
+    :param seed: Random seed of the synthetic volumes
+    :return: Dictionary of timings in seconds and voxel throughputs
+    """
+    rng = np.random.default_rng(seed)
+    ground_truth = np.where(rng.random(shape) < 0.5, pos_label, 0).astype(np.uint8)
+    predicted = np.where(rng.random(shape) < error_rate, pos_label - ground_truth, ground_truth).astype(np.uint8)
+    roi_voxels = rng.random(shape) < roi_fraction if roi_fraction is not None else None
+
+    sklearn_time, sklearn_counts = best_time(sklearn_confusion_counts, repeats, ground_truth, predicted, pos_label,
+                                             roi_voxels)
+    kernel_time, kernel_counts = best_time(binary_confusion_counts, repeats, ground_truth, predicted, pos_label,
+                                           roi_voxels)
+
+    if tuple(sklearn_counts) != tuple(kernel_counts[:4]):
+        raise ValueError(f"Counts differ: sklearn {sklearn_counts}, kernel {kernel_counts[:4]}")
+
+    voxels = ground_truth.size
+    return {"voxels": voxels,
+            "sklearn_seconds": sklearn_time,
+            "kernel_seconds": kernel_time,
+            "sklearn_voxels_per_second": voxels / sklearn_time,
+            "kernel_voxels_per_second": voxels / kernel_time,
+            "speedup": sklearn_time / kernel_time}
+
+
+def main():
+    """
+    Runs the comparison with and without an ROI mask, adjust the shape to match the volumes you work with.
+    """
+    shape = (512, 512, 64)
+
+    for roi_fraction in (None, 0.7):
+        results = benchmark_confusion_counts(shape, roi_fraction=roi_fraction)
+        print(f"ROI fraction: {roi_fraction}")
+        print(f"sklearn confusion_matrix: {results['sklearn_seconds']:.3f} s "
+              f"({results['sklearn_voxels_per_second'] / 1e6:.1f} Mvoxel/s)")
+        print(f"binary_confusion_counts: {results['kernel_seconds']:.3f} s "
+              f"({results['kernel_voxels_per_second'] / 1e6:.1f} Mvoxel/s)")
+        print(f"Speedup: {results['speedup']:.1f}x\n")
+
+
+if __name__ == '__main__':
+    main()
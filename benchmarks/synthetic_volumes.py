@@ -0,0 +1,123 @@
+import json
+import os
+
+import numpy as np
+from PIL import Image
+
+
+def positive_label(dtype):
+    """
+    :param dtype: Integer data type of a segmentation volume
+    :return: The greyscale value of the positive voxels, the largest value of the type
+    """
+    return int(np.iinfo(dtype).max)
+
+
+def scan_slice(index, slice_shape, dtype=np.uint8, seed=0):
+    """
+    Generates one slice of a synthetic greyscale scan: a gradient that drifts from slice to slice plus noise, so the
+    difference scores of neighbouring slices have local extrema like a real serial dataset.
+    :param index: Index of the slice
+    :param slice_shape: (rows, columns) of the slice
+    :param dtype: Integer data type of the slice
+    :param seed: Random seed of the volume, each slice is reproducible on its own
+    :return: 2D array of the slice
+    """
+    rng = np.random.default_rng([seed, index])
+    max_value = positive_label(dtype)
+
+    rows, columns = np.indices(slice_shape, dtype=np.float32)
+    drift = 0.5 + 0.25 * np.sin(index / 7.0)
+    image = drift * (rows / slice_shape[0] + columns / slice_shape[1]) / 2 + rng.normal(0, 0.05, slice_shape)
+
+    return (np.clip(image, 0, 1) * max_value).astype(dtype)
+
+
+def segmentation_slices(index, slice_shape, dtype=np.uint8, error_rate=0.05, roi_fraction=0.7, seed=0):
+    """
+    Generates one slice of a synthetic ground truth, a prediction with a given fraction of its voxels flipped, and an
+    ROI mask.
+    :param index: Index of the slice
+    :param slice_shape: (rows, columns) of the slice
+    :param dtype: Integer data type of the slices, the positive label is the largest value of the type
+    :param error_rate: Fraction of predicted voxels flipped relative to the ground truth
+    :param roi_fraction: Fraction of voxels inside the ROI mask
+    :param seed: Random seed of the volume, each slice is reproducible on its own
+    :return: ground truth, predicted and ROI mask slices
+    """
+    rng = np.random.default_rng([seed, index])
+    pos_label = positive_label(dtype)
+
+    ground_truth = np.where(rng.random(slice_shape) < 0.5, pos_label, 0).astype(dtype)
+    predicted = np.where(rng.random(slice_shape) < error_rate, pos_label - ground_truth, ground_truth).astype(dtype)
+    roi_mask = np.where(rng.random(slice_shape) < roi_fraction, pos_label, 0).astype(dtype)
+
+    return ground_truth, predicted, roi_mask
+
+
+def write_tiff_stack(folder_path, slices):
+    """
+    Saves slices as a folder of numbered TIFF images.
+    :param folder_path: Path to the folder to create
+    :param slices: Iterable of 2D arrays
+    :return: The folder path
+    """
+    os.makedirs(folder_path, exist_ok=True)
+    for i, image_array in enumerate(slices):
+        Image.fromarray(image_array).save(os.path.join(folder_path, f"slice_{i:05d}.tiff"))
+    return folder_path
+
+
+def write_raw_volume(file_path, slices, number_of_slices):
+    """
+    Saves slices as a headerless raw volume with a JSON sidecar describing its shape and type.
+    :param file_path: Path to the .raw file to create
+    :param slices: Iterable of 2D arrays of identical size and type
+    :param number_of_slices: Number of slices in the iterable
+    :return: The file path
+    """
+    slice_shape = None
+    dtype = None
+
+    with open(file_path, "wb") as raw_file:
+        for image_array in slices:
+            slice_shape, dtype = image_array.shape, image_array.dtype
+            raw_file.write(np.ascontiguousarray(image_array).tobytes())
+
+    with open(file_path + ".json", "w") as sidecar:
+        json.dump({"shape": [number_of_slices, *slice_shape], "dtype": dtype.name, "header_bytes": 0}, sidecar)
+
+    return file_path
+
+
+def generate_datasets(output_dir, shape=(64, 512, 512), dtype=np.uint8, error_rate=0.05, roi_fraction=0.7, seed=0):
+    """
+    Writes a synthetic scan and segmentation datasets as TIFF stacks, plus the scan and ground truth as raw volumes.
+    Slices are generated one at a time so volumes larger than memory can be written.
+    :param output_dir: Folder to write the datasets to
+    :param shape: (slices, rows, columns) of the volumes
+    :param dtype: Integer data type of the volumes
+    :param error_rate: Fraction of predicted voxels flipped relative to the ground truth
+    :param roi_fraction: Fraction of voxels inside the ROI mask
+    :param seed: Random seed of the volumes
+    :return: Dictionary of the dataset paths keyed by "scan", "ground_truth", "predicted", "roi_mask", "scan_raw" and
+             "ground_truth_raw"
+    """
+    number_of_slices, slice_shape = shape[0], tuple(shape[1:])
+    dtype = np.dtype(dtype)
+
+    def scan():
+        return (scan_slice(i, slice_shape, dtype, seed) for i in range(number_of_slices))
+
+    def segmentation(which):
+        return (segmentation_slices(i, slice_shape, dtype, error_rate, roi_fraction, seed)[which]
+                for i in range(number_of_slices))
+
+    os.makedirs(output_dir, exist_ok=True)
+    return {"scan": write_tiff_stack(os.path.join(output_dir, "scan"), scan()),
+            "ground_truth": write_tiff_stack(os.path.join(output_dir, "ground_truth"), segmentation(0)),
+            "predicted": write_tiff_stack(os.path.join(output_dir, "predicted"), segmentation(1)),
+            "roi_mask": write_tiff_stack(os.path.join(output_dir, "roi_mask"), segmentation(2)),
+            "scan_raw": write_raw_volume(os.path.join(output_dir, "scan.raw"), scan(), number_of_slices),
+            "ground_truth_raw": write_raw_volume(os.path.join(output_dir, "ground_truth.raw"), segmentation(0),
+                                                 number_of_slices)}
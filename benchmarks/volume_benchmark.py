@@ -0,0 +1,291 @@
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+from synthetic_volumes import generate_datasets, positive_label
+
+try:
+    import resource
+except ImportError:  # Windows has no resource module, peak memory isn't reported there
+    resource = None
+
+# Number of difference scores the extrema benchmarks search, about the number of slices of a large scan
+DEFAULT_SCORE_LENGTH = 4000
+
+
+def peak_rss_bytes():
+    """
+    :return: Peak resident memory of the current process in bytes, or None where it can't be measured
+    """
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports kilobytes and macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def dataset_bytes(path):
+    """
+    :return: Size in bytes of the files of a dataset folder or volume file
+    """
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, file_name)) for file_name in os.listdir(path))
+    return os.path.getsize(path)
+
+
+def synthetic_scores(config):
+    """
+    :return: Reproducible difference scores for the extrema benchmarks, a drifting signal plus noise
+    """
+    rng = np.random.default_rng(config["seed"])
+    x = np.arange(config["score_length"])
+    return np.sin(x / 25.0) + rng.normal(0, 0.3, config["score_length"])
+
+
+def image_stacker_case(datasets, config, dataset="ground_truth"):
+    from Source.Tools.confusion_matrix_stats_calculator import image_stacker
+
+    return lambda: image_stacker(datasets[dataset]), dataset_bytes(datasets[dataset]), config["shape"][0]
+
+
+def confusion_matrix_statistics_case(datasets, config, roi=False, slab_size=None):
+    from Source.Tools.confusion_matrix_stats_calculator import confusion_matrix_statistics
+
+    paths = [datasets["ground_truth"], datasets["predicted"]] + ([datasets["roi_mask"]] if roi else [])
+    pos_label = positive_label(np.dtype(config["dtype"]))
+
+    def run():
+        return confusion_matrix_statistics(pos_label, roi, False, *paths, slab_size=slab_size)
+
+    return run, sum(dataset_bytes(path) for path in paths), config["shape"][0]
+
+
+def image_list_avg_case(datasets, config):
+    from Source.Tools.training_data_selector import image_list_avg
+
+    return lambda: image_list_avg(datasets["scan"]), dataset_bytes(datasets["scan"]), config["shape"][0]
+
+
+def average_pixel_difference_calc_case(datasets, config):
+    from Source.Tools.training_data_selector import image_list_avg, average_pixel_difference_calc
+
+    # The average image is calculated once outside of the timed call
+    file_paths, avg_img = image_list_avg(datasets["scan"])
+
+    def run():
+        return average_pixel_difference_calc(avg_img, file_paths)
+
+    return run, dataset_bytes(datasets["scan"]), config["shape"][0]
+
+
+def local_extrema_by_mode_case(datasets, config):
+    from Source.Tools.training_data_selector import local_extrema_by_mode
+
+    scores = synthetic_scores(config)
+    return lambda: local_extrema_by_mode(scores, "both", 1), scores.nbytes, len(scores)
+
+
+def order_search_case(datasets, config):
+    from Source.Tools.training_data_selector import extremum_radii, order_for_slice_count
+
+    scores = synthetic_scores(config)
+
+    def run():
+        radii = extremum_radii(scores)
+        return order_for_slice_count(radii, "both", config["desired_number_of_slices"], len(scores))
+
+    return run, scores.nbytes, len(scores)
+
+
+# Benchmark cases, each returns the function to time, the number of input bytes and the number of slices it processes
+CASES = {
+    "image_stacker": image_stacker_case,
+    "image_stacker_raw": lambda datasets, config: image_stacker_case(datasets, config, "ground_truth_raw"),
+    "confusion_matrix_statistics": confusion_matrix_statistics_case,
+    "confusion_matrix_statistics_roi": lambda datasets, config: confusion_matrix_statistics_case(datasets, config,
+                                                                                                 roi=True),
+    "confusion_matrix_statistics_roi_streamed": lambda datasets, config: confusion_matrix_statistics_case(
+        datasets, config, roi=True, slab_size=16),
+    "image_list_avg": image_list_avg_case,
+    "average_pixel_difference_calc": average_pixel_difference_calc_case,
+    "local_extrema_by_mode": local_extrema_by_mode_case,
+    "order_search": order_search_case,
+}
+
+
+def run_case(case_name, datasets, config):
+    """
+    Times one benchmark case, meant to run in a fresh process so its peak memory isn't mixed with other cases.
+    :param case_name: Key of the case in CASES
+    :param datasets: Dictionary of the dataset paths from generate_datasets
+    :param config: Dictionary of the benchmark settings
+    :return: Dictionary of the results of the case
+    """
+    rss_before = peak_rss_bytes()
+    times = []
+
+    # The tools print their statistics and progress bars, which would drown out the report
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        function, input_bytes, slices = CASES[case_name](datasets, config)
+
+        for _ in range(config["repeats"]):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+
+    rss_after = peak_rss_bytes()
+    seconds = min(times)
+
+    return {"seconds": seconds,
+            "median_seconds": float(np.median(times)),
+            "input_bytes": input_bytes,
+            "slices": slices,
+            "mb_per_second": input_bytes / seconds / 1e6,
+            "slices_per_second": slices / seconds,
+            "peak_rss_mb": None if rss_after is None else rss_after / 1e6,
+            "rss_increase_mb": None if rss_after is None else (rss_after - rss_before) / 1e6}
+
+
+def run_benchmarks(datasets, config, case_names=None):
+    """
+    Runs each benchmark case in its own process.
+    :param datasets: Dictionary of the dataset paths from generate_datasets
+    :param config: Dictionary of the benchmark settings
+    :param case_names: Optional list of the cases to run, None for all of them
+    :return: Dictionary of the results keyed by case name, failed cases hold an "error" message
+    """
+    results = {}
+    spawn_context = multiprocessing.get_context("spawn")
+
+    for case_name in case_names or CASES:
+        if case_name not in CASES:
+            raise ValueError(f"Unknown benchmark case '{case_name}', choose from {list(CASES)}")
+
+        with ProcessPoolExecutor(max_workers=1, mp_context=spawn_context) as executor:
+            try:
+                results[case_name] = executor.submit(run_case, case_name, datasets, config).result()
+            except Exception as error:
+                results[case_name] = {"error": f"{type(error).__name__}: {error}"}
+
+        print(format_result(case_name, results[case_name]))
+
+    return results
+
+
+def format_result(case_name, result):
+    """
+    :return: One line summary of a case's result
+    """
+    if "error" in result:
+        return f"{case_name:<42} failed: {result['error']}"
+
+    peak = "n/a" if result["peak_rss_mb"] is None else f"{result['peak_rss_mb']:.0f} MB"
+    return (f"{case_name:<42} {result['seconds']:8.3f} s {result['mb_per_second']:9.1f} MB/s "
+            f"{result['slices_per_second']:9.1f} slices/s   peak RSS {peak}")
+
+
+def compare_results(results, baseline_results, tolerance=0.15, min_seconds=0.01):
+    """
+    Compares benchmark results against a baseline run.
+    :param results: Dictionary of the results keyed by case name
+    :param baseline_results: Dictionary of the baseline results keyed by case name
+    :param tolerance: Allowed fractional increase in time or peak memory before a case counts as a regression
+    :param min_seconds: Slowdowns smaller than this are timer noise and never count as a regression
+    :return: List of (case name, measure, baseline value, new value) for each regression
+    """
+    regressions = []
+
+    for case_name, result in results.items():
+        baseline = baseline_results.get(case_name)
+        if baseline is None or "error" in baseline or "error" in result:
+            continue
+
+        for measure in ("seconds", "peak_rss_mb"):
+            if baseline[measure] is None or result[measure] is None:
+                continue
+            if measure == "seconds" and result[measure] - baseline[measure] < min_seconds:
+                continue
+            if result[measure] > baseline[measure] * (1 + tolerance):
+                regressions.append((case_name, measure, baseline[measure], result[measure]))
+
+    return regressions
+
+
+def main():
+    """
+    Command line entry point, run with python benchmarks/volume_benchmark.py --help for the options.
+    """
+    parser = argparse.ArgumentParser(description="Time and memory-profile the volume tools on synthetic datasets.")
+    parser.add_argument("--shape", type=int, nargs=3, default=(64, 512, 512), metavar=("SLICES", "ROWS", "COLUMNS"),
+                        help="shape of the synthetic volumes")
+    parser.add_argument("--dtype", default="uint8", choices=("uint8", "uint16"), help="data type of the volumes")
+    parser.add_argument("--error-rate", type=float, default=0.05, help="fraction of predicted voxels flipped")
+    parser.add_argument("--roi-fraction", type=float, default=0.7, help="fraction of voxels inside the ROI mask")
+    parser.add_argument("--score-length", type=int, default=DEFAULT_SCORE_LENGTH,
+                        help="number of difference scores in the extrema benchmarks")
+    parser.add_argument("--repeats", type=int, default=3, help="timed runs per case, the fastest is reported")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the synthetic data")
+    parser.add_argument("--cases", nargs="+", default=None, help=f"cases to run, from {list(CASES)}")
+    parser.add_argument("--data-dir", default=None,
+                        help="folder to write the synthetic datasets to and keep them in, a temporary folder if unset")
+    parser.add_argument("--output", default=None, help="JSON file to save the results to")
+    parser.add_argument("--baseline", default=None, help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15,
+                        help="fractional slowdown or memory increase over the baseline reported as a regression")
+    args = parser.parse_args()
+
+    config = {"shape": list(args.shape), "dtype": args.dtype, "error_rate": args.error_rate,
+              "roi_fraction": args.roi_fraction, "score_length": args.score_length,
+              "desired_number_of_slices": max(1, args.score_length // 100), "repeats": args.repeats, "seed": args.seed}
+
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        data_dir = args.data_dir or temporary_dir
+        print(f"Writing synthetic datasets of shape {tuple(args.shape)} {args.dtype} to {data_dir}")
+        datasets = generate_datasets(data_dir, tuple(args.shape), args.dtype, args.error_rate, args.roi_fraction,
+                                     args.seed)
+
+        results = run_benchmarks(datasets, config, args.cases)
+
+    report = {"config": config,
+              "machine": {"platform": platform.platform(), "python": platform.python_version(),
+                          "numpy": np.__version__, "cpu_count": os.cpu_count()},
+              "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "results": results}
+
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+        if baseline.get("config") != config:
+            print("Warning: the baseline was run with different settings, the comparison may not be meaningful.")
+
+        regressions = compare_results(results, baseline["results"], args.tolerance)
+        for case_name, measure, old_value, new_value in regressions:
+            print(f"Regression: {case_name} {measure} {old_value:.3f} -> {new_value:.3f}")
+
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,23 @@
+import math
 import pytest
 import sys
 import os
+import numpy as np
+from PIL import Image
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+from Source.Tools import confusion_matrix_stats_calculator
 from Source.Tools.training_data_selector import get_total_size, collect_file_paths
 
+
+def write_image_stack(folder, volume):
+    # Saves a (slices, rows, columns) array as a folder of numbered TIFF images
+    folder.mkdir()
+    for i, image_array in enumerate(volume):
+        Image.fromarray(image_array).save(folder / f"slice_{i:04d}.tiff")
+    return str(folder)
+
+
 def test_get_total_size(tmp_path, capsys):
     # Create test files with known content
     file1 = tmp_path / "file1.txt"
@@ -95,4 +108,1027 @@ def test_collect_file_paths(tmp_path):
     invalid_path = tmp_path / "file1.wav"
     invalid_path.write_text("dummy")
     with pytest.raises(ValueError):
-        collect_file_paths(str(invalid_path), accepted_extensions=('.txt',))
\ No newline at end of file
+        collect_file_paths(str(invalid_path), accepted_extensions=('.txt',))
+
+def test_binary_confusion_counts():
+    from sklearn.metrics import confusion_matrix
+
+    rng = np.random.default_rng(1)
+    ground_truth = rng.choice([0, 255], size=(20, 15, 6)).astype(np.uint8)
+    predicted = rng.choice([0, 255], size=(20, 15, 6)).astype(np.uint8)
+    roi_voxels = rng.random((20, 15, 6)) < 0.6
+
+    # Voxels that are neither 0 nor the positive label are reported instead of silently dropped
+    predicted[0, :5, 0] = 7
+    ground_truth[1, :3, 0] = 100
+
+    for roi in (None, roi_voxels):
+        selected = np.ones(ground_truth.shape, dtype=bool) if roi is None else roi
+        expected = confusion_matrix(ground_truth[selected], predicted[selected], labels=[0, 255]).ravel()
+        *counts, unlabeled = confusion_matrix_stats_calculator.binary_confusion_counts(ground_truth, predicted, 255,
+                                                                                        roi)
+
+        assert tuple(counts) == tuple(expected)
+        assert unlabeled == np.count_nonzero(selected) - expected.sum()
+
+    assert confusion_matrix_stats_calculator.binary_confusion_counts(ground_truth, predicted, 255)[4] == 8
+
+
+def test_streamed_confusion_matrix_statistics(tmp_path):
+    rng = np.random.default_rng(0)
+    ground_truth = rng.choice([0, 255], size=(7, 12, 10)).astype(np.uint8)
+    predicted = np.where(rng.random((7, 12, 10)) < 0.2, 255 - ground_truth, ground_truth).astype(np.uint8)
+    roi_mask = rng.choice([0, 255], size=(7, 12, 10), p=[0.3, 0.7]).astype(np.uint8)
+
+    ground_truth_path = write_image_stack(tmp_path / "gt", ground_truth)
+    predicted_path = write_image_stack(tmp_path / "pred", predicted)
+    roi_mask_path = write_image_stack(tmp_path / "roi", roi_mask)
+
+    for roi_mask_input in (True, False):
+        in_memory = confusion_matrix_stats_calculator.confusion_matrix_statistics(
+            255, roi_mask_input, True, ground_truth_path, predicted_path, roi_mask_path)
+
+        # Slab sizes that do and don't divide the number of slices must give identical results
+        for slab_size in (1, 3, 7, 20):
+            streamed = confusion_matrix_stats_calculator.confusion_matrix_statistics(
+                255, roi_mask_input, True, ground_truth_path, predicted_path, roi_mask_path, slab_size=slab_size)
+            np.testing.assert_array_equal(streamed, in_memory)
+
+    with pytest.raises(ValueError):
+        confusion_matrix_stats_calculator.confusion_matrix_statistics(
+            255, False, True, ground_truth_path, predicted_path, slab_size=0)
+
+
+def test_parallel_image_decoding(tmp_path):
+    from Source.Tools.training_data_selector import image_list_avg, average_pixel_difference_calc
+
+    rng = np.random.default_rng(2)
+    volume = rng.integers(0, 65535, size=(9, 16, 11), dtype=np.uint16)
+    folder_path = write_image_stack(tmp_path / "stack", volume)
+
+    # The default layout matches np.stack along the last axis, z_axis=0 keeps each slice contiguous
+    stacked = confusion_matrix_stats_calculator.image_stacker(folder_path, workers=3)
+    np.testing.assert_array_equal(stacked, np.stack(list(volume), axis=2))
+    np.testing.assert_array_equal(confusion_matrix_stats_calculator.image_stacker(folder_path, z_axis=0), volume)
+
+    file_paths, avg_img = image_list_avg(folder_path, workers=3)
+    order = [int(os.path.basename(file_path)[6:10]) for file_path in file_paths]
+
+    summed_array = 0
+    for i in order:
+        summed_array += volume[i].astype(float)
+    np.testing.assert_array_equal(avg_img, summed_array / len(order))
+
+    scores = average_pixel_difference_calc(avg_img, file_paths, workers=3)
+    assert scores == [np.mean((volume[i] - avg_img) ** 2) for i in order]
+
+    # Images of a different size can't be stacked
+    Image.fromarray(np.zeros((4, 4), dtype=np.uint16)).save(tmp_path / "stack" / "slice_9999.tiff")
+    with pytest.raises(ValueError):
+        confusion_matrix_stats_calculator.image_stacker(folder_path)
+
+
+def test_volume_cache(tmp_path):
+    from Source.Tools.volume_cache import cached_volume, cache_entries
+
+    rng = np.random.default_rng(3)
+    volume = rng.integers(0, 255, size=(5, 8, 6), dtype=np.uint8)
+    folder_path = write_image_stack(tmp_path / "stack", volume)
+    other_path = write_image_stack(tmp_path / "other", volume[:2])
+    cache_dir = str(tmp_path / "cache")
+
+    # The first load decodes into the cache, the second maps the same file
+    np.testing.assert_array_equal(confusion_matrix_stats_calculator.image_stacker(folder_path, cache_dir=cache_dir),
+                                  np.stack(list(volume), axis=2))
+    file_paths = confusion_matrix_stats_calculator.stack_file_paths(folder_path)
+    cached = cached_volume(file_paths, cache_dir)
+    assert isinstance(cached, np.memmap)
+    np.testing.assert_array_equal(cached, volume)
+    assert len(cache_entries(cache_dir)) == 1
+
+    # Changing a file invalidates the cached volume
+    volume[0] = 0
+    Image.fromarray(volume[0]).save(file_paths[0])
+    os.utime(file_paths[0], ns=(0, 0))
+    np.testing.assert_array_equal(cached_volume(file_paths, cache_dir), volume)
+    assert len(cache_entries(cache_dir)) == 2
+
+    # Only the most recently used volumes are kept within the size limit
+    cached_volume(confusion_matrix_stats_calculator.stack_file_paths(other_path), cache_dir,
+                  max_cache_bytes=volume.nbytes + volume[:2].nbytes + 256)
+    assert sorted(size for _, size, _ in cache_entries(cache_dir)) == [volume[:2].nbytes + 128, volume.nbytes + 128]
+
+    # The incoming volume is sized with its header like the cached ones, so the limit is never overshot
+    third_path = write_image_stack(tmp_path / "third", volume[:2])
+    max_cache_bytes = 2 * (volume[:2].nbytes + 128) - 1
+    cached_volume(confusion_matrix_stats_calculator.stack_file_paths(third_path), cache_dir,
+                  max_cache_bytes=max_cache_bytes)
+    assert sum(size for _, size, _ in cache_entries(cache_dir)) <= max_cache_bytes
+
+
+def test_batch_confusion_matrix_statistics(tmp_path, monkeypatch):
+    import csv
+    from Source.Tools import batch_evaluation
+    from Source.Tools.batch_evaluation import batch_confusion_matrix_statistics, BATCH_COLUMNS
+
+    rng = np.random.default_rng(4)
+    ground_truth = rng.choice([0, 255], size=(6, 9, 7)).astype(np.uint8)
+    roi_mask = rng.choice([0, 255], size=(6, 9, 7)).astype(np.uint8)
+    ground_truth_path = write_image_stack(tmp_path / "gt", ground_truth)
+    roi_mask_path = write_image_stack(tmp_path / "roi", roi_mask)
+
+    (tmp_path / "models").mkdir()
+    for model in range(3):
+        predicted = np.where(rng.random(ground_truth.shape) < 0.1 * (model + 1), 255 - ground_truth, ground_truth)
+        write_image_stack(tmp_path / "models" / f"model_{model}", predicted.astype(np.uint8))
+
+    # A prediction of the wrong size is reported and left out of the table
+    write_image_stack(tmp_path / "models" / "model_short", ground_truth[:2])
+
+    output_path = str(tmp_path / "results.csv")
+    rows = batch_confusion_matrix_statistics(255, ground_truth_path, str(tmp_path / "models" / "model_*"),
+                                             roi_mask_path, output_path, slab_size=4, workers=2)
+
+    assert [os.path.basename(row["model"]) for row in rows] == ["model_0", "model_1", "model_2"]
+
+    for row in rows:
+        expected = confusion_matrix_stats_calculator.confusion_matrix_statistics(
+            255, True, True, ground_truth_path, row["model"], roi_mask_path)
+        np.testing.assert_array_equal([row[column] for column in BATCH_COLUMNS[1:-1]], expected)
+
+    with open(output_path, newline="") as output_file:
+        table = list(csv.DictReader(output_file))
+    assert tuple(table[0].keys()) == BATCH_COLUMNS
+    assert len(table) == 3
+
+    # Volumes too large for the persistent cache are only decoded into the batch's scratch folder
+    cached_volume = batch_evaluation.cached_volume
+    cache_dirs = []
+
+    def recorded_cached_volume(file_paths, cache_dir, **kwargs):
+        cache_dirs.append(cache_dir)
+        return cached_volume(file_paths, cache_dir, **kwargs)
+
+    monkeypatch.setattr(batch_evaluation, "cached_volume", recorded_cached_volume)
+    monkeypatch.setattr(batch_evaluation, "DEFAULT_MAX_CACHE_BYTES", 1)
+    cache_dir = str(tmp_path / "cache")
+    cached_rows = batch_confusion_matrix_statistics(255, ground_truth_path, str(tmp_path / "models" / "model_*"),
+                                                    roi_mask_path, slab_size=4, workers=1, cache_dir=cache_dir)
+    assert [row["tp"] for row in cached_rows] == [row["tp"] for row in rows]
+    assert len(cache_dirs) == 2 and cache_dir not in cache_dirs
+
+
+def test_single_decode_avg_and_scores(tmp_path):
+    from Source.Tools.training_data_selector import (image_list_avg, average_pixel_difference_calc,
+                                                     single_decode_avg_and_scores)
+
+    rng = np.random.default_rng(5)
+    folder_path = write_image_stack(tmp_path / "stack", rng.integers(0, 255, size=(8, 10, 12), dtype=np.uint8))
+
+    file_paths, avg_img = image_list_avg(folder_path)
+    scores = average_pixel_difference_calc(avg_img, file_paths)
+
+    single_file_paths, single_avg_img, single_scores = single_decode_avg_and_scores(folder_path, workers=2,
+                                                                                    scratch_dir=str(tmp_path))
+    assert single_file_paths == file_paths
+    np.testing.assert_array_equal(single_avg_img, avg_img)
+    assert single_scores == scores
+
+    # The scratch volume is removed once the scores are calculated
+    assert sorted(os.listdir(tmp_path)) == ["stack"]
+
+
+def test_extremum_radii_match_argrelextrema():
+    from Source.Tools.training_data_selector import (local_extrema_by_mode, extremum_radii, extrema_at_order,
+                                                     order_for_slice_count)
+
+    rng = np.random.default_rng(6)
+    arrays = [rng.random(40), rng.integers(0, 4, size=41).astype(float), np.ones(5), np.array([1.0]),
+              np.array([3.0, 1.0, 2.0, np.nan, 5.0, 0.0, 4.0, 4.0, 1.0, 2.0])]
+
+    for array in arrays:
+        radii = extremum_radii(array)
+        number_of_images = len(array)
+
+        for mode in ("max", "min", "both"):
+            for order in range(1, number_of_images + 2):
+                expected_total, expected = local_extrema_by_mode(array, mode, order, 1)
+                total, extrema = extrema_at_order(radii, mode, order, 1)
+
+                assert total == expected_total
+                assert extrema.keys() == expected.keys()
+                for key in expected:
+                    np.testing.assert_array_equal(extrema[key], expected[key])
+
+            # The order search from the highest order down settles on the same order as the lookup
+            for desired_number_of_slices in range(1, local_extrema_by_mode(array, mode, 1)[0]):
+                order = math.floor(number_of_images / 2)
+                while local_extrema_by_mode(array, mode, order)[0] < desired_number_of_slices and order >= 1:
+                    order -= 1
+                assert order_for_slice_count(radii, mode, desired_number_of_slices, number_of_images) == order
+
+
+def test_multiclass_confusion_matrix_statistics(tmp_path):
+    from sklearn.metrics import confusion_matrix, precision_recall_fscore_support, jaccard_score
+    from Source.Tools.multiclass_metrics import multiclass_confusion_matrix_statistics
+
+    rng = np.random.default_rng(7)
+    labels = (0, 100, 200)
+    ground_truth = rng.choice(labels, size=(5, 9, 8)).astype(np.uint8)
+    predicted = np.where(rng.random(ground_truth.shape) < 0.3, rng.choice(labels, size=ground_truth.shape),
+                         ground_truth).astype(np.uint8)
+    predicted[0, 0, :3] = 50
+    roi_mask = rng.choice([0, 255], size=ground_truth.shape).astype(np.uint8)
+
+    ground_truth_path = write_image_stack(tmp_path / "gt", ground_truth)
+    predicted_path = write_image_stack(tmp_path / "pred", predicted)
+    roi_mask_path = write_image_stack(tmp_path / "roi", roi_mask)
+
+    stats = multiclass_confusion_matrix_statistics(labels, ground_truth_path, predicted_path, roi_mask_path,
+                                                   slab_size=2)
+
+    selected = (roi_mask == 255) & (predicted != 50)
+    assert stats["unlabeled"] == np.count_nonzero((roi_mask == 255) & (predicted == 50))
+
+    y_true, y_pred = ground_truth[selected], predicted[selected]
+    np.testing.assert_array_equal(stats["confusion_matrix"], confusion_matrix(y_true, y_pred, labels=labels))
+
+    precision, recall, f1, _ = precision_recall_fscore_support(y_true, y_pred, labels=labels, zero_division=np.nan)
+    np.testing.assert_allclose(stats["precision"], precision)
+    np.testing.assert_allclose(stats["recall"], recall)
+    np.testing.assert_allclose(stats["f1"], f1)
+    np.testing.assert_allclose(stats["iou"], jaccard_score(y_true, y_pred, labels=labels, average=None))
+    np.testing.assert_allclose(stats["macro"]["f1"], np.mean(f1))
+    np.testing.assert_allclose(stats["micro"]["f1"], np.mean(y_true == y_pred))
+
+
+def test_slice_profiles(tmp_path):
+    import csv
+    from Source.Tools.slice_profiles import slice_profile_export, bootstrap_confidence_interval
+
+    rng = np.random.default_rng(8)
+    ground_truth = rng.choice([0, 255], size=(6, 10, 9)).astype(np.uint8)
+    predicted = np.where(rng.random(ground_truth.shape) < 0.2, 255 - ground_truth, ground_truth).astype(np.uint8)
+    roi_mask = rng.choice([0, 255], size=ground_truth.shape).astype(np.uint8)
+
+    ground_truth_path = write_image_stack(tmp_path / "gt", ground_truth)
+    predicted_path = write_image_stack(tmp_path / "pred", predicted)
+    roi_mask_path = write_image_stack(tmp_path / "roi", roi_mask)
+
+    stat_bloc = confusion_matrix_stats_calculator.confusion_matrix_statistics(
+        255, True, True, ground_truth_path, predicted_path, roi_mask_path)
+
+    for slab_size in (None, 4):
+        profiled_stat_bloc, slice_profile = confusion_matrix_stats_calculator.confusion_matrix_statistics(
+            255, True, True, ground_truth_path, predicted_path, roi_mask_path, slab_size=slab_size, profile=True)
+        np.testing.assert_array_equal(profiled_stat_bloc, stat_bloc)
+        assert slice_profile.shape == (6, 5)
+
+        # Each slice's counts match counting that slice on its own
+        for i in range(6):
+            expected = confusion_matrix_stats_calculator.binary_confusion_counts(ground_truth[i], predicted[i], 255,
+                                                                                 roi_mask[i] == 255)
+            np.testing.assert_array_equal(slice_profile[i], expected)
+
+        _, tile_profile = confusion_matrix_stats_calculator.confusion_matrix_statistics(
+            255, True, True, ground_truth_path, predicted_path, roi_mask_path, slab_size=slab_size, tile_size=4)
+        assert tile_profile.shape == (6, 3, 3, 5)
+        np.testing.assert_array_equal(tile_profile.sum(axis=(1, 2)), slice_profile)
+
+    output_path = str(tmp_path / "profile.csv")
+    slice_profile_export(tile_profile, output_path, idx_offset=1)
+    with open(output_path, newline="") as output_file:
+        rows = list(csv.DictReader(output_file))
+    assert len(rows) == 6 * 3 * 3
+    assert rows[0]["slice"] == "1" and rows[-1]["tile_column"] == "2"
+
+    f1, lower, upper = bootstrap_confidence_interval(slice_profile, seed=0)
+    assert f1 == stat_bloc[6]
+    assert lower <= f1 <= upper
+
+
+def test_raw_volume(tmp_path):
+    from Source.Tools.raw_volume import open_raw_volume, threshold_counts, streaming_histogram, otsu_threshold
+
+    rng = np.random.default_rng(9)
+    volume = rng.integers(0, 60000, size=(4, 6, 5), dtype=np.uint16)
+    header = np.zeros(512, dtype=np.uint16)
+    header[[0, 2, 4]] = (5, 6, 4)  # x, y, z dimensions as 32-bit integers
+
+    raw_path = tmp_path / "scan.scv"
+    raw_path.write_bytes(header.tobytes() + volume.tobytes())
+
+    # The data type and header size of a header without fields for them are never guessed
+    with pytest.raises(ValueError, match="dtype and header_bytes"):
+        open_raw_volume(str(raw_path))
+
+    raw = open_raw_volume(str(raw_path), dtype="uint16", header_bytes=1024)
+    assert isinstance(raw, np.memmap)
+    np.testing.assert_array_equal(raw, volume)
+
+    assert threshold_counts(raw, 12515, chunk_voxels=7) == (np.sum(volume > 12515), np.sum(volume <= 12515))
+
+    histogram, values = streaming_histogram(raw, chunk_voxels=11)
+    np.testing.assert_array_equal(histogram, np.bincount(volume.ravel(), minlength=65536))
+
+    # Otsu's threshold separates two well separated intensity populations
+    two_phase = np.concatenate([rng.normal(10000, 500, 1000), rng.normal(40000, 500, 1000)]).astype(np.uint16)
+    assert 11000 < otsu_threshold(*streaming_histogram(two_phase)) < 39000
+
+    # Fields in a text header give the shape, data type and header size
+    float_volume = rng.random((3, 4, 2), dtype=np.float32)
+    float_path = tmp_path / "scan.vol"
+    float_path.write_bytes(b"DimSize = 2 4 3\nElementType = MET_FLOAT\nHeaderSize = 64\n".ljust(64)
+                           + float_volume.tobytes())
+    np.testing.assert_array_equal(open_raw_volume(str(float_path)), float_volume)
+
+    (tmp_path / "scan.scv.json").write_text('{"dtype": "uint16", "header_bytes": 1024}')
+    np.testing.assert_array_equal(confusion_matrix_stats_calculator.image_stacker(str(raw_path)),
+                                  np.stack(list(volume), axis=2))
+
+    # A raw volume described by a JSON sidecar can be used in place of an image stack folder
+    segmentation = rng.choice([0, 255], size=(4, 6, 5)).astype(np.uint8)
+    segmentation_path = tmp_path / "segmentation.raw"
+    segmentation_path.write_bytes(segmentation.tobytes())
+    (tmp_path / "segmentation.raw.json").write_text('{"shape": [4, 6, 5], "dtype": "uint8", "header_bytes": 0}')
+
+    folder_path = write_image_stack(tmp_path / "stack", segmentation)
+    expected = confusion_matrix_stats_calculator.confusion_matrix_statistics(255, False, True, folder_path,
+                                                                             folder_path)
+    for slab_size in (None, 3):
+        np.testing.assert_array_equal(
+            confusion_matrix_stats_calculator.confusion_matrix_statistics(255, False, True, folder_path,
+                                                                          str(segmentation_path), slab_size=slab_size),
+            expected)
+
+
+def test_multi_page_tiff_volume(tmp_path):
+    from Source.Tools.volume_sources import MultiPageTiffSource, open_volume_source
+    from Source.Tools.batch_evaluation import batch_confusion_matrix_statistics
+    from Source.Tools.training_data_selector import image_list_avg, average_pixel_difference_calc
+
+    rng = np.random.default_rng(10)
+    ground_truth = rng.choice([0, 255], size=(5, 7, 6)).astype(np.uint8)
+    predicted = np.where(rng.random(ground_truth.shape) < 0.2, 255 - ground_truth, ground_truth).astype(np.uint8)
+    ground_truth_folder = write_image_stack(tmp_path / "gt", ground_truth)
+    predicted_folder = write_image_stack(tmp_path / "pred", predicted)
+
+    # Uncompressed pages are mapped straight from the file, compressed pages are decoded with Pillow
+    pages = [Image.fromarray(image_array) for image_array in predicted]
+    pages[0].save(tmp_path / "pred.tif", save_all=True, append_images=pages[1:])
+    pages[0].save(tmp_path / "pred_deflate.tif", save_all=True, append_images=pages[1:], compression="tiff_deflate")
+
+    for file_name, memory_mapped in (("pred.tif", True), ("pred_deflate.tif", False)):
+        volume_path = str(tmp_path / file_name)
+        volume_source = open_volume_source(volume_path)
+        assert isinstance(volume_source, MultiPageTiffSource)
+        assert volume_source.is_memory_mapped == memory_mapped
+        np.testing.assert_array_equal(volume_source.read_slab(1, 4, workers=2), predicted[1:4])
+
+        np.testing.assert_array_equal(confusion_matrix_stats_calculator.image_stacker(volume_path),
+                                      confusion_matrix_stats_calculator.image_stacker(predicted_folder))
+
+        expected = confusion_matrix_stats_calculator.confusion_matrix_statistics(255, False, True,
+                                                                                 ground_truth_folder, predicted_folder)
+        np.testing.assert_array_equal(confusion_matrix_stats_calculator.confusion_matrix_statistics(
+            255, False, True, ground_truth_folder, volume_path, slab_size=2), expected)
+
+        rows = batch_confusion_matrix_statistics(255, volume_path, [predicted_folder], slab_size=2, workers=1)
+        assert rows[0]["tp"] == np.sum(predicted == 255)
+
+        file_paths, avg_img = image_list_avg(predicted_folder)
+        volume_slices, volume_avg_img = image_list_avg(volume_path, workers=2)
+        assert len(volume_slices) == len(file_paths)
+        np.testing.assert_array_equal(volume_avg_img, avg_img)
+        # Folders are collected in directory listing order, so the folder's images are scored in slice order here
+        assert average_pixel_difference_calc(volume_avg_img, volume_slices) == \
+               average_pixel_difference_calc(avg_img, sorted(file_paths))
+
+
+def test_multi_page_tiff_handles_and_single_page_files(tmp_path):
+    from Source.Tools.volume_sources import is_volume_file, open_volume_source
+    from Source.Tools.batch_evaluation import expand_predicted_folders
+
+    volume = np.arange(4 * 5 * 6, dtype=np.uint8).reshape(4, 5, 6)
+    pages = [Image.fromarray(image_array) for image_array in volume]
+    pages[0].save(tmp_path / "volume.tif", save_all=True, append_images=pages[1:], compression="tiff_deflate")
+    pages[0].save(tmp_path / "slice.tif")
+
+    # Every handle opened by the decoding threads is closed with the source, which can still be read afterwards
+    with open_volume_source(str(tmp_path / "volume.tif")) as volume_source:
+        np.testing.assert_array_equal(volume_source.read_slab(0, 4, workers=3), volume)
+        handles = list(volume_source._handles.values())
+        assert handles
+    assert not volume_source._handles and all(img.fp is None for img in handles)
+    np.testing.assert_array_equal(volume_source.read(2), volume[2])
+    volume_source.close()
+
+    # A single-page TIFF is an image of a stack folder rather than a volume
+    assert is_volume_file(str(tmp_path / "volume.tif"))
+    assert not is_volume_file(str(tmp_path / "slice.tif"))
+    assert expand_predicted_folders(str(tmp_path / "*.tif")) == [str(tmp_path / "volume.tif")]
+    with pytest.raises(ValueError):
+        open_volume_source(str(tmp_path / "slice.tif"))
+
+
+# Seconds the core compute path may take to import in a fresh interpreter
+IMPORT_TIME_BUDGET = 2.0
+
+
+def test_headless_import_time_budget():
+    import subprocess
+
+    # The GUI, plotting and scipy libraries must only be imported when a dialog, plot or reference search is requested
+    code = ("import sys, time; start = time.perf_counter(); "
+            "import Source.Tools.confusion_matrix_stats_calculator, Source.Tools.training_data_selector, "
+            "Source.Tools.batch_evaluation, Source.Tools.multiclass_metrics; "
+            "print(time.perf_counter() - start); "
+            "print(sorted({'tkinter', 'matplotlib', 'scipy', 'sklearn'} & {name.split('.')[0] for name in sys.modules}))")
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                            cwd=os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+    import_seconds, heavy_modules = result.stdout.splitlines()
+
+    assert heavy_modules == "[]"
+    assert float(import_seconds) < IMPORT_TIME_BUDGET
+
+
+def test_command_line_entry_points(tmp_path, capsys):
+    import csv
+    import json
+    from Source.Tools import training_data_selector
+
+    rng = np.random.default_rng(11)
+    ground_truth = rng.choice([0, 255], size=(5, 8, 6)).astype(np.uint8)
+    predicted = np.where(rng.random(ground_truth.shape) < 0.2, 255 - ground_truth, ground_truth).astype(np.uint8)
+    ground_truth_path = write_image_stack(tmp_path / "gt", ground_truth)
+    predicted_path = write_image_stack(tmp_path / "pred", predicted)
+
+    # The statistics are written as JSON on stdout with the progress messages on stderr
+    confusion_matrix_stats_calculator.main([ground_truth_path, predicted_path, "--slab-size", "2"])
+    row = json.loads(capsys.readouterr().out)[0]
+    assert row["tp"] == np.sum((ground_truth == 255) & (predicted == 255))
+    assert row["fp"] == np.sum((ground_truth == 0) & (predicted == 255))
+
+    scan_path = write_image_stack(tmp_path / "scan", rng.integers(0, 255, size=(12, 6, 6), dtype=np.uint8))
+    output_path = str(tmp_path / "selection.csv")
+    training_data_selector.main([scan_path, "--slices", "2", "--output", output_path])
+
+    with open(output_path, newline="") as output_file:
+        table = list(csv.DictReader(output_file))
+    assert tuple(table[0].keys()) == training_data_selector.SELECTION_COLUMNS
+    assert len(table) >= 2
+    assert all(row["extremum"] in ("max", "min") for row in table)
+
+    # The agreement report only compares extrema selections
+    with pytest.raises(ValueError):
+        training_data_selector.main([scan_path, "--slices", "2", "--mode", "diverse", "--agreement-sample", "6"])
+
+    # The outliers can be trimmed several per round from the command line
+    training_data_selector.main([scan_path, "--slices", "2", "--trim-outliers", "4", "--outliers-per-round", "2",
+                                 "--output", output_path])
+    with open(output_path, newline="") as output_file:
+        assert len(list(csv.DictReader(output_file))) >= 2
+
+
+def test_downsampled_slice_selection(tmp_path):
+    from Source.Tools.image_io import block_reduce
+    from Source.Tools.training_data_selector import (image_list_avg, average_pixel_difference_calc,
+                                                     single_decode_avg_and_scores, downsampling_agreement)
+
+    rng = np.random.default_rng(12)
+    volume = rng.integers(0, 255, size=(10, 9, 13), dtype=np.uint8)
+    folder_path = write_image_stack(tmp_path / "stack", volume)
+
+    # Mean pooling leaves out the edge rows and columns that don't fill a whole block
+    np.testing.assert_allclose(block_reduce(volume[0], 4), volume[0, :8, :12].reshape(2, 4, 3, 4).mean(axis=(1, 3)))
+
+    file_paths, avg_img = image_list_avg(folder_path, downsample_factor=2)
+    reduced = np.stack([block_reduce(image_array, 2) for image_array in volume])
+    order = [int(os.path.basename(file_path)[6:10]) for file_path in file_paths]
+    np.testing.assert_allclose(avg_img, reduced.mean(axis=0))
+    np.testing.assert_allclose(average_pixel_difference_calc(avg_img, file_paths, downsample_factor=2),
+                               [np.mean((reduced[i] - avg_img) ** 2) for i in order])
+
+    _, single_avg_img, single_scores = single_decode_avg_and_scores(folder_path, downsample_factor=2,
+                                                                    scratch_dir=str(tmp_path))
+    np.testing.assert_allclose(single_avg_img, avg_img)
+
+    with pytest.raises(ValueError):
+        image_list_avg(folder_path, downsample_factor=0)
+
+    # Without downsampling both selections are the same
+    report = downsampling_agreement(folder_path, 1, 3, sample_size=8)
+    assert report["sample"] == (1, 8)
+    assert report["full_resolution"] == report["downsampled"]
+    assert report["jaccard"] == report["matched_within_one"] == report["score_rank_correlation"] == 1.0
+
+    report = downsampling_agreement(folder_path, 2, 3)
+    assert 0 <= report["jaccard"] <= 1 and -1 <= report["score_rank_correlation"] <= 1
+
+
+def test_diverse_slice_selection(tmp_path, monkeypatch):
+    from Source.Tools import diversity_selection
+    from Source.Tools.diversity_selection import slice_embedding, farthest_point_sampling
+    from Source.Tools.training_data_selector import dataset_file_paths, training_slice_selector
+
+    # Three kinds of slices, equally far from the average image but different from each other
+    rng = np.random.default_rng(13)
+    patterns = np.zeros((3, 16, 16))
+    patterns[0, :, :8] = patterns[1, :, 8:] = patterns[2, :8, :] = 200
+    kinds = np.repeat([0, 1, 2], 9)
+    volume = (patterns[kinds] + rng.normal(0, 5, (27, 16, 16))).clip(0, 255).astype(np.uint8)
+    folder_path = write_image_stack(tmp_path / "stack", volume)
+
+    file_paths = sorted(dataset_file_paths(folder_path))
+    embedding = slice_embedding(file_paths, n_components=4, downsample_factor=2, batch_size=5,
+                                scratch_dir=str(tmp_path))
+    assert embedding.shape == (27, 4)
+    assert sorted(kinds[farthest_point_sampling(embedding, 3)]) == [0, 1, 2]
+
+    # Equally spread points are picked from the centre outwards
+    np.testing.assert_array_equal(farthest_point_sampling(np.arange(5.0)[:, None], 3), [2, 0, 4])
+
+    # The slices are pooled by diversity_selection's default factor unless another one is given
+    factors = []
+
+    def recorded_embedding(file_paths, n_components, downsample_factor, *args):
+        factors.append(downsample_factor)
+        return slice_embedding(file_paths, n_components, downsample_factor, *args)
+
+    monkeypatch.setattr(diversity_selection, "slice_embedding", recorded_embedding)
+    local_extrema, scores = training_slice_selector(folder_path, 6, mode="diverse", idx_offset=1)
+    assert len(local_extrema["diverse"]) == 6
+    assert scores.shape == (27, 2)
+    training_slice_selector(folder_path, 6, mode="diverse", downsample_factor=1)
+    assert factors == [diversity_selection.DEFAULT_DOWNSAMPLE_FACTOR, 1]
+
+    # Options of the difference scores are rejected rather than ignored
+    for options in ({"number_of_outliers": 2}, {"result_cache_dir": str(tmp_path / "results")},
+                    {"single_decode": True}):
+        with pytest.raises(ValueError):
+            training_slice_selector(folder_path, 6, mode="diverse", **options)
+
+
+def test_trimmed_avg_and_scores(tmp_path):
+    from Source.Tools.training_data_selector import trimmed_avg_and_scores, array_mse_calc
+
+    rng = np.random.default_rng(14)
+    volume = rng.integers(20000, 40000, size=(12, 7, 9), dtype=np.uint16)
+    volume[[3, 8]] = rng.integers(0, 65535, size=(2, 7, 9), dtype=np.uint16)
+    folder_path = write_image_stack(tmp_path / "stack", volume)
+
+    file_paths, avg_img, scores, removed = trimmed_avg_and_scores(folder_path, 3, workers=2,
+                                                                  scratch_dir=str(tmp_path))
+    images = np.stack([np.array(Image.open(file_path)) for file_path in file_paths]).astype(float)
+
+    # Removing the outliers one at a time matches recalculating the average and the scores after every removal
+    kept = list(range(len(images)))
+    for outlier in removed:
+        expected_scores = [array_mse_calc(image, images[kept].mean(axis=0)) for image in images]
+        assert outlier == max(kept, key=lambda i: expected_scores[i])
+        kept.remove(outlier)
+
+    np.testing.assert_allclose(avg_img, images[kept].mean(axis=0))
+    np.testing.assert_allclose(scores, [array_mse_calc(image, avg_img) for image in images])
+    assert {int(os.path.basename(file_paths[i])[6:10]) for i in removed} >= {3, 8}
+
+    # Several outliers can be removed per round
+    _, batched_avg_img, _, batched_removed = trimmed_avg_and_scores(folder_path, 4, outliers_per_round=2)
+    assert len(batched_removed) == 4
+    np.testing.assert_allclose(batched_avg_img, np.delete(images, batched_removed, axis=0).mean(axis=0))
+
+
+def test_result_cache(tmp_path):
+    from Source.Tools.result_cache import cached_avg_and_scores, cached_confusion_counts
+    from Source.Tools.training_data_selector import (image_list_avg, average_pixel_difference_calc,
+                                                     training_slice_selector)
+
+    rng = np.random.default_rng(15)
+    scan_path = write_image_stack(tmp_path / "scan", rng.integers(0, 255, size=(6, 8, 8), dtype=np.uint8))
+    cache_dir = str(tmp_path / "results")
+
+    def expected_avg_and_scores():
+        file_paths, avg_img = image_list_avg(scan_path)
+        return avg_img, average_pixel_difference_calc(avg_img, file_paths)
+
+    _, avg_img, scores, decoded = cached_avg_and_scores(scan_path, cache_dir)
+    assert decoded == 6
+    assert cached_avg_and_scores(scan_path, cache_dir)[3] == 0
+
+    # Only the changed slice is decoded again
+    changed_path = os.path.join(scan_path, "slice_0002.tiff")
+    Image.fromarray(rng.integers(0, 255, size=(8, 8), dtype=np.uint8)).save(changed_path)
+    os.utime(changed_path, ns=(0, 10 ** 18))
+    _, avg_img, scores, decoded = cached_avg_and_scores(scan_path, cache_dir)
+    assert decoded == 1
+    expected_avg_img, expected_scores = expected_avg_and_scores()
+    np.testing.assert_allclose(avg_img, expected_avg_img)
+    np.testing.assert_allclose(scores, expected_scores)
+
+    # Content hashes ignore files that were only touched
+    cached_avg_and_scores(scan_path, cache_dir, hash_contents=True)
+    os.utime(changed_path, ns=(0, 2 * 10 ** 18))
+    assert cached_avg_and_scores(scan_path, cache_dir, hash_contents=True)[3] == 0
+
+    # Identical slices of another dataset share their stored copies, which outlive a change to either dataset
+    import shutil
+    copy_path = shutil.copytree(scan_path, tmp_path / "scan_copy")
+    assert cached_avg_and_scores(copy_path, cache_dir, hash_contents=True)[3] == 0
+    Image.fromarray(rng.integers(0, 255, size=(8, 8), dtype=np.uint8)).save(os.path.join(scan_path, "slice_0000.tiff"))
+    assert cached_avg_and_scores(scan_path, cache_dir, hash_contents=True)[3] == 1
+    Image.fromarray(rng.integers(0, 255, size=(8, 8), dtype=np.uint8)).save(os.path.join(copy_path, "slice_0005.tiff"))
+    assert cached_avg_and_scores(copy_path, cache_dir, hash_contents=True)[3] == 1
+
+    # The store is trimmed to its size limit, keeping the slices of the dataset just scored
+    slice_dir = os.path.join(cache_dir, "slices")
+    slice_bytes = os.path.getsize(os.path.join(slice_dir, os.listdir(slice_dir)[0]))
+    cached_avg_and_scores(scan_path, cache_dir, max_cache_bytes=6 * slice_bytes)
+    assert len(os.listdir(slice_dir)) == 6
+
+    # A dataset larger than the limit isn't stored, so a change decodes every slice again
+    shutil.rmtree(slice_dir)
+    for change in range(2):
+        Image.fromarray(rng.integers(0, 255, size=(8, 8), dtype=np.uint8)).save(changed_path)
+        os.utime(changed_path, ns=(0, (3 + change) * 10 ** 18))
+        assert cached_avg_and_scores(scan_path, cache_dir, max_cache_bytes=slice_bytes)[3] == 6
+        assert not os.listdir(slice_dir)
+    np.testing.assert_allclose(cached_avg_and_scores(scan_path, cache_dir)[2], expected_avg_and_scores()[1])
+
+    ground_truth = rng.choice([0, 255], size=(5, 6, 7)).astype(np.uint8)
+    predicted = np.where(rng.random(ground_truth.shape) < 0.2, 255 - ground_truth, ground_truth).astype(np.uint8)
+    ground_truth_path = write_image_stack(tmp_path / "gt", ground_truth)
+    predicted_path = write_image_stack(tmp_path / "pred", predicted)
+
+    assert cached_confusion_counts(255, ground_truth_path, predicted_path, cache_dir)[2] == 5
+    Image.fromarray(ground_truth[4]).save(os.path.join(predicted_path, "slice_0004.tiff"))
+    os.utime(os.path.join(predicted_path, "slice_0004.tiff"), ns=(0, 10 ** 18))
+    slice_profile, roi_size, counted = cached_confusion_counts(255, ground_truth_path, predicted_path, cache_dir)
+    assert counted == 1 and roi_size is None
+
+    np.testing.assert_array_equal(
+        confusion_matrix_stats_calculator.confusion_matrix_statistics(255, False, True, ground_truth_path,
+                                                                      predicted_path, result_cache_dir=cache_dir),
+        confusion_matrix_stats_calculator.confusion_matrix_statistics(255, False, True, ground_truth_path,
+                                                                      predicted_path))
+    assert slice_profile[4, 1] == slice_profile[4, 2] == 0
+
+    # ROI voxels are counted, and the trimmed scores can't be combined with the cache
+    roi_path = write_image_stack(tmp_path / "roi", np.where(ground_truth > 0, 255, 7).astype(np.uint8))
+    assert cached_confusion_counts(255, ground_truth_path, predicted_path, cache_dir, roi_path)[1] == \
+        np.count_nonzero(ground_truth == 255)
+    with pytest.raises(ValueError):
+        training_slice_selector(scan_path, 2, number_of_outliers=1, result_cache_dir=cache_dir)
+
+
+def test_surface_distance_metrics(tmp_path):
+    from Source.Tools.surface_distance import (full_volume_surface_distances, lower_envelope_distances,
+                                               surface_distance_metrics)
+
+    # Objects far apart along the slices so the nearest surface is many slabs away
+    ground_truth = np.zeros((24, 10, 12), dtype=np.uint8)
+    ground_truth[2:6, 2:7, 3:9] = 255
+    ground_truth[20:23, 0:4, 0:5] = 255
+    predicted = np.zeros_like(ground_truth)
+    predicted[3:7, 3:8, 2:8] = 255
+    predicted[12:14, 6:10, 8:12] = 255
+    roi = np.zeros_like(ground_truth)
+    roi[:, 1:, :10] = 255
+
+    ground_truth_path = write_image_stack(tmp_path / "gt", ground_truth)
+    predicted_path = write_image_stack(tmp_path / "pred", predicted)
+    roi_path = write_image_stack(tmp_path / "roi", roi)
+
+    for spacing in [(1, 1, 1), (2.5, 0.7, 0.7)]:
+        expected = full_volume_surface_distances(ground_truth, predicted, 255, spacing)
+        metrics = surface_distance_metrics(255, ground_truth_path, predicted_path, spacing=spacing, slab_size=2,
+                                           workers=1)
+        assert metrics == pytest.approx(expected)
+
+    # Scattered voxels whose nearest surface voxel changes when the row and column spacing differ
+    rng = np.random.default_rng(41)
+    scattered = [np.where(rng.random((6, 12, 14)) < 0.08, 255, 0).astype(np.uint8) for _ in range(2)]
+    scattered_paths = [write_image_stack(tmp_path / name, volume)
+                       for name, volume in zip(("scattered_gt", "scattered_pred"), scattered)]
+    for spacing in [(1, 2, 1), (0.5, 0.7, 1.3)]:
+        expected = full_volume_surface_distances(scattered[0], scattered[1], 255, spacing)
+        metrics = surface_distance_metrics(255, *scattered_paths, spacing=spacing, slab_size=2, workers=1)
+        assert metrics == pytest.approx(expected)
+
+    expected = full_volume_surface_distances(ground_truth, predicted, 255, roi_voxels=roi == 255)
+    assert surface_distance_metrics(255, ground_truth_path, predicted_path, roi_path, slab_size=3,
+                                    workers=1) == pytest.approx(expected)
+
+    with pytest.raises(ValueError):
+        surface_distance_metrics(255, ground_truth_path, write_image_stack(tmp_path / "empty", roi * 0), workers=1)
+
+    # The lower envelope along the slices matches a brute force minimum, with slices lacking any surface
+    rng = np.random.default_rng(37)
+    in_plane = np.where(rng.random((9, 4, 3)) < 0.3, rng.integers(0, 20, size=(9, 4, 3)), np.inf)
+    offsets = np.arange(9)[:, None] - np.arange(9)[None, :]
+    brute_force = np.min((1.5 * offsets[:, :, None, None]) ** 2 + in_plane[None], axis=1)
+    assert np.array_equal(lower_envelope_distances(in_plane, 1.5), brute_force)
+
+
+def test_read_image_region_strips(tmp_path, monkeypatch):
+    from PIL import TiffImagePlugin
+    from Source.Tools.image_io import read_image_region
+
+    image_array = (np.arange(64 * 48) % 251).astype(np.uint8).reshape(64, 48)
+    Image.fromarray(image_array).save(tmp_path / "strips.tif", tiffinfo={278: 8})
+    Image.fromarray(image_array).save(tmp_path / "deflate.tif", tiffinfo={278: 8}, compression="tiff_deflate")
+
+    # Records the rows of the pieces Pillow is left to decode
+    decoded_rows = []
+    tiff_load = TiffImagePlugin.TiffImageFile.load
+
+    def recorded_load(img):
+        decoded_rows.append(sum(tile[1][3] - tile[1][1] for tile in img.tile))
+        return tiff_load(img)
+
+    monkeypatch.setattr(TiffImagePlugin.TiffImageFile, "load", recorded_load)
+
+    # Only the two strips of 8 rows overlapping the box are decoded, compressed strips are decoded whole
+    for file_name, expected_rows in (("strips.tif", 16), ("deflate.tif", 64)):
+        decoded_rows.clear()
+        region = read_image_region(str(tmp_path / file_name), (10, 20), (5, 30))
+        np.testing.assert_array_equal(region, image_array[10:20, 5:30])
+        assert decoded_rows[0] == expected_rows
+
+
+def test_roi_cropped_confusion_counts(tmp_path):
+    from Source.Tools.volume_sources import open_volume_source
+
+    rng = np.random.default_rng(19)
+    ground_truth = rng.choice([0, 255], size=(6, 9, 11)).astype(np.uint8)
+    predicted = np.where(rng.random(ground_truth.shape) < 0.3, 255 - ground_truth, ground_truth).astype(np.uint8)
+    predicted[2, 0, 0] = 7
+
+    # The ROI leaves out whole slices and covers a different box in each of the others
+    roi = np.zeros_like(ground_truth)
+    roi[1, 2:5, 3:9] = 255
+    roi[2, 0:3, 0:2] = 255
+    roi[4, 5:9, 6:11] = 255
+    roi[4, 6, 7] = 0
+
+    paths = [write_image_stack(tmp_path / name, volume)
+             for name, volume in (("gt", ground_truth), ("pred", predicted), ("roi", roi))]
+
+    tn, fp, fn, tp, unlabeled, roi_size, slice_profile = \
+        confusion_matrix_stats_calculator.roi_cropped_confusion_counts(255, *paths, profile=True)
+
+    expected_profile = np.stack(confusion_matrix_stats_calculator.binary_confusion_counts(
+        np.moveaxis(ground_truth, 0, 2), np.moveaxis(predicted, 0, 2), 255, np.moveaxis(roi == 255, 0, 2), True),
+        axis=-1)
+    np.testing.assert_array_equal(slice_profile, expected_profile)
+    assert (tn, fp, fn, tp, unlabeled) == tuple(expected_profile.sum(axis=0))
+    assert unlabeled == 1 and roi_size == np.sum(roi / 255)
+
+    # Slices are only read inside the box they are asked for
+    np.testing.assert_array_equal(open_volume_source(paths[0]).read_region(4, (5, 9), (6, 11)),
+                                  ground_truth[4, 5:9, 6:11])
+
+    stat_bloc = confusion_matrix_stats_calculator.confusion_matrix_statistics(255, True, True, *paths)
+    np.testing.assert_array_equal(stat_bloc[:4], [tp, fn, fp, tn])
+
+
+def test_object_detection_statistics(tmp_path):
+    from scipy.ndimage import generate_binary_structure, label
+    from Source.Tools.object_metrics import chunked_object_labels, object_detection_statistics
+
+    rng = np.random.default_rng(20)
+    ground_truth = (rng.random((9, 12, 10)) < 0.3).astype(np.uint8) * 255
+    predicted = np.where(rng.random(ground_truth.shape) < 0.1, 255 - ground_truth, ground_truth).astype(np.uint8)
+    ground_truth_path = write_image_stack(tmp_path / "gt", ground_truth)
+    predicted_path = write_image_stack(tmp_path / "pred", predicted)
+
+    # Labeling two slices at a time has to give the same objects as labeling the whole volume
+    for connectivity in (1, 3):
+        structure = generate_binary_structure(3, connectivity)
+        ground_truth_labels, _ = label(ground_truth == 255, structure=structure)
+        predicted_labels, _ = label(predicted == 255, structure=structure)
+
+        ground_truth_sizes, predicted_sizes, overlaps = chunked_object_labels(
+            255, ground_truth_path, predicted_path, slab_size=2, connectivity=connectivity, workers=1)
+
+        np.testing.assert_array_equal(np.sort(ground_truth_sizes),
+                                      np.sort(np.bincount(ground_truth_labels.ravel())[1:]))
+        np.testing.assert_array_equal(np.sort(predicted_sizes), np.sort(np.bincount(predicted_labels.ravel())[1:]))
+        assert overlaps[:, 2].sum() == np.count_nonzero((ground_truth == 255) & (predicted == 255))
+
+    # Two pores, one found exactly, one half found, and one false detection
+    ground_truth = np.zeros((6, 8, 8), dtype=np.uint8)
+    ground_truth[0:2, 0:2, 0:2] = 255
+    ground_truth[3:5, 4:8, 4:8] = 255
+    predicted = ground_truth.copy()
+    predicted[3:5, 4:8, 6:8] = 0
+    predicted[5, 0, 7] = 255
+    statistics, per_object = object_detection_statistics(255, write_image_stack(tmp_path / "gt_pores", ground_truth),
+                                                         write_image_stack(tmp_path / "pred_pores", predicted),
+                                                         slab_size=4, workers=1)
+
+    assert (statistics["object_tp"], statistics["object_fn"], statistics["object_fp"]) == (2, 0, 1)
+    assert statistics["detection_f1"] == pytest.approx(0.8)
+    assert statistics["mean_matched_iou"] == pytest.approx(0.75)
+    assert sorted(row["voxels"] for row in per_object if row["volume"] == "predicted") == [1, 8, 16]
+
+
+def test_threshold_sweep(tmp_path):
+    from sklearn.metrics import average_precision_score, roc_auc_score
+    from Source.Tools.threshold_sweep import threshold_sweep
+
+    rng = np.random.default_rng(21)
+    ground_truth = rng.choice([0, 255], size=(5, 8, 9)).astype(np.uint8)
+    probabilities = np.clip(rng.normal(np.where(ground_truth == 255, 40000, 25000), 9000), 0, 65535).astype(np.uint16)
+    roi = np.zeros_like(ground_truth)
+    roi[1:4, 2:7, :] = 255
+
+    paths = [write_image_stack(tmp_path / name, volume)
+             for name, volume in (("gt", ground_truth), ("prob", probabilities), ("roi", roi))]
+    summary, curve = threshold_sweep(255, *paths)
+
+    # Every point of the curve matches binarizing the probability map at its threshold
+    inside = roi == 255
+    for row in curve[::7] + [curve[-1]]:
+        tn, fp, fn, tp, _ = confusion_matrix_stats_calculator.binary_confusion_counts(
+            ground_truth, np.where(probabilities >= row["threshold"], 255, 0), 255, inside)
+        assert (row["tp"], row["fp"], row["fn"], row["tn"]) == (tp, fp, fn, tn)
+
+    assert summary["f1"] == max(row["f1"] for row in curve)
+    assert summary["roc_auc"] == pytest.approx(roc_auc_score(ground_truth[inside] == 255, probabilities[inside]))
+    assert summary["average_precision"] == pytest.approx(
+        average_precision_score(ground_truth[inside] == 255, probabilities[inside]))
+
+
+def test_prefetch_pipeline(tmp_path):
+    import time
+    from Source.Tools.image_io import Prefetch, map_ordered
+    from Source.Tools.training_data_selector import image_list_avg
+
+    pulled = []
+
+    def items():
+        for item in range(20):
+            pulled.append(item)
+            yield item
+
+    def slow_square(item):
+        time.sleep(0.005)
+        return item * item
+
+    # The producer never gets more than the read-ahead depth past the consumer, and results stay in order
+    prefetch = Prefetch(read_ahead=3)
+    for consumed, result in enumerate(map_ordered(slow_square, items(), workers=2, prefetch=prefetch)):
+        assert result == consumed * consumed
+        assert len(pulled) - consumed <= 4
+
+    assert prefetch.items == 20 and prefetch.stalls > 0 and 0 < prefetch.wait_seconds <= prefetch.elapsed_seconds
+
+    with pytest.raises(ValueError):
+        Prefetch(read_ahead=0)
+
+    volume = np.random.default_rng(22).integers(0, 255, size=(6, 5, 4), dtype=np.uint8)
+    prefetch = Prefetch(read_ahead=1)
+    _, avg_img = image_list_avg(write_image_stack(tmp_path / "scan", volume), workers=1, prefetch=prefetch)
+    np.testing.assert_allclose(avg_img, volume.mean(axis=0))
+    assert prefetch.items == 6
+
+
+def test_instrumentation_report(tmp_path, monkeypatch):
+    import json
+    from Source.Tools import instrumentation, training_data_selector
+
+    rng = np.random.default_rng(23)
+    ground_truth = rng.choice([0, 255], size=(4, 6, 5)).astype(np.uint8)
+    ground_truth_path = write_image_stack(tmp_path / "gt", ground_truth)
+    predicted = np.where(rng.random(ground_truth.shape) < 0.3, 255 - ground_truth, ground_truth).astype(np.uint8)
+    predicted_path = write_image_stack(tmp_path / "pred", predicted)
+
+    # Off by default, stages cost nothing and no report is written
+    assert instrumentation.stage("count") is instrumentation.stage("decode")
+
+    report_path = tmp_path / "report.json"
+    monkeypatch.setenv(instrumentation.REPORT_ENVIRONMENT_VARIABLE, str(report_path))
+    monkeypatch.setenv(instrumentation.PROFILE_ENVIRONMENT_VARIABLE, str(tmp_path / "profiles"))
+    confusion_matrix_stats_calculator.confusion_matrix_statistics(255, False, False, ground_truth_path, predicted_path)
+
+    report = json.loads(report_path.read_text())
+    assert report["run"] == "confusion_matrix_statistics"
+    assert [stage["stage"] for stage in report["stages"]] == ["decode", "count"]
+    assert report["stages"][0]["slices"] == 4 and report["stages"][0]["bytes_decoded"] == 2 * ground_truth.nbytes
+    assert os.path.isfile(tmp_path / "profiles" / "confusion_matrix_statistics.decode.prof")
+
+    # The command line flag switches it on for the training data selector
+    monkeypatch.delenv(instrumentation.REPORT_ENVIRONMENT_VARIABLE)
+    monkeypatch.delenv(instrumentation.PROFILE_ENVIRONMENT_VARIABLE)
+    try:
+        training_data_selector.main([ground_truth_path, "--slices", "2", "--instrument", str(report_path),
+                                     "--output", str(tmp_path / "selection.json")])
+    finally:
+        instrumentation.configure()
+
+    stages = [stage["stage"] for stage in json.loads(report_path.read_text())["stages"]]
+    assert stages == ["listing", "averaging", "scoring", "extremum_radii", "extrema_search"]
+
+
+def test_dataset_index(tmp_path, capsys):
+    import json
+    import shutil
+    from Source.Tools import dataset_index
+
+    rng = np.random.default_rng(29)
+    archive = tmp_path / "archive"
+    (archive / "sample_a").mkdir(parents=True)
+    ground_truth = rng.choice([0, 255], size=(3, 7, 5)).astype(np.uint8)
+    write_image_stack(archive / "sample_a" / "gt_labels", ground_truth)
+    write_image_stack(archive / "sample_a" / "pred_labels", ground_truth)
+    write_image_stack(archive / "scan_b", rng.integers(0, 65535, size=(4, 6, 6), dtype=np.uint16))
+    index_path = str(tmp_path / "datasets.sqlite")
+
+    statistics = dataset_index.refresh_index(index_path, str(archive), workers=3)
+    assert statistics == {"scanned": 5, "unchanged": 0, "removed": 0}
+
+    # Stack folders are described from their listing and first image header only
+    datasets = dataset_index.find_datasets(index_path)
+    assert [os.path.basename(dataset["path"]) for dataset in datasets] == ["gt_labels", "pred_labels", "scan_b"]
+    scan = datasets[2]
+    assert scan["slice_count"] == 4 and scan["extensions"] == {".tiff": 4}
+    assert scan["shape"] == [6, 6] and scan["dtype"] == "uint16"
+    assert scan["total_size"] == sum(entry.stat().st_size for entry in os.scandir(scan["path"]))
+
+    # Phrases match folder names, patterns with wildcards match whole paths
+    assert len(dataset_index.find_datasets(index_path, "labels")) == 2
+    assert [dataset["name"] for dataset in dataset_index.find_datasets(index_path, "*/sample_a/gt_*")] == ["gt_labels"]
+
+    # Unchanged folders aren't listed again, changed and removed ones are updated
+    Image.fromarray(ground_truth[0]).save(archive / "scan_b" / "extra.png")
+    shutil.rmtree(archive / "sample_a" / "pred_labels")
+    statistics = dataset_index.refresh_index(index_path, str(archive))
+    assert statistics == {"scanned": 2, "unchanged": 2, "removed": 1}
+    scan = dataset_index.find_datasets(index_path, "scan")[0]
+    assert scan["slice_count"] == 5 and scan["extensions"] == {".tiff": 4, ".png": 1}
+
+    # Refreshing one folder leaves the subfolders of siblings whose names only match it as LIKE patterns alone
+    for folder in ("run_1", "runX1", "Scan", "scan"):
+        (archive / folder).mkdir()
+        write_image_stack(archive / folder / f"stack_{folder}", ground_truth)
+    dataset_index.refresh_index(index_path, str(archive))
+    assert dataset_index.refresh_index(index_path, str(archive / "run_1"))["removed"] == 0
+    assert dataset_index.refresh_index(index_path, str(archive / "Scan"))["removed"] == 0
+    assert len(dataset_index.find_datasets(index_path, "stack_", str(archive / "run_1"))) == 1
+    assert len(dataset_index.find_datasets(index_path, "stack_")) == 4
+
+    # A query standing in for a path must match exactly one stack folder
+    with pytest.raises(ValueError):
+        dataset_index.resolve_dataset_argument("_", index_path)
+    assert dataset_index.resolve_dataset_argument("gt_lab", index_path) == str(archive / "sample_a" / "gt_labels")
+
+    capsys.readouterr()
+    confusion_matrix_stats_calculator.main(["gt_labels", "gt_labels", "--index", index_path])
+    assert json.loads(capsys.readouterr().out)[0]["fp"] == 0
+
+
+def test_packed_mask_counts(tmp_path):
+    from Source.Tools.packed_mask import pack_labels, packed_confusion_counts
+    from Source.Tools.volume_sources import ArraySource
+
+    # Slices of 7 x 13 voxels don't fill whole words, and a few voxels are neither 0 nor 255
+    rng = np.random.default_rng(31)
+    ground_truth = rng.choice([0, 255], size=(5, 7, 13)).astype(np.uint8)
+    predicted = np.where(rng.random(ground_truth.shape) < 0.25, 255 - ground_truth, ground_truth).astype(np.uint8)
+    ground_truth[2, 3, 4] = 100
+    roi_mask = np.where(rng.random(ground_truth.shape) < 0.6, 255, 0).astype(np.uint8)
+
+    ground_truth_positive, ground_truth_labeled = pack_labels(ArraySource(ground_truth), 255)
+    predicted_positive, predicted_labeled = pack_labels(ArraySource(predicted), 255)
+    roi, _ = pack_labels(ArraySource(roi_mask), 255)
+
+    # One bit per voxel, with the labeled mask only kept for datasets holding other values
+    assert ground_truth_positive.nbytes == 5 * 2 * 8 and predicted_labeled is None
+    assert np.array_equal(ground_truth_positive.read(2), ground_truth[2] == 255)
+    assert np.array_equal(ground_truth_labeled.read(2), ground_truth[2] != 100)
+
+    volumes = np.moveaxis(ground_truth, 0, 2), np.moveaxis(predicted, 0, 2)
+    expected = np.stack(confusion_matrix_stats_calculator.binary_confusion_counts(
+        *volumes, 255, np.moveaxis(roi_mask == 255, 0, 2), True), axis=-1)
+    counts = packed_confusion_counts(ground_truth_positive, predicted_positive, ground_truth_labeled,
+                                     predicted_labeled, roi, per_slice=True)
+    assert np.array_equal(np.stack(counts, axis=-1), expected)
+
+    # The in-memory and streamed paths count the same on packed masks as the ROI-cropped path
+    ground_truth_path = write_image_stack(tmp_path / "gt", ground_truth)
+    predicted_path = write_image_stack(tmp_path / "pred", predicted)
+    roi_path = write_image_stack(tmp_path / "roi", roi_mask)
+    in_memory = confusion_matrix_stats_calculator.confusion_matrix_statistics(
+        255, False, False, ground_truth_path, predicted_path, profile=True)
+    assert np.array_equal(in_memory[1], np.stack(confusion_matrix_stats_calculator.binary_confusion_counts(
+        *volumes, 255, per_slice=True), axis=-1))
+
+    streamed = confusion_matrix_stats_calculator.confusion_matrix_statistics(
+        255, True, False, ground_truth_path, predicted_path, roi_path, slab_size=2)
+    cropped = confusion_matrix_stats_calculator.confusion_matrix_statistics(
+        255, True, False, ground_truth_path, predicted_path, roi_path)
+    assert np.array_equal(streamed[:4], cropped[:4])
+    assert np.array_equal(streamed[:4], expected.sum(axis=0)[3::-1])
+    tiled, _ = confusion_matrix_stats_calculator.confusion_matrix_statistics(
+        255, True, False, ground_truth_path, predicted_path, roi_path, slab_size=2, tile_size=4)
+    assert np.array_equal(tiled[:4], cropped[:4])